@@ -0,0 +1 @@
+"""Microbenchmarks for contextlib2"""
@@ -0,0 +1,324 @@
+"""Microbenchmarks comparing contextlib2 with the standard library contextlib.
+
+Each benchmark is run against both ``contextlib2`` (imported from this
+checkout) and the running interpreter's ``contextlib``, so the results are
+reported side by side as ``<benchmark>[contextlib2]`` and
+``<benchmark>[contextlib]``.
+
+If pyperf is installed, the benchmarks are run with ``pyperf.Runner`` (and
+accept all of its usual options)::
+
+    python -m benchmarks.bench_contextlib -o before.json
+    python -m benchmarks.bench_contextlib -o after.json
+    python -m pyperf compare_to before.json after.json
+
+Otherwise (or if ``--no-pyperf`` is given) a simple timeit based runner is
+used, which works offline with no additional dependencies. It writes its
+results as JSON with ``-o FILE``, and can report regressions relative to a
+previous run with ``--compare-to FILE``::
+
+    python -m benchmarks.bench_contextlib --no-pyperf -o before.json
+    python -m benchmarks.bench_contextlib --no-pyperf --compare-to before.json
+
+Running the suite before and after syncing with CPython (see
+``dev/sync_from_cpython.sh``) shows any resulting performance changes.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+if not __package__:
+    # Allow running as a script (as pyperf does for its worker processes)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import contextlib2
+
+MODULES = (contextlib2, contextlib)
+
+
+def _noop(*args):
+    pass
+
+
+def bench_contextmanager(loops, cl):
+    @cl.contextmanager
+    def cm():
+        yield
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with cm():
+            pass
+    return time.perf_counter() - t0
+
+
+def bench_contextmanager_decorator(loops, cl):
+    @cl.contextmanager
+    def cm():
+        yield
+
+    @cm()
+    def func():
+        pass
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        func()
+    return time.perf_counter() - t0
+
+
+def bench_context_decorator(loops, cl):
+    class cm(cl.ContextDecorator):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    @cm()
+    def func():
+        pass
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        func()
+    return time.perf_counter() - t0
+
+
+def _bench_exit_stack(callback_count):
+    def bench_exit_stack(loops, cl):
+        ExitStack = cl.ExitStack
+        callbacks = range(callback_count)
+        range_it = range(loops)
+        t0 = time.perf_counter()
+        for _ in range_it:
+            with ExitStack() as stack:
+                callback = stack.callback
+                for _ in callbacks:
+                    callback(_noop)
+        return time.perf_counter() - t0
+    return bench_exit_stack
+
+
+def bench_suppress_hit(loops, cl):
+    suppress = cl.suppress
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with suppress(KeyError):
+            raise KeyError
+    return time.perf_counter() - t0
+
+
+def bench_suppress_miss(loops, cl):
+    suppress = cl.suppress
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        try:
+            with suppress(KeyError):
+                raise ValueError
+        except ValueError:
+            pass
+    return time.perf_counter() - t0
+
+
+def bench_suppress_no_exception(loops, cl):
+    suppress = cl.suppress
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with suppress(KeyError):
+            pass
+    return time.perf_counter() - t0
+
+
+def bench_redirect_stdout(loops, cl):
+    redirect_stdout = cl.redirect_stdout
+    target = io.StringIO()
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with redirect_stdout(target):
+            pass
+    return time.perf_counter() - t0
+
+
+def bench_nullcontext(loops, cl):
+    nullcontext = cl.nullcontext
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with nullcontext():
+            pass
+    return time.perf_counter() - t0
+
+
+def bench_timed(loops, cl):
+    timed = cl.timed
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        with timed("bench"):
+            pass
+    return time.perf_counter() - t0
+
+bench_timed.requires = ("timed",)
+
+
+BENCHMARKS = {
+    "contextmanager": bench_contextmanager,
+    "contextmanager_decorator": bench_contextmanager_decorator,
+    "context_decorator": bench_context_decorator,
+    "exit_stack_1": _bench_exit_stack(1),
+    "exit_stack_10": _bench_exit_stack(10),
+    "exit_stack_1000": _bench_exit_stack(1000),
+    "suppress_hit": bench_suppress_hit,
+    "suppress_miss": bench_suppress_miss,
+    "suppress_no_exception": bench_suppress_no_exception,
+    "redirect_stdout": bench_redirect_stdout,
+    "nullcontext": bench_nullcontext,
+    "timed": bench_timed,
+}
+
+
+def iter_benchmarks(benchmarks=BENCHMARKS):
+    """Yields (name, bench_func, module) for each benchmark and module.
+
+    Benchmarks are skipped for modules lacking any of the attributes named
+    in the benchmark function's ``requires`` attribute (if it has one).
+    """
+    for name, func in benchmarks.items():
+        for cl in MODULES:
+            if all(hasattr(cl, attr) for attr in getattr(func, "requires", ())):
+                yield f"{name}[{cl.__name__}]", func, cl
+
+
+def run_pyperf(benchmarks=BENCHMARKS):
+    import pyperf
+    runner = pyperf.Runner()
+    runner.metadata["contextlib2_version"] = _contextlib2_version()
+    for name, func, cl in iter_benchmarks(benchmarks):
+        runner.bench_time_func(name, func, cl)
+
+
+def _calibrate_loops(func, cl, min_time):
+    loops = 1
+    while func(loops, cl) < min_time:
+        loops *= 2
+    return loops
+
+
+def _timeit(func, cl, *, min_time=0.05, values=5):
+    """Returns the seconds per loop of each timed run of func."""
+    loops = _calibrate_loops(func, cl, min_time)
+    func(loops, cl)  # Warmup
+    return [func(loops, cl) / loops for _ in range(values)]
+
+
+def _contextlib2_version():
+    version_path = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "VERSION.txt")
+    try:
+        with open(version_path) as version_file:
+            return version_file.read().strip()
+    except OSError:
+        return "unknown"
+
+
+def run_simple(args, benchmarks=BENCHMARKS):
+    """Runs the benchmarks with timeit style timing (no pyperf needed)."""
+    results = {}
+    for name, func, cl in iter_benchmarks(benchmarks):
+        if args.filter and not any(pattern in name for pattern in args.filter):
+            continue
+        values = _timeit(func, cl, min_time=args.min_time, values=args.values)
+        results[name] = {
+            "mean": statistics.mean(values),
+            "min": min(values),
+            "values": values,
+        }
+        mean = results[name]["mean"]
+        print(f"{name:<48} {mean * 1e9:10.1f} ns", flush=True)
+    report = {
+        "metadata": {
+            "python_implementation": platform.python_implementation(),
+            "python_version": platform.python_version(),
+            "contextlib2_version": _contextlib2_version(),
+            "platform": platform.platform(),
+        },
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.compare_to:
+        return compare(args.compare_to, report, args.threshold)
+    return 0
+
+
+def compare(baseline_path, report, threshold):
+    """Prints the changes relative to a baseline and counts regressions."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["benchmarks"]
+    regressions = 0
+    print(f"\nCompared to {baseline_path}:")
+    for name, result in report["benchmarks"].items():
+        if name not in baseline:
+            continue
+        ratio = result["min"] / baseline[name]["min"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<48} {ratio:6.2f}x{flag}")
+    return 1 if regressions else 0
+
+
+def make_arg_parser(description=__doc__):
+    parser = argparse.ArgumentParser(
+        description=description.splitlines()[0])
+    parser.add_argument("--no-pyperf", action="store_true",
+                        help="use the simple runner even if pyperf is installed")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--compare-to", metavar="FILE",
+                        help="report changes relative to a previous --output")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as a regression "
+                             "(default: %(default)s)")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="minimum seconds per timed value "
+                             "(default: %(default)s)")
+    parser.add_argument("--values", type=int, default=5,
+                        help="timed values per benchmark (default: %(default)s)")
+    parser.add_argument("filter", nargs="*",
+                        help="only run benchmarks with names containing "
+                             "one of these strings")
+    return parser
+
+
+def main(benchmarks=BENCHMARKS, description=__doc__):
+    if "--no-pyperf" not in sys.argv:
+        try:
+            import pyperf
+        except ImportError:
+            pass
+        else:
+            run_pyperf(benchmarks)
+            return 0
+    args = make_arg_parser(description).parse_args()
+    return run_simple(args, benchmarks)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
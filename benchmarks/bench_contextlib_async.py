@@ -0,0 +1,183 @@
+"""Asyncio microbenchmarks comparing contextlib2 with the standard library.
+
+Times the asynchronous context management APIs (@asynccontextmanager,
+AsyncContextDecorator and AsyncExitStack) for both ``contextlib2`` and the
+running interpreter's ``contextlib``. Each reported value is the event loop
+time per operation (such as one ``async with`` statement, or one call of a
+decorated coroutine function), measured inside a running event loop. The
+``*_tasks_100`` variants spread the operations across 100 concurrently
+running tasks that yield to the event loop inside every ``async with``
+statement, which gives the per-operation cost under load (the reciprocal
+being the throughput).
+
+Accepts the same options as ``benchmarks.bench_contextlib``::
+
+    python -m benchmarks.bench_contextlib_async --no-pyperf -o async.json
+"""
+import asyncio
+import os
+import sys
+import time
+
+if not __package__:
+    # Allow running as a script (as pyperf does for its worker processes)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_contextlib import main
+
+
+def _async_bench(func):
+    """Turns an async benchmark into a pyperf style time function.
+
+    The event loop is created outside the timed region.
+    """
+    def bench(loops, cl):
+        return asyncio.run(func(loops, cl))
+    bench.__name__ = func.__name__
+    return bench
+
+
+def _concurrent_bench(task_count):
+    """Runs an async benchmark spread across concurrently running tasks."""
+    def decorator(func):
+        async def bench(loops, cl):
+            per_task = max(loops // task_count, 1)
+            t0 = time.perf_counter()
+            await asyncio.gather(*(func(per_task, cl)
+                                   for _ in range(task_count)))
+            return (time.perf_counter() - t0) * loops / (per_task * task_count)
+        bench.__name__ = func.__name__
+        return _async_bench(bench)
+    return decorator
+
+
+async def _async_noop(*args):
+    pass
+
+
+async def _asynccontextmanager(loops, cl, *, yield_to_loop=False):
+    @cl.asynccontextmanager
+    async def cm():
+        yield
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    if yield_to_loop:
+        sleep = asyncio.sleep
+        for _ in range_it:
+            async with cm():
+                await sleep(0)
+    else:
+        for _ in range_it:
+            async with cm():
+                pass
+    return time.perf_counter() - t0
+
+
+@_async_bench
+async def bench_asynccontextmanager(loops, cl):
+    return await _asynccontextmanager(loops, cl)
+
+
+@_concurrent_bench(100)
+async def bench_asynccontextmanager_tasks(loops, cl):
+    return await _asynccontextmanager(loops, cl, yield_to_loop=True)
+
+
+@_async_bench
+async def bench_asynccontextmanager_decorator(loops, cl):
+    @cl.asynccontextmanager
+    async def cm():
+        yield
+
+    @cm()
+    async def func():
+        pass
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        await func()
+    return time.perf_counter() - t0
+
+
+@_async_bench
+async def bench_async_context_decorator(loops, cl):
+    class cm(cl.AsyncContextDecorator):
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc_info):
+            return False
+
+    @cm()
+    async def func():
+        pass
+
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        await func()
+    return time.perf_counter() - t0
+
+bench_async_context_decorator.requires = ("AsyncContextDecorator",)
+
+
+async def _async_exit_stack(loops, cl, callback_count, *, yield_to_loop=False):
+    AsyncExitStack = cl.AsyncExitStack
+    callbacks = range(callback_count)
+    sleep = asyncio.sleep
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        async with AsyncExitStack() as stack:
+            push_async_callback = stack.push_async_callback
+            for _ in callbacks:
+                push_async_callback(_async_noop)
+            if yield_to_loop:
+                await sleep(0)
+    return time.perf_counter() - t0
+
+
+def _bench_async_exit_stack(callback_count):
+    @_async_bench
+    async def bench_async_exit_stack(loops, cl):
+        return await _async_exit_stack(loops, cl, callback_count)
+    return bench_async_exit_stack
+
+
+@_concurrent_bench(100)
+async def bench_async_exit_stack_tasks(loops, cl):
+    return await _async_exit_stack(loops, cl, 10, yield_to_loop=True)
+
+
+@_async_bench
+async def bench_enter_async_context(loops, cl):
+    @cl.asynccontextmanager
+    async def cm():
+        yield
+
+    AsyncExitStack = cl.AsyncExitStack
+    range_it = range(loops)
+    t0 = time.perf_counter()
+    for _ in range_it:
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_context(cm())
+    return time.perf_counter() - t0
+
+
+BENCHMARKS = {
+    "asynccontextmanager": bench_asynccontextmanager,
+    "asynccontextmanager_tasks_100": bench_asynccontextmanager_tasks,
+    "asynccontextmanager_decorator": bench_asynccontextmanager_decorator,
+    "async_context_decorator": bench_async_context_decorator,
+    "async_exit_stack_1": _bench_async_exit_stack(1),
+    "async_exit_stack_10": _bench_async_exit_stack(10),
+    "async_exit_stack_100": _bench_async_exit_stack(100),
+    "async_exit_stack_10_tasks_100": bench_async_exit_stack_tasks,
+    "enter_async_context": bench_enter_async_context,
+}
+
+
+if __name__ == "__main__":
+    sys.exit(main(BENCHMARKS, __doc__))
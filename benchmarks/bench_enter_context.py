@@ -0,0 +1,86 @@
+"""Microbenchmark for ExitStack.enter_context() special method lookups.
+
+Compares entering the same context manager type in a tight loop against
+the alternatives for resolving __enter__/__exit__ on the type:
+
+* direct attribute lookup on the type (what enter_context() does), which
+  is served from the interpreter's own per-type attribute cache (keyed by
+  type version tag, and invalidated whenever the class or one of its bases
+  is mutated), so the depth of the MRO is irrelevant on a cache hit
+* Python level caches keyed by the type (a plain dict, which would keep
+  the types alive and can't notice class mutation, and a
+  WeakKeyDictionary, which is safe but much slower)
+
+Run with: python -m benchmarks.bench_enter_context
+"""
+import timeit
+import weakref
+
+import contextlib2
+
+
+class _Base:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# A class hierarchy deeper than that of _GeneratorContextManager
+_Deep = _Base
+for _i in range(8):
+    _Deep = type(f"_Deep{_i}", (_Deep,), {})
+
+
+@contextlib2.contextmanager
+def _gen_cm():
+    yield
+
+
+def bench_lookups(cls, number):
+    """Return seconds per lookup of the enter/exit pair for each strategy."""
+    strong_cache = {cls: (cls.__enter__, cls.__exit__)}
+    weak_cache = weakref.WeakKeyDictionary(strong_cache)
+    namespace = {"cls": cls, "strong_cache": strong_cache,
+                 "weak_cache": weak_cache}
+    statements = {
+        "type attribute lookup": "cls.__enter__; cls.__exit__",
+        "dict cache (unsafe)": "strong_cache[cls]",
+        "WeakKeyDictionary cache": "weak_cache[cls]",
+    }
+    return {
+        name: min(timeit.repeat(stmt, globals=namespace,
+                                number=number, repeat=5)) / number
+        for name, stmt in statements.items()
+    }
+
+
+def bench_enter_context(cm, number):
+    """Return seconds per ExitStack.enter_context() call."""
+    stack = contextlib2.ExitStack()
+    namespace = {"enter_context": stack.enter_context, "cm": cm}
+    best = min(timeit.repeat("enter_context(cm)", setup="pop_all()",
+                             globals=dict(namespace, pop_all=stack.pop_all),
+                             number=number, repeat=50))
+    stack.pop_all()
+    return best / number
+
+
+def main():
+    number = 200_000
+    for label, cls in (("_GeneratorContextManager",
+                        contextlib2._GeneratorContextManager),
+                       ("9 level class hierarchy", _Deep)):
+        print(f"Special method lookup, {label}:")
+        for name, seconds in bench_lookups(cls, number * 5).items():
+            print(f"  {name:<26} {seconds * 1e9:7.1f} ns")
+    print("ExitStack.enter_context():")
+    for label, cm in (("9 level class hierarchy", _Deep()),
+                      ("nullcontext", contextlib2.nullcontext())):
+        seconds = bench_enter_context(cm, number // 100)
+        print(f"  {label:<26} {seconds * 1e9:7.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark for reusing exit stacks via ExitStack.free_list().
+
+Simulates a request handler that registers a few callbacks on a fresh
+ExitStack per request, and compares it with acquiring the stack from a
+free list and releasing it afterwards. Reports the time per request and
+the peak memory allocated while handling a request (via tracemalloc).
+
+Run with: python -m benchmarks.bench_exitstack_reuse (requires Python 3.9+)
+"""
+import timeit
+import tracemalloc
+
+import contextlib2
+
+
+def _noop(*args):
+    pass
+
+
+def handle_request_new_stack():
+    with contextlib2.ExitStack() as stack:
+        stack.callback(_noop)
+        stack.callback(_noop)
+        stack.callback(_noop)
+
+
+_stacks = contextlib2.ExitStack.free_list()
+
+
+def handle_request_free_list():
+    stack = _stacks.acquire()
+    with stack:
+        stack.callback(_noop)
+        stack.callback(_noop)
+        stack.callback(_noop)
+    _stacks.release(stack)
+
+
+def peak_allocated(handler, number):
+    """Return the peak bytes allocated (via tracemalloc) per call to handler."""
+    handler()
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            handler()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def main():
+    number = 100_000
+    for label, handler in (("new ExitStack per request",
+                            handle_request_new_stack),
+                           ("ExitStack.free_list()", handle_request_free_list)):
+        seconds = min(timeit.repeat(handler, number=number, repeat=5)) / number
+        allocated = peak_allocated(handler, 1000)
+        print(f"{label:<28} {seconds * 1e9:7.1f} ns "
+              f"{allocated:7.1f} bytes allocated per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Benchmark for unwinding exit stacks when no exception is raised.
+
+Times a with statement around an ExitStack (and an AsyncExitStack) with a
+few registered callbacks, none of which fail, which is by far the most
+common way for a stack to be unwound.
+
+Run with: python -m benchmarks.bench_exitstack_unwind
+"""
+import asyncio
+import timeit
+
+import contextlib2
+
+
+def _noop(*args):
+    pass
+
+
+async def _async_noop(*args):
+    pass
+
+
+def unwind_sync(callback_count):
+    with contextlib2.ExitStack() as stack:
+        for _ in range(callback_count):
+            stack.callback(_noop)
+
+
+async def unwind_async(callback_count, number):
+    for _ in range(number):
+        async with contextlib2.AsyncExitStack() as stack:
+            for _ in range(callback_count):
+                stack.push_async_callback(_async_noop)
+
+
+def main():
+    number = 50_000
+    for callback_count in (0, 1, 10):
+        seconds = min(timeit.repeat(lambda: unwind_sync(callback_count),
+                                    number=number, repeat=5)) / number
+        print(f"ExitStack, {callback_count:>2} callbacks      "
+              f"{seconds * 1e9:8.1f} ns")
+    for callback_count in (0, 1, 10):
+        seconds = min(
+            timeit.repeat(
+                lambda: asyncio.run(unwind_async(callback_count, number)),
+                number=1, repeat=5)) / number
+        print(f"AsyncExitStack, {callback_count:>2} callbacks "
+              f"{seconds * 1e9:8.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Memory footprint of context manager instances.
+
+Creates a large number of instances of each context manager (keeping them
+all alive, as a server with many requests in flight would) and reports the
+bytes allocated per instance (via tracemalloc), for both ``contextlib2`` and
+the running interpreter's ``contextlib``. Only the context manager objects
+themselves are measured: their arguments are shared between all instances.
+
+Run with: python -m benchmarks.bench_memory
+"""
+import contextlib
+import io
+import sys
+import tracemalloc
+
+import contextlib2
+
+MODULES = (contextlib2, contextlib)
+
+
+def _gen():
+    yield
+
+
+async def _agen():
+    yield
+
+
+_stream = io.StringIO()
+
+# Each factory creates one instance using the given module
+FACTORIES = {
+    "closing": lambda cl: cl.closing(_stream),
+    "aclosing": lambda cl: cl.aclosing(_stream),
+    "nullcontext": lambda cl: cl.nullcontext(_stream),
+    "suppress": lambda cl: cl.suppress(KeyError),
+    "redirect_stdout": lambda cl: cl.redirect_stdout(_stream),
+    "chdir": lambda cl: cl.chdir("."),
+    "contextmanager": lambda cl: cl.contextmanager(_gen)(),
+    "asynccontextmanager": lambda cl: cl.asynccontextmanager(_agen)(),
+}
+
+
+def bytes_per_instance(factory, number=10_000):
+    """Return the bytes allocated per instance while keeping number alive.
+
+    Note that the generator based context managers include the generator.
+    """
+    factory()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [factory() for _ in range(number)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # Exclude the list used to keep the instances alive
+    result = (after - before - sys.getsizeof(instances)) / number
+    for cm in instances:
+        gen = getattr(cm, "gen", None)
+        if hasattr(gen, "aclose"):
+            # Avoid "never awaited" noise from unstarted async generators
+            gen.aclose().close()
+    return result
+
+
+def main():
+    print(f"{'context manager':<24} {'contextlib2':>12} {'contextlib':>12}")
+    for name, make in FACTORIES.items():
+        row = []
+        for cl in MODULES:
+            if not hasattr(cl, name):
+                row.append(f"{'n/a':>12}")
+                continue
+            result = bytes_per_instance(lambda: make(cl))
+            row.append(f"{result:10.1f} B")
+        print(f"{name:<24} {' '.join(row)}")
+
+
+if __name__ == "__main__":
+    main()
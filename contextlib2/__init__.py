@@ -1,11 +1,18 @@
 """Utilities for with-statement contexts.  See PEP 343."""
 import abc
+import array
+import contextvars
+import itertools
 import os
 import sys
+import threading
+import weakref
 import _collections_abc
-from collections import deque
-from functools import wraps
-from types import MethodType
+from collections import OrderedDict, deque, namedtuple
+from functools import partial, wraps
+from time import monotonic as _monotonic, perf_counter as _perf_counter
+from time import perf_counter_ns as _perf_counter_ns
+from types import FunctionType, MethodType
 
 # Python 3.8 compatibility: GenericAlias may not be defined
 try:
@@ -22,10 +29,58 @@ except ImportError:
 try:
     BaseExceptionGroup
 except NameError:
-    # If the real BaseExceptionGroup type doesn't exist, it will never actually
-    # be raised. This means the fallback placeholder doesn't need to provide
-    # any meaningful behaviour, it just needs to be compatible with 'issubclass'
+    # If the real BaseExceptionGroup type doesn't exist, the only exception
+    # groups ever raised are those from AsyncExitStack.concurrent_group(). This
+    # means the fallback only needs to provide enough of the real API for
+    # those to be inspected and filtered by 'suppress'
     class BaseExceptionGroup(BaseException):
+        def __new__(cls, message, exceptions, /):
+            if (cls is BaseExceptionGroup
+                    and all(isinstance(exc, Exception) for exc in exceptions)):
+                cls = ExceptionGroup
+            return super().__new__(cls, message, exceptions)
+
+        def __init__(self, message, exceptions, /):
+            super().__init__(message, exceptions)
+            self.message = message
+            self.exceptions = tuple(exceptions)
+
+        def __str__(self):
+            return f"{self.message} ({len(self.exceptions)} sub-exceptions)"
+
+        def derive(self, excs):
+            return BaseExceptionGroup(self.message, excs)
+
+        def split(self, condition):
+            if isinstance(condition, (type, tuple)):
+                exc_types = condition
+                condition = lambda exc: isinstance(exc, exc_types)
+            if condition(self):
+                return self, None
+            match, rest = [], []
+            for exc in self.exceptions:
+                if isinstance(exc, BaseExceptionGroup):
+                    exc_match, exc_rest = exc.split(condition)
+                elif condition(exc):
+                    exc_match, exc_rest = exc, None
+                else:
+                    exc_match, exc_rest = None, exc
+                if exc_match is not None:
+                    match.append(exc_match)
+                if exc_rest is not None:
+                    rest.append(exc_rest)
+            return self._derive_split(match), self._derive_split(rest)
+
+        def _derive_split(self, excs):
+            if not excs:
+                return None
+            group = self.derive(excs)
+            group.__cause__ = self.__cause__
+            group.__context__ = self.__context__
+            group.__traceback__ = self.__traceback__
+            return group
+
+    class ExceptionGroup(BaseExceptionGroup, Exception):
         pass
 
 # Python 3.9 and earlier compatibility: anext may not be defined
@@ -50,13 +105,19 @@ __all__ = ["asynccontextmanager", "contextmanager", "closing", "nullcontext",
            "AbstractContextManager", "AbstractAsyncContextManager",
            "AsyncExitStack", "ContextDecorator", "ExitStack",
            "redirect_stdout", "redirect_stderr", "suppress", "aclosing",
-           "chdir"]
+           "chdir", "ResourcePool", "AsyncResourcePool", "shared", "lazy",
+           "cached_contextmanager", "add_context_hook", "remove_context_hook",
+           "timed", "LatencyHistogram", "get_latency_histogram",
+           "format_latency_histograms", "ExitProfile",
+           "ExitTimeoutError", "SpanTracer", "counting_suppress"]
 
 
 class AbstractContextManager(abc.ABC):
 
     """An abstract base class for context managers."""
 
+    __slots__ = ()
+
     __class_getitem__ = classmethod(GenericAlias)
 
     def __enter__(self):
@@ -79,6 +140,8 @@ class AbstractAsyncContextManager(abc.ABC):
 
     """An abstract base class for asynchronous context managers."""
 
+    __slots__ = ()
+
     __class_getitem__ = classmethod(GenericAlias)
 
     async def __aenter__(self):
@@ -98,9 +161,36 @@ class AbstractAsyncContextManager(abc.ABC):
         return NotImplemented
 
 
+# Code object flags (as defined by the inspect module)
+_CO_GENERATOR = 0x20
+_CO_COROUTINE = 0x80
+_CO_ASYNC_GENERATOR = 0x200
+
+
+def _code_flags(func):
+    """Return the code object flags of the function underlying func.
+
+    This unwraps methods and partial objects the same way as
+    inspect.isgeneratorfunction(), without needing to import inspect.
+    Returns 0 for objects that aren't (wrapped) Python functions.
+    """
+    while True:
+        if isinstance(func, MethodType):
+            func = func.__func__
+        elif isinstance(func, partial):
+            func = func.func
+        else:
+            break
+    if isinstance(func, FunctionType):
+        return func.__code__.co_flags
+    return 0
+
+
 class ContextDecorator(object):
     "A base class or mixin that enables context managers to work as decorators."
 
+    __slots__ = ()
+
     def refresh_cm(self):
         """Returns the context manager used to actually wrap the call to the
         decorated function.
@@ -132,6 +222,36 @@ class ContextDecorator(object):
         return self
 
     def __call__(self, func):
+        flags = _code_flags(func)
+        if flags & _CO_GENERATOR:
+            # Keep the context open while the generator is running
+            @wraps(func)
+            def inner(*args, **kwds):
+                with self._recreate_cm():
+                    return (yield from func(*args, **kwds))
+            return inner
+        if flags & _CO_ASYNC_GENERATOR:
+            @wraps(func)
+            async def inner(*args, **kwds):
+                agen = func(*args, **kwds)
+                with self._recreate_cm():
+                    # Equivalent to "yield from" for async generators
+                    try:
+                        value = await agen.__anext__()
+                        while True:
+                            try:
+                                sent = yield value
+                            except GeneratorExit:
+                                await agen.aclose()
+                                raise
+                            except BaseException as exc:
+                                value = await agen.athrow(exc)
+                            else:
+                                value = await agen.asend(sent)
+                    except StopAsyncIteration:
+                        pass
+            return inner
+
         @wraps(func)
         def inner(*args, **kwds):
             with self._recreate_cm():
@@ -142,12 +262,37 @@ class ContextDecorator(object):
 class AsyncContextDecorator(object):
     "A base class or mixin that enables async context managers to work as decorators."
 
+    __slots__ = ()
+
     def _recreate_cm(self):
         """Return a recreated instance of self.
         """
         return self
 
     def __call__(self, func):
+        if _code_flags(func) & _CO_ASYNC_GENERATOR:
+            # Keep the context open while the generator is running
+            @wraps(func)
+            async def inner(*args, **kwds):
+                agen = func(*args, **kwds)
+                async with self._recreate_cm():
+                    # Equivalent to "yield from" for async generators
+                    try:
+                        value = await agen.__anext__()
+                        while True:
+                            try:
+                                sent = yield value
+                            except GeneratorExit:
+                                await agen.aclose()
+                                raise
+                            except BaseException as exc:
+                                value = await agen.athrow(exc)
+                            else:
+                                value = await agen.asend(sent)
+                    except StopAsyncIteration:
+                        pass
+            return inner
+
         @wraps(func)
         async def inner(*args, **kwds):
             async with self._recreate_cm():
@@ -155,29 +300,61 @@ class AsyncContextDecorator(object):
         return inner
 
 
+class _GeneratorContextManagerDoc:
+    """Class level __doc__ reporting the generator function's docstring.
+
+    Issue 19330: ensure context manager instances have good docstrings,
+    without storing a docstring on every instance.
+    """
+
+    __slots__ = ("_class_doc",)
+
+    def __init__(self, class_doc):
+        self._class_doc = class_doc
+
+    def __get__(self, instance, owner=None):
+        if instance is not None:
+            doc = getattr(getattr(instance, "func", None), "__doc__", None)
+            if doc is not None:
+                return doc
+        return self._class_doc
+
+
 class _GeneratorContextManagerBase:
     """Shared functionality for @contextmanager and @asynccontextmanager."""
 
-    def __init__(self, func, args, kwds):
-        self.gen = func(*args, **kwds)
-        self.func, self.args, self.kwds = func, args, kwds
-        # Issue 19330: ensure context manager instances have good docstrings
-        doc = getattr(func, "__doc__", None)
-        if doc is None:
-            doc = type(self).__doc__
-        self.__doc__ = doc
+    # Instances are created for every call of a decorated generator
+    # function, so avoid the memory overhead of an instance __dict__
+    __slots__ = ("gen", "func", "args", "kwds", "__weakref__")
+
+    def __init_subclass__(cls, **kwds):
+        super().__init_subclass__(**kwds)
+        cls.__doc__ = _GeneratorContextManagerDoc(cls.__dict__.get("__doc__"))
         # Unfortunately, this still doesn't provide good help output when
         # inspecting the created context manager instances, since pydoc
         # currently bypasses the instance docstring and shows the docstring
         # for the class instead.
         # See http://bugs.python.org/issue19404 for more details.
 
+    def __init__(self, func, args, kwds):
+        self.gen = func(*args, **kwds)
+        self.func, self.args, self.kwds = func, args, kwds
+
     def _recreate_cm(self):
         # _GCMB instances are one-shot context managers, so the
         # CM must be recreated each time a decorated function is
         # called
         return self.__class__(self.func, self.args, self.kwds)
 
+    @classmethod
+    def _for_exception(cls, gen):
+        # The decorators created by the subclasses drive the generator
+        # directly, so a context manager instance is only needed to
+        # reuse the exit logic when the decorated function raises
+        cm = cls.__new__(cls)
+        cm.gen = gen
+        return cm
+
 
 class _GeneratorContextManager(
     _GeneratorContextManagerBase,
@@ -186,15 +363,54 @@ class _GeneratorContextManager(
 ):
     """Helper for @contextmanager decorator."""
 
+    __slots__ = ()
+
     def __enter__(self):
         # do not keep args and kwds alive unnecessarily
         # they are only needed for recreation, which is not possible anymore
-        del self.args, self.kwds, self.func
+        # (func is kept, as the decorator keeps it alive regardless, and it
+        # provides the instance docstring)
+        del self.args, self.kwds
         try:
             return next(self.gen)
         except StopIteration:
             raise RuntimeError("generator didn't yield") from None
 
+    def __call__(self, func):
+        if _code_flags(func) & (_CO_GENERATOR | _CO_ASYNC_GENERATOR):
+            return super().__call__(func)
+        # Equivalent to ContextDecorator.__call__, but without
+        # recreating the context manager for every call
+        gen_func, args, kwds = self.func, self.args, self.kwds
+        for_exception = self._for_exception
+
+        @wraps(func)
+        def inner(*inner_args, **inner_kwds):
+            if _context_hooks:
+                # Report the enter and exit to the instrumentation hooks
+                with self._recreate_cm():
+                    return func(*inner_args, **inner_kwds)
+            gen = gen_func(*args, **kwds)
+            try:
+                next(gen)
+            except StopIteration:
+                raise RuntimeError("generator didn't yield") from None
+            try:
+                result = func(*inner_args, **inner_kwds)
+            except BaseException:
+                if for_exception(gen).__exit__(*sys.exc_info()):
+                    return None
+                raise
+            try:
+                next(gen)
+            except StopIteration:
+                return result
+            try:
+                raise RuntimeError("generator didn't stop")
+            finally:
+                gen.close()
+        return inner
+
     def __exit__(self, typ, value, traceback):
         if typ is None:
             try:
@@ -259,15 +475,54 @@ class _AsyncGeneratorContextManager(
 ):
     """Helper for @asynccontextmanager decorator."""
 
+    __slots__ = ()
+
     async def __aenter__(self):
         # do not keep args and kwds alive unnecessarily
         # they are only needed for recreation, which is not possible anymore
-        del self.args, self.kwds, self.func
+        # (func is kept, as the decorator keeps it alive regardless, and it
+        # provides the instance docstring)
+        del self.args, self.kwds
         try:
             return await anext(self.gen)
         except StopAsyncIteration:
             raise RuntimeError("generator didn't yield") from None
 
+    def __call__(self, func):
+        if _code_flags(func) & _CO_ASYNC_GENERATOR:
+            return super().__call__(func)
+        # Equivalent to AsyncContextDecorator.__call__, but without
+        # recreating the context manager for every call
+        gen_func, args, kwds = self.func, self.args, self.kwds
+        for_exception = self._for_exception
+
+        @wraps(func)
+        async def inner(*inner_args, **inner_kwds):
+            if _context_hooks:
+                # Report the enter and exit to the instrumentation hooks
+                async with self._recreate_cm():
+                    return await func(*inner_args, **inner_kwds)
+            gen = gen_func(*args, **kwds)
+            try:
+                await anext(gen)
+            except StopAsyncIteration:
+                raise RuntimeError("generator didn't yield") from None
+            try:
+                result = await func(*inner_args, **inner_kwds)
+            except BaseException:
+                if await for_exception(gen).__aexit__(*sys.exc_info()):
+                    return None
+                raise
+            try:
+                await anext(gen)
+            except StopAsyncIteration:
+                return result
+            try:
+                raise RuntimeError("generator didn't stop")
+            finally:
+                await gen.aclose()
+        return inner
+
     async def __aexit__(self, typ, value, traceback):
         if typ is None:
             try:
@@ -409,6 +664,8 @@ class closing(AbstractContextManager):
             f.close()
 
     """
+    __slots__ = ("thing", "__weakref__")
+
     def __init__(self, thing):
         self.thing = thing
     def __enter__(self):
@@ -435,6 +692,8 @@ class aclosing(AbstractAsyncContextManager):
             await agen.aclose()
 
     """
+    __slots__ = ("thing", "__weakref__")
+
     def __init__(self, thing):
         self.thing = thing
     async def __aenter__(self):
@@ -445,6 +704,8 @@ class aclosing(AbstractAsyncContextManager):
 
 class _RedirectStream(AbstractContextManager):
 
+    __slots__ = ("_new_target", "_old_targets", "__weakref__")
+
     _stream = None
 
     def __init__(self, new_target):
@@ -474,15 +735,25 @@ class redirect_stdout(_RedirectStream):
                 help(pow)
     """
 
+    __slots__ = ()
+
     _stream = "stdout"
 
 
 class redirect_stderr(_RedirectStream):
     """Context manager for temporarily redirecting stderr to another file."""
 
+    __slots__ = ()
+
     _stream = "stderr"
 
 
+# suppress() verdicts for the exceptions in an exception group
+_SUPPRESS_NO_MATCH = 0
+_SUPPRESS_MATCH = 1
+_SUPPRESS_NESTED = 2
+
+
 class suppress(AbstractContextManager):
     """Context manager to suppress specified exceptions
 
@@ -494,6 +765,10 @@ class suppress(AbstractContextManager):
          # Execution still resumes here if the file was already removed
     """
 
+    # _verdicts caches the _SUPPRESS_* verdict for each exception type found
+    # in exception groups, and is only created when one is handled
+    __slots__ = ("_exceptions", "_verdicts", "__weakref__")
+
     def __init__(self, *exceptions):
         self._exceptions = exceptions
 
@@ -514,37 +789,258 @@ class suppress(AbstractContextManager):
             return
         if issubclass(exctype, self._exceptions):
             return True
+        if issubclass(exctype, BaseExceptionGroup):
+            return self._exit_group(excinst)
+        return False
+
+    def _exit_group(self, excgroup):
+        # Only split the group (which copies the tree of nested groups) if
+        # some, but not all, of the leaf exceptions are suppressed
+        exceptions = self._exceptions
+        try:
+            verdicts = self._verdicts
+        except AttributeError:
+            verdicts = self._verdicts = {}
+        matched = unmatched = False
+        pending = [excgroup]
+        while pending:
+            group = pending.pop()
+            # Groups usually contain many instances of a few types, so the
+            # verdicts are looked up once per type (iterating in C)
+            for exctype in set(map(type, group.exceptions)):
+                verdict = verdicts.get(exctype)
+                if verdict is None:
+                    if issubclass(exctype, exceptions):
+                        verdict = _SUPPRESS_MATCH
+                    elif issubclass(exctype, BaseExceptionGroup):
+                        verdict = _SUPPRESS_NESTED
+                    else:
+                        verdict = _SUPPRESS_NO_MATCH
+                    verdicts[exctype] = verdict
+                if verdict == _SUPPRESS_NESTED:
+                    pending.extend(exc for exc in group.exceptions
+                                   if type(exc) is exctype)
+                elif verdict == _SUPPRESS_MATCH:
+                    matched = True
+                else:
+                    unmatched = True
+            if matched and unmatched:
+                match, rest = excgroup.split(exceptions)
+                raise rest
+        # Either everything matched, or nothing did (in which case the
+        # original group is left to propagate unchanged)
+        return not unmatched
+
+
+class counting_suppress(suppress, AbstractAsyncContextManager,
+                        ContextDecorator):
+    """Variant of suppress that counts the exceptions it suppresses
+
+    Counts are kept per exception type, along with a bounded random sample
+    of formatted tracebacks. The exceptions themselves are not retained,
+    so they don't keep the frames they were raised from alive. A single
+    instance is intended to be reused (including as a decorator for both
+    regular and coroutine functions):
+
+         remove_quietly = counting_suppress(FileNotFoundError)
+         for name in names:
+             with remove_quietly:
+                 os.remove(name)
+         print(remove_quietly.counts)
+    """
+
+    __slots__ = ("max_samples", "counts", "samples", "_suppressed", "_lock")
+
+    def __init__(self, *exceptions, max_samples=10):
+        super().__init__(*exceptions)
+        self.max_samples = max_samples
+        self.counts = {}
+        self.samples = []
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        """The number of times exceptions were suppressed."""
+        return self._suppressed
+
+    def reset(self):
+        """Discard the counts and samples."""
+        with self._lock:
+            self.counts = {}
+            self.samples = []
+            self._suppressed = 0
+
+    def __call__(self, func):
+        if _code_flags(func) & _CO_COROUTINE:
+            return AsyncContextDecorator.__call__(self, func)
+        return ContextDecorator.__call__(self, func)
+
+    def __exit__(self, exctype, excinst, exctb):
+        if exctype is None:
+            return
+        if issubclass(exctype, self._exceptions):
+            self._record(exctype, excinst, exctb, (exctype,))
+            return True
         if issubclass(exctype, BaseExceptionGroup):
             match, rest = excinst.split(self._exceptions)
+            if match is None:
+                return False
+            self._record(exctype, excinst, exctb, _leaf_types(match))
             if rest is None:
                 return True
             raise rest
         return False
 
+    # Not replaced while context hooks are installed, so an async exit
+    # isn't reported as a sync exit too
+    _exit = __exit__
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exctype, excinst, exctb):
+        return self._exit(exctype, excinst, exctb)
+
+    def _record(self, exctype, excinst, exctb, suppressed_types):
+        # The traceback is only formatted if it is chosen for the sample
+        # (using reservoir sampling, so every suppressed exception has the
+        # same chance of being included)
+        with self._lock:
+            counts = self.counts
+            for suppressed_type in suppressed_types:
+                counts[suppressed_type] = counts.get(suppressed_type, 0) + 1
+            self._suppressed += 1
+            seen = self._suppressed
+            samples = self.samples
+            if len(samples) < self.max_samples:
+                index = len(samples)
+                samples.append(None)
+            else:
+                import random
+                index = random.randrange(seen)
+                if index >= self.max_samples:
+                    return
+        import traceback
+        formatted = "".join(traceback.format_exception(exctype, excinst, exctb))
+        with self._lock:
+            if samples is self.samples:
+                samples[index] = formatted
+
+
+def _leaf_types(excgroup):
+    """Returns the types of the leaf exceptions in an exception group."""
+    types = []
+    pending = [excgroup]
+    while pending:
+        for exc in pending.pop().exceptions:
+            if isinstance(exc, BaseExceptionGroup):
+                pending.append(exc)
+            else:
+                types.append(type(exc))
+    return types
+
+
+# Registered exit callbacks are stored in a flat deque, with each entry
+# occupying _EXIT_ENTRY_SIZE consecutive slots: (kind, target, arg, kwds).
+# This avoids allocating a closure, bound method or tuple per registration.
+_EXIT_ENTRY_SIZE = 4
+# target(*exc_details)
+_EXIT_PUSHED = 0
+# target(arg, *exc_details), where target is an unbound __exit__ method
+_EXIT_CM = 1
+# target(*arg, **kwds), with the result ignored
+_EXIT_CALLBACK = 2
+# Flag set on the kinds above when the result must be awaited
+_EXIT_ASYNC = 4
+# Shared (never modified) keyword arguments for bulk registered callbacks
+_NO_KWDS = {}
+
 
 class _BaseExitStack:
     """A base class for ExitStack and AsyncExitStack."""
 
-    @staticmethod
-    def _create_exit_wrapper(cm, cm_exit):
-        return MethodType(cm_exit, cm)
-
-    @staticmethod
-    def _create_cb_wrapper(callback, /, *args, **kwds):
-        def _exit_wrapper(exc_type, exc, tb):
-            callback(*args, **kwds)
-        return _exit_wrapper
+    # Set while the stack is held in an _ExitStackFreeList
+    _in_free_list = False
 
     def __init__(self):
         self._exit_callbacks = deque()
 
+    @classmethod
+    def free_list(cls, maxsize=64):
+        """Returns a bounded free list of reusable instances of this class."""
+        return _ExitStackFreeList(cls, maxsize)
+
+    def reset(self):
+        """Prepares a closed stack for reuse.
+
+        Raises RuntimeError if any exit callbacks are still registered.
+        """
+        if self._exit_callbacks:
+            raise RuntimeError("cannot reset a stack with pending exit callbacks")
+        if type(self._exit_callbacks) is not deque:
+            # Stop profiling, so reused stacks start from a clean slate
+            self._exit_callbacks = deque()
+
+    def mark(self):
+        """Returns a marker for the current position in the context stack.
+
+        The marker may be passed to unwind_to() (or aunwind_to() for async
+        stacks) to unwind only the callbacks registered after this point.
+        """
+        return len(self._exit_callbacks) // _EXIT_ENTRY_SIZE
+
+    def _detach_to_mark(self, mark):
+        """Detach and return the exit callback entries registered after *mark*."""
+        if not 0 <= mark <= len(self._exit_callbacks) // _EXIT_ENTRY_SIZE:
+            raise ValueError(f"cannot unwind to mark {mark!r}, as the stack "
+                             f"no longer extends that far")
+        return self._pop_exit_entries(mark * _EXIT_ENTRY_SIZE)
+
     def pop_all(self):
         """Preserve the context stack by transferring it to a new instance."""
         new_stack = type(self)()
-        new_stack._exit_callbacks = self._exit_callbacks
-        self._exit_callbacks = deque()
+        callbacks = self._exit_callbacks
+        new_stack._exit_callbacks = callbacks
+        if type(callbacks) is deque:
+            self._exit_callbacks = deque()
+        else:
+            self._exit_callbacks = callbacks.new_empty()
         return new_stack
 
+    def enable_profiling(self, profile=None):
+        """Times the exit callbacks registered from now on.
+
+        Each timing is recorded along with the site that registered the
+        callback, and aggregated into *profile* (a new ExitProfile if None),
+        which may be shared between stacks. Returns the profile.
+        """
+        if profile is None:
+            profile = ExitProfile()
+        callbacks = _ProfiledExitCallbacks(_ExitStackTimings(profile))
+        # Callbacks that are already registered aren't timed
+        deque.extend(callbacks, self._exit_callbacks)
+        self._exit_callbacks = callbacks
+        return profile
+
+    def _end_profiled_unwind(self):
+        # Any further exits are reported as part of a new unwind
+        timings = getattr(self._exit_callbacks, "timings", None)
+        if timings is not None:
+            timings.unwinding = False
+
+    def slowest_exits(self, n=10):
+        """Returns the n slowest exit callbacks from the last unwind.
+
+        Raises RuntimeError if profiling isn't enabled for the stack.
+        """
+        try:
+            timings = self._exit_callbacks.timings
+        except AttributeError:
+            raise RuntimeError("profiling is not enabled for this stack") from None
+        return sorted(timings.last_unwind, key=lambda timing: timing.duration,
+                      reverse=True)[:n]
+
     def push(self, exit):
         """Registers a callback with the standard __exit__ method signature.
 
@@ -560,9 +1056,9 @@ class _BaseExitStack:
             exit_method = _cb_type.__exit__
         except AttributeError:
             # Not a context manager, so assume it's a callable.
-            self._push_exit_callback(exit)
+            self._exit_callbacks.extend((_EXIT_PUSHED, exit, None, None))
         else:
-            self._push_cm_exit(exit, exit_method)
+            self._exit_callbacks.extend((_EXIT_CM, exit_method, exit, None))
         return exit  # Allow use as a decorator.
 
     def enter_context(self, cm):
@@ -581,29 +1077,119 @@ class _BaseExitStack:
             raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' object does "
                             f"not support the context manager protocol") from None
         result = _enter(cm)
-        self._push_cm_exit(cm, _exit)
+        self._exit_callbacks.extend((_EXIT_CM, _exit, cm, None))
         return result
 
+    def enter_contexts(self, cms):
+        """Enters each of the supplied context managers in turn.
+
+        Returns a list of the results of the __enter__ methods. If entering
+        any context manager fails, the ones already entered by this call are
+        unwound and the exception is propagated.
+        """
+        callbacks = self._exit_callbacks
+        start = len(callbacks)
+        results = []
+        last_cls = None
+        try:
+            for cm in cms:
+                # Consecutive context managers are often of the same type,
+                # so the special method lookup is only repeated on a change
+                cls = type(cm)
+                if cls is not last_cls:
+                    try:
+                        _enter = cls.__enter__
+                        _exit = cls.__exit__
+                    except _CL2_ERROR_TO_CONVERT:
+                        raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' "
+                                        f"object does not support the context "
+                                        f"manager protocol") from None
+                    last_cls = cls
+                results.append(_enter(cm))
+                callbacks.extend((_EXIT_CM, _exit, cm, None))
+        except:
+            batch = ExitStack()
+            batch._exit_callbacks = self._pop_exit_entries(start)
+            batch.__exit__(*sys.exc_info())
+            raise
+        return results
+
     def callback(self, callback, /, *args, **kwds):
         """Registers an arbitrary callback and arguments.
 
         Cannot suppress exceptions.
         """
-        _exit_wrapper = self._create_cb_wrapper(callback, *args, **kwds)
+        self._exit_callbacks.extend((_EXIT_CALLBACK, callback, args, kwds))
+        return callback  # Allow use as a decorator
+
+    def callbacks(self, callback, /, *iterables):
+        """Registers a callback once for each set of arguments.
+
+        Arguments are taken from the iterables in the same way as map(),
+        and the callbacks are invoked in the reverse order of the arguments.
 
-        # We changed the signature, so using @wraps is not appropriate, but
-        # setting __wrapped__ may still help with introspection.
-        _exit_wrapper.__wrapped__ = callback
-        self._push_exit_callback(_exit_wrapper)
+        Cannot suppress exceptions.
+        """
+        self._exit_callbacks.extend(self._iter_callback_entries(
+            _EXIT_CALLBACK, callback, iterables))
         return callback  # Allow use as a decorator
 
-    def _push_cm_exit(self, cm, cm_exit):
-        """Helper to correctly register callbacks to __exit__ methods."""
-        _exit_wrapper = self._create_exit_wrapper(cm, cm_exit)
-        self._push_exit_callback(_exit_wrapper, True)
+    @staticmethod
+    def _iter_callback_entries(kind, callback, iterables):
+        for args in zip(*iterables):
+            yield kind
+            yield callback
+            yield args
+            yield _NO_KWDS
+
+    def _pop_exit_entries(self, start):
+        """Detach and return the exit callback entries after *start*."""
+        callbacks = self._exit_callbacks
+        popped = deque()
+        for _ in range(len(callbacks) - start):
+            popped.appendleft(callbacks.pop())
+        return popped
+
+
+class _ExitStackFreeList:
+    """A bounded free list of reusable exit stacks.
+
+    Stacks are obtained with acquire() and, once closed, handed back with
+    release() instead of being discarded.
+    """
+
+    def __init__(self, stack_type, maxsize):
+        self._stack_type = stack_type
+        self._maxsize = maxsize
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        """Returns a stack from the free list, or a new one if it is empty."""
+        try:
+            stack = self._free.pop()
+        except IndexError:
+            return self._stack_type()
+        stack._in_free_list = False
+        return stack
+
+    def release(self, stack):
+        """Returns a closed stack to the free list for reuse.
 
-    def _push_exit_callback(self, callback, is_sync=True):
-        self._exit_callbacks.append((is_sync, callback))
+        Raises RuntimeError if the stack still has exit callbacks registered
+        or has already been released.
+        """
+        if type(stack) is not self._stack_type:
+            raise TypeError(f"expected {self._stack_type.__qualname__!r} "
+                            f"instance, not {type(stack).__qualname__!r}")
+        if stack._in_free_list:
+            raise RuntimeError("stack has already been released")
+        stack.reset()
+        if len(self._free) < self._maxsize:
+            stack._in_free_list = True
+            self._free.append(stack)
 
 
 # Inspired by discussions on http://bugs.python.org/issue13585
@@ -623,6 +1209,31 @@ class ExitStack(_BaseExitStack, AbstractContextManager):
 
     def __exit__(self, *exc_details):
         received_exc = exc_details[0] is not None
+        callbacks = self._exit_callbacks
+        pop = callbacks.pop
+        failed_exc = None
+
+        if not received_exc:
+            # Fast path: with no exception in flight, there is nothing to
+            # pass to the callbacks, chain or suppress until a callback fails
+            try:
+                while callbacks:
+                    kwds = pop()
+                    arg = pop()
+                    target = pop()
+                    kind = pop()
+                    assert not kind & _EXIT_ASYNC
+                    if kind == _EXIT_CM:
+                        target(arg, None, None, None)
+                    elif kind == _EXIT_CALLBACK:
+                        target(*arg, **kwds)
+                    else:
+                        target(None, None, None)
+            except BaseException as exc:
+                # Unwind the remaining callbacks below
+                failed_exc = exc
+            else:
+                return False
 
         # We manipulate the exception state so it behaves as though
         # we were actually nesting multiple with statements
@@ -645,11 +1256,28 @@ class ExitStack(_BaseExitStack, AbstractContextManager):
         # nested context managers
         suppressed_exc = False
         pending_raise = False
-        while self._exit_callbacks:
-            is_sync, cb = self._exit_callbacks.pop()
-            assert is_sync
+        if failed_exc is not None:
+            _fix_exception_context(failed_exc, None)
+            pending_raise = True
+            exc_details = (type(failed_exc), failed_exc,
+                           failed_exc.__traceback__)
+            failed_exc = None
+        while callbacks:
+            kwds = pop()
+            arg = pop()
+            target = pop()
+            kind = pop()
+            assert not kind & _EXIT_ASYNC
             try:
-                if cb(*exc_details):
+                if kind == _EXIT_CM:
+                    cb_suppress = target(arg, *exc_details)
+                elif kind == _EXIT_CALLBACK:
+                    target(*arg, **kwds)
+                    cb_suppress = False
+                else:
+                    cb_suppress = target(*exc_details)
+
+                if cb_suppress:
                     suppressed_exc = True
                     pending_raise = False
                     exc_details = (None, None, None)
@@ -674,6 +1302,20 @@ class ExitStack(_BaseExitStack, AbstractContextManager):
         """Immediately unwind the context stack."""
         self.__exit__(None, None, None)
 
+    def unwind_to(self, mark, exc_type=None, exc_value=None, traceback=None):
+        """Unwind the callbacks registered since the given mark().
+
+        The callbacks are invoked exactly as they would be by __exit__ with
+        the given exception details, and the result indicates whether the
+        exception was suppressed.
+        """
+        partial_stack = ExitStack()
+        partial_stack._exit_callbacks = self._detach_to_mark(mark)
+        try:
+            return partial_stack.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._end_profiled_unwind()
+
 
 # Inspired by discussions on https://bugs.python.org/issue29302
 class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
@@ -689,15 +1331,8 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
             # connection later in the list raise an exception.
     """
 
-    @staticmethod
-    def _create_async_exit_wrapper(cm, cm_exit):
-        return MethodType(cm_exit, cm)
-
-    @staticmethod
-    def _create_async_cb_wrapper(callback, /, *args, **kwds):
-        async def _exit_wrapper(exc_type, exc, tb):
-            await callback(*args, **kwds)
-        return _exit_wrapper
+    # (per_exit, total, on_timeout), set by set_exit_timeouts()
+    _exit_timeouts = None
 
     async def enter_async_context(self, cm):
         """Enters the supplied async context manager.
@@ -714,7 +1349,159 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
                             f"not support the asynchronous context manager protocol"
                            ) from None
         result = await _enter(cm)
-        self._push_async_cm_exit(cm, _exit)
+        self._exit_callbacks.extend((_EXIT_ASYNC | _EXIT_CM, _exit, cm, None))
+        return result
+
+    async def enter_async_contexts(self, cms):
+        """Enters each of the supplied async context managers in turn.
+
+        Returns a list of the results of the __aenter__ methods. If entering
+        any context manager fails, the ones already entered by this call are
+        unwound and the exception is propagated.
+        """
+        callbacks = self._exit_callbacks
+        start = len(callbacks)
+        results = []
+        last_cls = None
+        try:
+            for cm in cms:
+                cls = type(cm)
+                if cls is not last_cls:
+                    try:
+                        _enter = cls.__aenter__
+                        _exit = cls.__aexit__
+                    except _CL2_ERROR_TO_CONVERT:
+                        raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' "
+                                        f"object does not support the asynchronous "
+                                        f"context manager protocol") from None
+                    last_cls = cls
+                results.append(await _enter(cm))
+                callbacks.extend((_EXIT_ASYNC | _EXIT_CM, _exit, cm, None))
+        except:
+            batch = AsyncExitStack()
+            batch._exit_callbacks = self._pop_exit_entries(start)
+            await batch.__aexit__(*sys.exc_info())
+            raise
+        return results
+
+    async def enter_async_contexts_concurrently(self, cms, *, limit=None):
+        """Enters the supplied async context managers concurrently.
+
+        At most *limit* context managers are entered at the same time (no
+        limit if None). Returns a list of the results of the __aenter__
+        methods, and registers the __aexit__ methods in the same order as the
+        context managers were supplied.
+
+        If entering any context manager fails (or this call is cancelled),
+        the context managers still being entered are cancelled, those already
+        entered by this call are unwound, and the exception is propagated.
+
+        Each __aenter__ method runs in its own task, while the __aexit__
+        methods run in the task unwinding the stack, so this isn't suitable
+        for context managers tied to the task that entered them (such as
+        asyncio.timeout()). Context variables set by the __aenter__ methods
+        aren't visible to the caller.
+        """
+        import asyncio # Only import if needed for concurrent entry
+        entries = []
+        for cm in cms:
+            cls = type(cm)
+            try:
+                _enter = cls.__aenter__
+                _exit = cls.__aexit__
+            except _CL2_ERROR_TO_CONVERT:
+                raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' object does "
+                                f"not support the asynchronous context manager protocol"
+                               ) from None
+            entries.append((cm, _enter, _exit))
+        if not entries:
+            return []
+        semaphore = None if limit is None else asyncio.Semaphore(limit)
+        tasks = []
+        error = None
+        try:
+            for cm, _enter, _exit in entries:
+                if semaphore is None:
+                    # __aenter__ may fail before returning an awaitable, in
+                    # which case the tasks already started are unwound below
+                    tasks.append(asyncio.ensure_future(_enter(cm)))
+                else:
+                    tasks.append(asyncio.ensure_future(
+                        _enter_limited(semaphore, _enter, cm)))
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        except BaseException as exc:
+            error = exc
+        cancelled_tasks = {task for task in tasks if not task.done()}
+        if cancelled_tasks:
+            for task in cancelled_tasks:
+                task.cancel()
+            await asyncio.wait(cancelled_tasks)
+
+        results = []
+        failures = []
+        entered = deque()
+        for (cm, _enter, _exit), task in zip(entries, tasks):
+            if task.cancelled():
+                if task not in cancelled_tasks:
+                    failures.append(asyncio.CancelledError())
+            elif task.exception() is not None:
+                failures.append(task.exception())
+            else:
+                results.append(task.result())
+                entered.extend((_EXIT_ASYNC | _EXIT_CM, _exit, cm, None))
+        if error is None and not failures:
+            self._exit_callbacks.extend(entered)
+            return results
+
+        if error is None:
+            if len(failures) == 1:
+                error = failures[0]
+            else:
+                error = BaseExceptionGroup(
+                    "exceptions raised while concurrently entering "
+                    "async context managers", failures)
+        batch = AsyncExitStack()
+        batch._exit_callbacks = entered
+        try:
+            raise error
+        except:
+            await batch.__aexit__(*sys.exc_info())
+            raise
+
+    async def enter_context_in_executor(self, cm, executor=None):
+        """Enters the supplied context manager in an executor.
+
+        Both the __enter__ method and the registered __exit__ method are run
+        via loop.run_in_executor() (using the default executor if *executor*
+        is None), so that blocking context managers don't block the event
+        loop. They both run in the same copy of the current context.
+        """
+        import asyncio # Only import if needed for executor offloading
+        cls = type(cm)
+        try:
+            _enter = cls.__enter__
+            _exit = cls.__exit__
+        except _CL2_ERROR_TO_CONVERT:
+            raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' object does "
+                            f"not support the context manager protocol") from None
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        future = loop.run_in_executor(executor, ctx.run, _enter, cm)
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The blocking __enter__ call can't be interrupted, so make sure
+            # the context manager is exited if it finishes entering anyway
+            def _exit_if_entered(future):
+                if not future.cancelled() and future.exception() is None:
+                    exit_future = loop.run_in_executor(
+                        executor, ctx.run, _exit, cm, None, None, None)
+                    # Nothing is left to report a failure to
+                    exit_future.add_done_callback(_discard_future_result)
+            future.add_done_callback(_exit_if_entered)
+            raise
+        self._exit_callbacks.extend((_EXIT_ASYNC | _EXIT_CM, _exit_in_executor,
+                                     (cm, _exit, executor, ctx), None))
         return result
 
     def push_async_exit(self, exit):
@@ -730,9 +1517,10 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
             exit_method = _cb_type.__aexit__
         except AttributeError:
             # Not an async context manager, so assume it's a coroutine function
-            self._push_exit_callback(exit, False)
+            self._exit_callbacks.extend((_EXIT_ASYNC | _EXIT_PUSHED, exit, None, None))
         else:
-            self._push_async_cm_exit(exit, exit_method)
+            self._exit_callbacks.extend(
+                (_EXIT_ASYNC | _EXIT_CM, exit_method, exit, None))
         return exit  # Allow use as a decorator
 
     def push_async_callback(self, callback, /, *args, **kwds):
@@ -740,29 +1528,137 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
 
         Cannot suppress exceptions.
         """
-        _exit_wrapper = self._create_async_cb_wrapper(callback, *args, **kwds)
+        self._exit_callbacks.extend(
+            (_EXIT_ASYNC | _EXIT_CALLBACK, callback, args, kwds))
+        return callback  # Allow use as a decorator
 
-        # We changed the signature, so using @wraps is not appropriate, but
-        # setting __wrapped__ may still help with introspection.
-        _exit_wrapper.__wrapped__ = callback
-        self._push_exit_callback(_exit_wrapper, False)
+    def push_async_callbacks(self, callback, /, *iterables):
+        """Registers a coroutine function once for each set of arguments.
+
+        Arguments are taken from the iterables in the same way as map(),
+        and the callbacks are invoked in the reverse order of the arguments.
+
+        Cannot suppress exceptions.
+        """
+        self._exit_callbacks.extend(self._iter_callback_entries(
+            _EXIT_ASYNC | _EXIT_CALLBACK, callback, iterables))
         return callback  # Allow use as a decorator
 
     async def aclose(self):
         """Immediately unwind the context stack."""
         await self.__aexit__(None, None, None)
 
-    def _push_async_cm_exit(self, cm, cm_exit):
-        """Helper to correctly register coroutine function to __aexit__
-        method."""
-        _exit_wrapper = self._create_async_exit_wrapper(cm, cm_exit)
-        self._push_exit_callback(_exit_wrapper, False)
+    def pop_all(self):
+        new_stack = super().pop_all()
+        if self._exit_timeouts is not None:
+            new_stack._exit_timeouts = self._exit_timeouts
+        return new_stack
+
+    def reset(self):
+        super().reset()
+        self._exit_timeouts = None
+
+    def set_exit_timeouts(self, per_exit=None, total=None, *, on_timeout=None):
+        """Bounds the time taken by async exit callbacks when unwinding.
+
+        Each async exit callback is limited to *per_exit* seconds, and all
+        of the callbacks in an unwind share a budget of *total* seconds
+        (no limit if None). A callback that runs out of time is cancelled,
+        and the unwind continues as though it raised ExitTimeoutError.
+        If given, on_timeout(callback, timeout) is called for each timeout.
+        """
+        if per_exit is None and total is None:
+            self._exit_timeouts = None
+        else:
+            self._exit_timeouts = (per_exit, total, on_timeout)
+
+    def _bound_exit_callbacks(self):
+        """Applies the exit timeouts to the registered callbacks."""
+        import asyncio # Only import if needed for exit timeouts
+        budget = _ExitBudget(asyncio.get_running_loop(), *self._exit_timeouts)
+        callbacks = self._exit_callbacks
+        entries = list(callbacks)
+        for i in range(0, len(entries), _EXIT_ENTRY_SIZE):
+            kind, target, arg = entries[i:i + 3]
+            if kind & _EXIT_ASYNC:
+                entries[i + 1] = _bounded_exit_callback(
+                    budget, kind, target,
+                    _exit_entry_callback(kind, target, arg))
+        callbacks.clear()
+        # Bypass the registration site tracking of profiled stacks
+        deque.extend(callbacks, entries)
+
+    async def aunwind_to(self, mark, exc_type=None, exc_value=None,
+                         traceback=None):
+        """Unwind the callbacks registered since the given mark().
+
+        The callbacks are invoked exactly as they would be by __aexit__ with
+        the given exception details, and the result indicates whether the
+        exception was suppressed.
+        """
+        partial_stack = AsyncExitStack()
+        partial_stack._exit_callbacks = self._detach_to_mark(mark)
+        partial_stack._exit_timeouts = self._exit_timeouts
+        try:
+            return await partial_stack.__aexit__(exc_type, exc_value, traceback)
+        finally:
+            self._end_profiled_unwind()
+
+    @contextmanager
+    def concurrent_group(self):
+        """Groups the exit callbacks registered within a with statement.
+
+        When the stack is unwound, the callbacks in the group are invoked
+        concurrently (using asyncio) rather than one after another, and any
+        exceptions they raise are reported together in a BaseExceptionGroup.
+        """
+        start = len(self._exit_callbacks)
+        try:
+            yield self
+        finally:
+            group = self._pop_exit_entries(start)
+            if group:
+                # The whole group is unwound via a single exit entry
+                self._exit_callbacks.extend(
+                    (_EXIT_ASYNC | _EXIT_CM, _exit_concurrently, group, None))
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, *exc_details):
+        if self._exit_timeouts is not None:
+            self._bound_exit_callbacks()
         received_exc = exc_details[0] is not None
+        callbacks = self._exit_callbacks
+        pop = callbacks.pop
+        failed_exc = None
+
+        if not received_exc:
+            # Fast path: with no exception in flight, there is nothing to
+            # pass to the callbacks, chain or suppress until a callback fails
+            try:
+                while callbacks:
+                    kwds = pop()
+                    arg = pop()
+                    target = pop()
+                    kind = pop()
+                    if kind == _EXIT_ASYNC | _EXIT_CM:
+                        await target(arg, None, None, None)
+                    elif kind == _EXIT_ASYNC | _EXIT_CALLBACK:
+                        await target(*arg, **kwds)
+                    elif kind == _EXIT_ASYNC | _EXIT_PUSHED:
+                        await target(None, None, None)
+                    elif kind == _EXIT_CM:
+                        target(arg, None, None, None)
+                    elif kind == _EXIT_CALLBACK:
+                        target(*arg, **kwds)
+                    else:
+                        target(None, None, None)
+            except BaseException as exc:
+                # Unwind the remaining callbacks below
+                failed_exc = exc
+            else:
+                return False
 
         # We manipulate the exception state so it behaves as though
         # we were actually nesting multiple with statements
@@ -785,13 +1681,32 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
         # nested context managers
         suppressed_exc = False
         pending_raise = False
-        while self._exit_callbacks:
-            is_sync, cb = self._exit_callbacks.pop()
+        if failed_exc is not None:
+            _fix_exception_context(failed_exc, None)
+            pending_raise = True
+            exc_details = (type(failed_exc), failed_exc,
+                           failed_exc.__traceback__)
+            failed_exc = None
+        while callbacks:
+            kwds = pop()
+            arg = pop()
+            target = pop()
+            kind = pop()
             try:
-                if is_sync:
-                    cb_suppress = cb(*exc_details)
+                if kind == _EXIT_CM:
+                    cb_suppress = target(arg, *exc_details)
+                elif kind == _EXIT_CALLBACK:
+                    target(*arg, **kwds)
+                    cb_suppress = False
+                elif kind == _EXIT_PUSHED:
+                    cb_suppress = target(*exc_details)
+                elif kind == _EXIT_ASYNC | _EXIT_CM:
+                    cb_suppress = await target(arg, *exc_details)
+                elif kind == _EXIT_ASYNC | _EXIT_CALLBACK:
+                    await target(*arg, **kwds)
+                    cb_suppress = False
                 else:
-                    cb_suppress = await cb(*exc_details)
+                    cb_suppress = await target(*exc_details)
 
                 if cb_suppress:
                     suppressed_exc = True
@@ -815,6 +1730,328 @@ class AsyncExitStack(_BaseExitStack, AbstractAsyncContextManager):
         return received_exc and suppressed_exc
 
 
+async def _enter_limited(semaphore, enter, cm):
+    """Enters an async context manager once the semaphore is acquired."""
+    async with semaphore:
+        return await enter(cm)
+
+
+async def _exit_in_executor(entry, *exc_details):
+    """Runs a context manager's __exit__ method in an executor.
+
+    The method runs in the context its __enter__ method ran in, so it sees
+    any context variables that __enter__ set.
+    """
+    import asyncio # Only import if needed for executor offloading
+    cm, cm_exit, executor, ctx = entry
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, ctx.run, cm_exit, cm,
+                                          *exc_details)
+    except BaseException as exc:
+        # The exception was raised in another thread, so chain it to the one
+        # being unwound as a synchronous __exit__ method would (Python 3.8
+        # doesn't do that when it is re-raised in this coroutine)
+        if exc.__context__ is None and exc is not exc_details[1]:
+            exc.__context__ = exc_details[1]
+        raise
+
+
+def _discard_future_result(future):
+    """Retrieves the result of a future that nothing else will await."""
+    if not future.cancelled():
+        future.exception()
+
+
+async def _exit_concurrently(callbacks, *exc_details):
+    """Invokes a group of exit callbacks concurrently.
+
+    All callbacks are passed the same exception details. The exception is
+    suppressed if any of the callbacks suppresses it and none of them fail.
+    """
+    import asyncio # Only import if needed for concurrent unwinding
+    # (kind, result, failed) for each callback, in LIFO order
+    outcomes = []
+    pop = callbacks.pop
+    while callbacks:
+        kwds = pop()
+        arg = pop()
+        target = pop()
+        kind = pop()
+        try:
+            if kind & ~_EXIT_ASYNC == _EXIT_CM:
+                result = target(arg, *exc_details)
+            elif kind & ~_EXIT_ASYNC == _EXIT_CALLBACK:
+                result = target(*arg, **kwds)
+            else:
+                result = target(*exc_details)
+            if kind & _EXIT_ASYNC:
+                result = asyncio.ensure_future(result)
+        except BaseException as exc:
+            outcomes.append((kind, exc, True))
+        else:
+            outcomes.append((kind, result, False))
+    futures = [result for kind, result, failed in outcomes
+               if kind & _EXIT_ASYNC and not failed]
+    if futures:
+        await asyncio.gather(*futures, return_exceptions=True)
+    failures = []
+    suppressed_exc = False
+    for kind, result, failed in outcomes:
+        if not failed and kind & _EXIT_ASYNC:
+            failed = result.exception() is not None
+            result = result.exception() if failed else result.result()
+        if failed:
+            failures.append(result)
+        elif result and kind & ~_EXIT_ASYNC != _EXIT_CALLBACK:
+            suppressed_exc = True
+    if failures:
+        raise BaseExceptionGroup(
+            "exceptions raised while concurrently unwinding exit callbacks",
+            failures)
+    return suppressed_exc
+
+
+class ExitTimeoutError(TimeoutError):
+    """An async exit callback exceeded the AsyncExitStack time budget.
+
+    The callback attribute is the callback (or context manager) that timed
+    out, and timed_out lists all of those that have timed out so far in the
+    same unwind.
+    """
+
+    def __init__(self, callback, timeout, timed_out):
+        super().__init__(f"exiting {callback!r} timed out after "
+                         f"{timeout:g} seconds")
+        self.callback = callback
+        self.timeout = timeout
+        self.timed_out = timed_out
+
+
+class _ExitBudget:
+    """The time budget for a single AsyncExitStack unwind."""
+
+    __slots__ = ("loop", "per_exit", "deadline", "on_timeout", "timed_out")
+
+    def __init__(self, loop, per_exit, total, on_timeout):
+        self.loop = loop
+        self.per_exit = per_exit
+        self.deadline = None if total is None else loop.time() + total
+        self.on_timeout = on_timeout
+        self.timed_out = []
+
+    def next_timeout(self):
+        timeout = self.per_exit
+        if self.deadline is not None:
+            remaining = max(self.deadline - self.loop.time(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+
+def _bounded_exit_callback(budget, kind, target, callback):
+    # Cancels the current task if the exit takes too long (rather than
+    # running the exit in a separate task, which would break context
+    # managers that need to be exited by the task that entered them)
+    base_kind = kind & ~_EXIT_ASYNC
+    if base_kind == _EXIT_CM:
+        exc_index = 2
+    elif base_kind == _EXIT_PUSHED:
+        exc_index = 1
+    else:
+        exc_index = None
+
+    async def bounded(*args, **kwds):
+        import asyncio # Only import if needed for exit timeouts
+        timeout = budget.next_timeout()
+        task = asyncio.current_task()
+        expired = False
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+        handle = budget.loop.call_later(timeout, expire)
+        try:
+            return await target(*args, **kwds)
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+        finally:
+            handle.cancel()
+            # Even if the target swallowed the cancellation and returned
+            if expired and hasattr(task, "uncancel"):
+                task.uncancel()
+        # Raised outside the except clause, so the CancelledError isn't
+        # chained in place of the exception being unwound (which is set
+        # explicitly, as Python 3.8 doesn't chain it here)
+        budget.timed_out.append(callback)
+        if budget.on_timeout is not None:
+            budget.on_timeout(callback, timeout)
+        exc = ExitTimeoutError(callback, timeout, budget.timed_out)
+        if exc_index is not None:
+            exc.__context__ = args[exc_index]
+        raise exc
+    bounded._cl2_callback = callback
+    return bounded
+
+
+def _exit_entry_callback(kind, target, arg):
+    """Returns the callback (or context manager) an exit entry invokes."""
+    # Set on the wrappers used for profiling, hooks and exit timeouts
+    callback = getattr(target, "_cl2_callback", None)
+    if callback is not None:
+        return callback
+    if target is _exit_in_executor:
+        return arg[0]
+    if kind & ~_EXIT_ASYNC == _EXIT_CM and target is not _exit_concurrently:
+        return arg
+    return target
+
+
+class _ExitTiming(namedtuple("ExitTiming", "duration code lineno callback")):
+    """The exit duration of a callback registered on a profiled stack."""
+
+    __slots__ = ()
+
+    @property
+    def site(self):
+        return _format_site(self.code, self.lineno)
+
+
+class _ExitSiteStats(namedtuple("ExitSiteStats", "code lineno calls total max")):
+    """The exit durations of the callbacks registered at a single site."""
+
+    __slots__ = ()
+
+    @property
+    def site(self):
+        return _format_site(self.code, self.lineno)
+
+
+def _format_site(code, lineno):
+    return f"{code.co_filename}:{lineno} in {code.co_name}"
+
+
+class ExitProfile:
+    """Exit callback timings aggregated across profiled exit stacks.
+
+    Stacks record into a profile once ExitStack.enable_profiling() (or
+    AsyncExitStack.enable_profiling()) has been called, with the timings
+    aggregated by the site (code object and line) that registered each
+    callback.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def _record(self, code, lineno, duration):
+        with self._lock:
+            stats = self._sites.get((code, lineno))
+            if stats is None:
+                self._sites[code, lineno] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+    def slowest(self, n=10):
+        """Return the n registration sites with the most total exit time."""
+        with self._lock:
+            sites = [_ExitSiteStats(code, lineno, *stats)
+                     for (code, lineno), stats in self._sites.items()]
+        sites.sort(key=lambda stats: stats.total, reverse=True)
+        return sites[:n]
+
+    def report(self, n=10):
+        """Return a text table of the n slowest registration sites."""
+        lines = [f"{'total':>10} {'max':>10} {'calls':>7}  registration site"]
+        for stats in self.slowest(n):
+            lines.append(f"{stats.total:9.6f}s {stats.max:9.6f}s "
+                         f"{stats.calls:7d}  {stats.site}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Discard all of the recorded timings."""
+        with self._lock:
+            self._sites.clear()
+
+
+class _ExitStackTimings:
+    """The exit timings for a single profiled stack."""
+
+    __slots__ = ("profile", "last_unwind", "unwinding")
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.last_unwind = []
+        self.unwinding = False
+
+    def record(self, code, lineno, callback, duration):
+        if not self.unwinding:
+            # First callback invoked since the last registration (or the
+            # end of a partial unwind)
+            self.unwinding = True
+            self.last_unwind = []
+        self.last_unwind.append(_ExitTiming(duration, code, lineno, callback))
+        self.profile._record(code, lineno, duration)
+
+
+class _ProfiledExitCallbacks(deque):
+    """Exit callback entries that are timed when invoked.
+
+    All registrations extend the entries, so this is where the registration
+    site is captured (as the first caller outside this module).
+    """
+
+    def __init__(self, timings):
+        super().__init__()
+        self.timings = timings
+
+    def new_empty(self):
+        return type(self)(_ExitStackTimings(self.timings.profile))
+
+    def extend(self, entries):
+        frame = sys._getframe(1)
+        while frame.f_globals is _module_globals and frame.f_back is not None:
+            frame = frame.f_back
+        code, lineno = frame.f_code, frame.f_lineno
+        timings = self.timings
+        timings.unwinding = False
+        entries = list(entries)
+        for i in range(0, len(entries), _EXIT_ENTRY_SIZE):
+            kind, target, arg = entries[i:i + 3]
+            entries[i + 1] = _profiled_exit_callback(
+                timings, kind, target, arg, code, lineno)
+        super().extend(entries)
+
+
+def _profiled_exit_callback(timings, kind, target, arg, code, lineno):
+    callback = _exit_entry_callback(kind, target, arg)
+    if kind & _EXIT_ASYNC:
+        async def profiled(*args, **kwds):
+            start = _perf_counter_ns()
+            try:
+                return await target(*args, **kwds)
+            finally:
+                timings.record(code, lineno, callback,
+                               (_perf_counter_ns() - start) / 1e9)
+    else:
+        def profiled(*args, **kwds):
+            start = _perf_counter_ns()
+            try:
+                return target(*args, **kwds)
+            finally:
+                timings.record(code, lineno, callback,
+                               (_perf_counter_ns() - start) / 1e9)
+    profiled._cl2_callback = callback
+    return profiled
+
+
+_module_globals = globals()
+
+
 class nullcontext(AbstractContextManager, AbstractAsyncContextManager):
     """Context manager that does no additional processing.
 
@@ -826,6 +2063,8 @@ class nullcontext(AbstractContextManager, AbstractAsyncContextManager):
         # Perform operation, using optional_cm if condition is True
     """
 
+    __slots__ = ("enter_result", "__weakref__")
+
     def __init__(self, enter_result=None):
         self.enter_result = enter_result
 
@@ -845,6 +2084,8 @@ class nullcontext(AbstractContextManager, AbstractAsyncContextManager):
 class chdir(AbstractContextManager):
     """Non thread-safe context manager to change the current working directory."""
 
+    __slots__ = ("path", "_old_cwd", "__weakref__")
+
     def __init__(self, path):
         self.path = path
         self._old_cwd = []
@@ -856,6 +2097,1638 @@ class chdir(AbstractContextManager):
     def __exit__(self, *excinfo):
         os.chdir(self._old_cwd.pop())
 
+
+class _PoolEntry:
+    """A pooled resource, along with the exit stack that releases it."""
+
+    __slots__ = ("resource", "stack", "idle_since")
+
+    def __init__(self, resource, stack):
+        self.resource = resource
+        self.stack = stack
+        self.idle_since = None
+
+
+class _BaseResourcePool:
+    """A base class for ResourcePool and AsyncResourcePool."""
+
+    def __init__(self, factory, /, maxsize=10, *, max_idle=None,
+                 idle_timeout=None, check=None, prefill=0):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self._clock = _monotonic
+        self._factory = factory
+        self._maxsize = maxsize
+        self._max_idle = maxsize if max_idle is None else max_idle
+        self._idle_timeout = idle_timeout
+        self._check = check
+        self._prefill_count = min(prefill, maxsize)
+        # Idle entries, least recently used first
+        self._idle = deque()
+        # Resources that exist or are being created
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._wait_time = 0.0
+        self._closed = False
+
+    @property
+    def maxsize(self):
+        """The maximum number of resources in the pool."""
+        return self._maxsize
+
+    @property
+    def in_use(self):
+        """The number of resources currently checked out."""
+        return self._in_use
+
+    @property
+    def idle(self):
+        """The number of resources available for immediate checkout."""
+        return len(self._idle)
+
+    @property
+    def waiting(self):
+        """The number of checkouts currently waiting for a resource."""
+        return self._waiting
+
+    @property
+    def wait_time(self):
+        """The total seconds checkouts have spent waiting for a resource."""
+        return self._wait_time
+
+    @property
+    def closed(self):
+        """Whether the pool has been closed."""
+        return self._closed
+
+    def _pop_expired(self):
+        # Called with the pool lock held
+        idle = self._idle
+        if self._idle_timeout is None or not idle:
+            return []
+        cutoff = self._clock() - self._idle_timeout
+        expired = []
+        while idle and idle[0].idle_since <= cutoff:
+            expired.append(idle.popleft())
+        self._size -= len(expired)
+        return expired
+
+    def _reserve(self):
+        # Called with the pool lock held. Returns an idle entry, None
+        # if a new resource should be created, or False to wait
+        if self._closed:
+            raise RuntimeError("cannot check out from a closed pool")
+        if self._idle:
+            entry = self._idle.pop()
+        elif self._size < self._maxsize:
+            entry = None
+            self._size += 1
+        else:
+            return False
+        self._in_use += 1
+        return entry
+
+    def _reserve_prefill(self):
+        # Called with the pool lock held
+        if (self._closed or self._size >= self._maxsize
+                or self._size >= self._prefill_count):
+            return False
+        self._size += 1
+        return True
+
+    def _return(self, entry, checked_out=True):
+        # Called with the pool lock held. Returns the entries to close
+        if checked_out:
+            self._in_use -= 1
+        discard = self._pop_expired()
+        if self._closed or not self._max_idle:
+            self._size -= 1
+            discard.append(entry)
+            return discard
+        entry.idle_since = self._clock()
+        self._idle.append(entry)
+        if len(self._idle) > self._max_idle:
+            # Evict the least recently used idle resource
+            self._size -= 1
+            discard.append(self._idle.popleft())
+        return discard
+
+    def _discard(self, checked_out=True):
+        # Called with the pool lock held, when a reserved slot is not
+        # filled (or its resource is closed rather than returned)
+        self._size -= 1
+        if checked_out:
+            self._in_use -= 1
+
+    def _close_pool(self):
+        # Called with the pool lock held. Returns the entries to close
+        self._closed = True
+        discard = list(self._idle)
+        self._idle.clear()
+        self._size -= len(discard)
+        return discard
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+        remaining = deadline - self._clock()
+        if remaining <= 0:
+            raise TimeoutError("timed out waiting for a pooled resource")
+        return remaining
+
+
+class ResourcePool(_BaseResourcePool, AbstractContextManager):
+    """Bounded, thread-safe pool of resources created by context managers.
+
+    Code like this:
+
+        pool = ResourcePool(connect, maxsize=10)
+        with pool.checkout() as conn:
+            <block>
+
+    enters connect() to create a new connection only when no idle one is
+    available, returning the connection to the pool at the end of the block
+    rather than exiting the context manager that created it.
+    """
+
+    def __init__(self, factory, /, maxsize=10, *, max_idle=None,
+                 idle_timeout=None, check=None, prefill=0):
+        super().__init__(factory, maxsize, max_idle=max_idle,
+                         idle_timeout=idle_timeout, check=check,
+                         prefill=prefill)
+        self._cond = threading.Condition()
+        self._prefill_thread = None
+
+    def _create(self):
+        with ExitStack() as stack:
+            resource = stack.enter_context(self._factory())
+            entry = _PoolEntry(resource, stack.pop_all())
+        return entry
+
+    def _close_entries(self, entries):
+        with ExitStack() as stack:
+            for entry in entries:
+                stack.push(entry.stack)
+
+    def _acquire(self, timeout):
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            with self._cond:
+                expired = self._pop_expired()
+                entry = False if expired else self._reserve()
+                if entry is False and not expired:
+                    self._waiting += 1
+                    wait_start = self._clock()
+                    try:
+                        while entry is False:
+                            self._cond.wait(self._remaining(deadline))
+                            entry = self._reserve()
+                    finally:
+                        self._waiting -= 1
+                        self._wait_time += self._clock() - wait_start
+                if expired:
+                    self._cond.notify(len(expired))
+            if expired:
+                self._close_entries(expired)
+                continue
+            try:
+                if entry is None:
+                    return self._create()
+                if self._check is None or self._check(entry.resource):
+                    return entry
+            except BaseException:
+                with self._cond:
+                    self._discard()
+                    self._cond.notify()
+                if entry is not None:
+                    entry.stack.close()
+                raise
+            # Failed the health check, so close it and try again
+            with self._cond:
+                self._discard()
+                self._cond.notify()
+            entry.stack.close()
+
+    def _release(self, entry):
+        with self._cond:
+            discard = self._return(entry)
+            self._cond.notify()
+        self._close_entries(discard)
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Check out a resource for the duration of a with statement.
+
+        Waits for up to *timeout* seconds (forever if None) for a resource
+        to become available if the pool is at capacity, raising
+        TimeoutError if none does.
+        """
+        entry = self._acquire(timeout)
+        try:
+            yield entry.resource
+        finally:
+            self._release(entry)
+
+    def _prefill(self):
+        while True:
+            with self._cond:
+                if not self._reserve_prefill():
+                    return
+            try:
+                entry = self._create()
+            except BaseException:
+                with self._cond:
+                    self._discard(checked_out=False)
+                    self._cond.notify()
+                raise
+            with self._cond:
+                discard = self._return(entry, checked_out=False)
+                self._cond.notify()
+            self._close_entries(discard)
+
+    def prefill(self):
+        """Create resources in a background thread until the pool holds
+        the number given by the *prefill* argument.
+
+        Called automatically when the pool is used in a with statement.
+        """
+        if self._prefill_thread is None or not self._prefill_thread.is_alive():
+            self._prefill_thread = threading.Thread(
+                target=self._prefill, name="ResourcePool prefill", daemon=True)
+            self._prefill_thread.start()
+        return self._prefill_thread
+
+    def close(self):
+        """Close the idle resources, and any checked out ones when returned."""
+        with self._cond:
+            discard = self._close_pool()
+            self._cond.notify_all()
+        self._close_entries(discard)
+
+    def __enter__(self):
+        if self._prefill_count:
+            self.prefill()
+        return self
+
+    def __exit__(self, *exc_details):
+        self.close()
+
+
+class AsyncResourcePool(_BaseResourcePool, AbstractAsyncContextManager):
+    """Bounded pool of resources created by async context managers.
+
+    Code like this:
+
+        pool = AsyncResourcePool(connect, maxsize=10)
+        async with pool.checkout() as conn:
+            <block>
+
+    enters connect() to create a new connection only when no idle one is
+    available, returning the connection to the pool at the end of the block
+    rather than exiting the async context manager that created it.
+    """
+
+    def __init__(self, factory, /, maxsize=10, *, max_idle=None,
+                 idle_timeout=None, check=None, prefill=0):
+        super().__init__(factory, maxsize, max_idle=max_idle,
+                         idle_timeout=idle_timeout, check=check,
+                         prefill=prefill)
+        # Created on first use, as on Python 3.9 and earlier asyncio
+        # primitives are bound to the event loop running at creation time
+        self._cond = None
+        self._prefill_task = None
+
+    def _get_cond(self):
+        if self._cond is None:
+            import asyncio # Only import if needed for a resource pool
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def _create(self):
+        async with AsyncExitStack() as stack:
+            resource = await stack.enter_async_context(self._factory())
+            entry = _PoolEntry(resource, stack.pop_all())
+        return entry
+
+    async def _close_entries(self, entries):
+        async with AsyncExitStack() as stack:
+            for entry in entries:
+                stack.push_async_exit(entry.stack)
+
+    async def _acquire(self, timeout):
+        import asyncio # Only import if needed for a resource pool
+        cond = self._get_cond()
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            async with cond:
+                expired = self._pop_expired()
+                entry = False if expired else self._reserve()
+                if entry is False and not expired:
+                    self._waiting += 1
+                    wait_start = self._clock()
+                    try:
+                        while entry is False:
+                            try:
+                                await asyncio.wait_for(
+                                    cond.wait(), self._remaining(deadline))
+                            except asyncio.TimeoutError:
+                                raise TimeoutError(
+                                    "timed out waiting for a pooled resource"
+                                ) from None
+                            entry = self._reserve()
+                    finally:
+                        self._waiting -= 1
+                        self._wait_time += self._clock() - wait_start
+                if expired:
+                    cond.notify(len(expired))
+            if expired:
+                await self._close_entries(expired)
+                continue
+            try:
+                if entry is None:
+                    return await self._create()
+                if self._check is None or await self._check(entry.resource):
+                    return entry
+            except BaseException:
+                async with cond:
+                    self._discard()
+                    cond.notify()
+                if entry is not None:
+                    await entry.stack.aclose()
+                raise
+            # Failed the health check, so close it and try again
+            async with cond:
+                self._discard()
+                cond.notify()
+            await entry.stack.aclose()
+
+    async def _release(self, entry):
+        cond = self._get_cond()
+        async with cond:
+            discard = self._return(entry)
+            cond.notify()
+        await self._close_entries(discard)
+
+    @asynccontextmanager
+    async def checkout(self, timeout=None):
+        """Check out a resource for the duration of an async with statement.
+
+        Waits for up to *timeout* seconds (forever if None) for a resource
+        to become available if the pool is at capacity, raising
+        TimeoutError if none does.
+        """
+        entry = await self._acquire(timeout)
+        try:
+            yield entry.resource
+        finally:
+            await self._release(entry)
+
+    async def _prefill(self):
+        cond = self._get_cond()
+        while True:
+            async with cond:
+                if not self._reserve_prefill():
+                    return
+            try:
+                entry = await self._create()
+            except BaseException:
+                async with cond:
+                    self._discard(checked_out=False)
+                    cond.notify()
+                raise
+            async with cond:
+                discard = self._return(entry, checked_out=False)
+                cond.notify()
+            await self._close_entries(discard)
+
+    def prefill(self):
+        """Create resources in a background task until the pool holds
+        the number given by the *prefill* argument.
+
+        Called automatically when the pool is used in an async with
+        statement.
+        """
+        import asyncio # Only import if needed for prefilling a pool
+        if self._prefill_task is None or self._prefill_task.done():
+            self._prefill_task = asyncio.ensure_future(self._prefill())
+        return self._prefill_task
+
+    async def aclose(self):
+        """Close the idle resources, and any checked out ones when returned.
+
+        Also cancels any running background prefill.
+        """
+        if self._prefill_task is not None:
+            self._prefill_task.cancel()
+        cond = self._get_cond()
+        async with cond:
+            discard = self._close_pool()
+            cond.notify_all()
+        await self._close_entries(discard)
+
+    async def __aenter__(self):
+        if self._prefill_count:
+            self.prefill()
+        return self
+
+    async def __aexit__(self, *exc_details):
+        await self.aclose()
+
+
+class shared(AbstractContextManager, AbstractAsyncContextManager):
+    """Context manager sharing one entered context between concurrent users.
+
+    Code like this:
+
+        index = shared(open_index)
+
+        with index as idx:
+            <block>
+
+    enters the context manager returned by open_index() for the first user
+    only, and gives any other users that arrive before it is exited the same
+    result. The context manager is exited when the last user leaves (or
+    after *linger* seconds, if no new user has arrived by then). With
+    ``async with``, the factory must return an async context manager.
+    """
+
+    def __init__(self, factory, /, *, linger=None):
+        self._factory = factory
+        self._linger = linger
+        self._lock = threading.Lock()
+        # Created on first use, as on Python 3.9 and earlier asyncio
+        # primitives are bound to the event loop running at creation time
+        self._async_lock = None
+        self._users = 0
+        # Incremented on every entry, so pending lingering teardowns can
+        # tell whether the context has been reused since they were scheduled
+        self._generation = 0
+        self._stack = None
+        self._result = None
+        self._teardown = None
+
+    def _enter(self):
+        # Called with the lock held
+        if self._teardown is not None:
+            self._teardown.cancel()
+            self._teardown = None
+        self._generation += 1
+        self._users += 1
+        return self._result
+
+    def _leave(self):
+        # Called with the lock held. Returns the stack to close (if any)
+        self._users -= 1
+        if self._users or self._linger is not None:
+            return None
+        return self._detach()
+
+    def _detach(self):
+        stack, self._stack, self._result = self._stack, None, None
+        return stack
+
+    def __enter__(self):
+        with self._lock:
+            if self._stack is None:
+                with ExitStack() as stack:
+                    self._result = stack.enter_context(self._factory())
+                    self._stack = stack.pop_all()
+            return self._enter()
+
+    def __exit__(self, *exc_details):
+        with self._lock:
+            stack = self._leave()
+            if stack is not None:
+                stack.close()
+            elif not self._users and self._stack is not None:
+                self._teardown = threading.Timer(
+                    self._linger, self._linger_expired, (self._generation,))
+                self._teardown.daemon = True
+                self._teardown.start()
+
+    def _linger_expired(self, generation):
+        with self._lock:
+            if generation != self._generation or self._users:
+                return
+            self._teardown = None
+            stack = self._detach()
+            if stack is not None:
+                stack.close()
+
+    def close(self):
+        """Exit the shared context now, rather than after it lingers."""
+        with self._lock:
+            if self._users:
+                raise RuntimeError("cannot close a shared context in use")
+            if self._teardown is not None:
+                self._teardown.cancel()
+                self._teardown = None
+            stack = self._detach()
+            if stack is not None:
+                stack.close()
+
+    def _get_async_lock(self):
+        if self._async_lock is None:
+            import asyncio # Only import if needed for a shared async context
+            self._async_lock = asyncio.Lock()
+        return self._async_lock
+
+    async def __aenter__(self):
+        async with self._get_async_lock():
+            if self._stack is None:
+                async with AsyncExitStack() as stack:
+                    self._result = await stack.enter_async_context(
+                        self._factory())
+                    self._stack = stack.pop_all()
+            return self._enter()
+
+    async def __aexit__(self, *exc_details):
+        async with self._get_async_lock():
+            stack = self._leave()
+            if stack is not None:
+                await stack.aclose()
+            elif not self._users and self._stack is not None:
+                import asyncio # Only import if needed for a lingering context
+                self._teardown = asyncio.ensure_future(
+                    self._linger_expired_async(self._generation))
+
+    async def _linger_expired_async(self, generation):
+        import asyncio # Only import if needed for a lingering context
+        await asyncio.sleep(self._linger)
+        async with self._get_async_lock():
+            if generation != self._generation or self._users:
+                return
+            self._teardown = None
+            stack = self._detach()
+            if stack is not None:
+                await stack.aclose()
+
+    async def aclose(self):
+        """Exit the shared async context now, rather than after it lingers."""
+        async with self._get_async_lock():
+            if self._users:
+                raise RuntimeError("cannot close a shared context in use")
+            if self._teardown is not None:
+                self._teardown.cancel()
+                self._teardown = None
+            stack = self._detach()
+            if stack is not None:
+                await stack.aclose()
+
+
+class lazy(AbstractContextManager, AbstractAsyncContextManager):
+    """Context manager that only enters another one when its result is used.
+
+    Code like this:
+
+        with lazy(get_connection, host) as conn:
+            if needed:
+                conn.get().execute(...)
+
+    only calls get_connection(host) and enters the resulting context manager
+    when conn.get() is first called (or, for async context managers, when
+    conn.aget() is first awaited), and only exits it if it was entered.
+    """
+
+    __slots__ = ("_factory", "_args", "_kwds", "_cm", "_exit", "_is_async",
+                 "_result", "__weakref__")
+
+    def __init__(self, factory, /, *args, **kwds):
+        self._factory = factory
+        self._args = args
+        self._kwds = kwds
+        self._cm = self._exit = self._result = None
+        self._is_async = False
+
+    @property
+    def entered(self):
+        """Whether the wrapped context manager has been entered."""
+        return self._exit is not None
+
+    def get(self):
+        """Return the result of entering the wrapped context manager,
+        entering it first if that hasn't happened yet.
+        """
+        if self._exit is None:
+            cm = self._factory(*self._args, **self._kwds)
+            cls = type(cm)
+            try:
+                _enter = cls.__enter__
+                _exit = cls.__exit__
+            except _CL2_ERROR_TO_CONVERT:
+                raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' object does "
+                                f"not support the context manager protocol") from None
+            self._result = _enter(cm)
+            self._cm, self._exit = cm, _exit
+        return self._result
+
+    async def aget(self):
+        """Return the result of entering the wrapped async context manager,
+        entering it first if that hasn't happened yet.
+        """
+        if self._exit is None:
+            cm = self._factory(*self._args, **self._kwds)
+            cls = type(cm)
+            try:
+                _enter = cls.__aenter__
+                _exit = cls.__aexit__
+            except _CL2_ERROR_TO_CONVERT:
+                raise TypeError(f"'{cls.__module__}.{cls.__qualname__}' object does "
+                                f"not support the asynchronous context manager protocol"
+                               ) from None
+            self._result = await _enter(cm)
+            self._cm, self._exit, self._is_async = cm, _exit, True
+        return self._result
+
+    def _detach(self):
+        # Allow the lazy context to be reused, and don't keep the wrapped
+        # context manager and its result alive unnecessarily
+        cm, _exit, is_async = self._cm, self._exit, self._is_async
+        self._cm = self._exit = self._result = None
+        self._is_async = False
+        return cm, _exit, is_async
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_details):
+        if self._exit is None:
+            return None
+        if self._is_async:
+            raise RuntimeError("an async context manager entered via aget() "
+                               "must be exited with async with")
+        cm, _exit, is_async = self._detach()
+        return _exit(cm, *exc_details)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_details):
+        if self._exit is None:
+            return None
+        cm, _exit, is_async = self._detach()
+        if is_async:
+            return await _exit(cm, *exc_details)
+        return _exit(cm, *exc_details)
+
+
+_CacheInfo = namedtuple("CacheInfo",
+                        ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+# Separates positional and keyword arguments in cache keys
+_KWD_MARK = object()
+
+
+class _CacheEntry:
+    """A cached context manager result, and the exit stack that exits it."""
+
+    __slots__ = ("result", "stack", "expires", "users", "evicted")
+
+    def __init__(self, result, stack, expires):
+        self.result = result
+        self.stack = stack
+        self.expires = expires
+        self.users = 1
+        self.evicted = False
+
+
+class _ContextCache:
+    """The cache used by a @cached_contextmanager function."""
+
+    def __init__(self, factory, maxsize, ttl):
+        self._factory = factory
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = _monotonic
+        # Least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._new_event = threading.Event
+        # Keys whose context managers are being entered, mapped to the
+        # events set once they have been (separately for sync and async)
+        self._pending = {}
+        self._apending = {}
+        self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        """Report cache statistics."""
+        return _CacheInfo(self._hits, self._misses, self._evictions,
+                          self._maxsize, len(self._entries))
+
+    # The helpers below are called with the lock held, and return the
+    # evicted entries that need to be closed once it has been released (as
+    # closing them may use the cache again)
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and (entry.expires is None
+                                  or entry.expires > self._clock()):
+            self._hits += 1
+            self._entries.move_to_end(key)
+            entry.users += 1
+            return entry, []
+        return None, self._evict_expired()
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        entry.evicted = True
+        self._evictions += 1
+        return [entry] if not entry.users else []
+
+    def _evict_expired(self):
+        if self._ttl is None:
+            return []
+        now = self._clock()
+        discard = []
+        for key in [key for key, entry in self._entries.items()
+                    if entry.expires <= now]:
+            discard += self._evict(key)
+        return discard
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        discard = []
+        if self._maxsize is not None:
+            while len(self._entries) > self._maxsize:
+                discard += self._evict(next(iter(self._entries)))
+        return discard
+
+    def _release(self, entry):
+        entry.users -= 1
+        return [entry] if entry.evicted and not entry.users else []
+
+    def _evict_all(self):
+        discard = []
+        for key in list(self._entries):
+            discard += self._evict(key)
+        return discard
+
+    def _expires(self):
+        return None if self._ttl is None else self._clock() + self._ttl
+
+    def _check_sync(self, entries):
+        for entry in entries:
+            if isinstance(entry.stack, AsyncExitStack):
+                raise RuntimeError("cached async context managers must "
+                                   "be closed with cache_aclear()")
+
+    def _close_entries(self, entries):
+        self._check_sync(entries)
+        with ExitStack() as stack:
+            # Close the entries in the order they were evicted
+            for entry in reversed(entries):
+                stack.push(entry.stack)
+
+    def enter(self, key, args, kwds):
+        while True:
+            with self._lock:
+                entry, discard = self._lookup(key)
+                if entry is not None:
+                    return entry
+                pending = self._pending.get(key)
+                if pending is None:
+                    # Enter the context manager without holding the lock,
+                    # so other keys (including from the factory) can be used
+                    pending = self._pending[key] = self._new_event()
+                    self._misses += 1
+                    break
+            self._close_entries(discard)
+            pending.wait()
+        try:
+            self._close_entries(discard)
+            with ExitStack() as stack:
+                result = stack.enter_context(self._factory(*args, **kwds))
+                entry = _CacheEntry(result, stack.pop_all(), self._expires())
+        except BaseException:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+            raise
+        with self._lock:
+            del self._pending[key]
+            pending.set()
+            discard = self._store(key, entry)
+        try:
+            self._close_entries(discard)
+        except BaseException:
+            self.exit(entry)
+            raise
+        return entry
+
+    def exit(self, entry):
+        with self._lock:
+            discard = self._release(entry)
+        self._close_entries(discard)
+
+    def clear(self):
+        """Exit all of the cached context managers."""
+        with self._lock:
+            self._check_sync(self._entries.values())
+            discard = self._evict_all()
+        self._close_entries(discard)
+
+    async def _aclose_entries(self, entries):
+        async with AsyncExitStack() as stack:
+            # Close the entries in the order they were evicted
+            for entry in reversed(entries):
+                if isinstance(entry.stack, AsyncExitStack):
+                    stack.push_async_exit(entry.stack)
+                else:
+                    stack.push(entry.stack)
+
+    # The async methods use the same (thread) lock, which is never held
+    # across an await
+    async def aenter(self, key, args, kwds):
+        import asyncio # Only import if needed for an async context cache
+        while True:
+            with self._lock:
+                entry, discard = self._lookup(key)
+                if entry is not None:
+                    return entry
+                pending = self._apending.get(key)
+                if pending is None:
+                    # Enter the context manager without holding the lock,
+                    # so other keys (including from the factory) can be used
+                    pending = self._apending[key] = asyncio.Event()
+                    self._misses += 1
+                    break
+            await self._aclose_entries(discard)
+            await pending.wait()
+        try:
+            await self._aclose_entries(discard)
+            async with AsyncExitStack() as stack:
+                result = await stack.enter_async_context(
+                    self._factory(*args, **kwds))
+                entry = _CacheEntry(result, stack.pop_all(), self._expires())
+        except BaseException:
+            with self._lock:
+                del self._apending[key]
+            pending.set()
+            raise
+        with self._lock:
+            del self._apending[key]
+            pending.set()
+            discard = self._store(key, entry)
+        try:
+            await self._aclose_entries(discard)
+        except BaseException:
+            await self.aexit(entry)
+            raise
+        return entry
+
+    async def aexit(self, entry):
+        with self._lock:
+            discard = self._release(entry)
+        await self._aclose_entries(discard)
+
+    async def aclear(self):
+        """Exit all of the cached (sync or async) context managers."""
+        with self._lock:
+            discard = self._evict_all()
+        await self._aclose_entries(discard)
+
+
+class _CachedContext(AbstractContextManager, AbstractAsyncContextManager):
+    """Helper for @cached_contextmanager decorator."""
+
+    __slots__ = ("_cache", "_key", "_args", "_kwds", "_entry")
+
+    def __init__(self, cache, key, args, kwds):
+        self._cache = cache
+        self._key = key
+        self._args = args
+        self._kwds = kwds
+        self._entry = None
+
+    def __enter__(self):
+        self._entry = self._cache.enter(self._key, self._args, self._kwds)
+        return self._entry.result
+
+    def __exit__(self, *exc_details):
+        entry, self._entry = self._entry, None
+        self._cache.exit(entry)
+
+    async def __aenter__(self):
+        self._entry = await self._cache.aenter(self._key, self._args,
+                                               self._kwds)
+        return self._entry.result
+
+    async def __aexit__(self, *exc_details):
+        entry, self._entry = self._entry, None
+        await self._cache.aexit(entry)
+
+
+def cached_contextmanager(func=None, /, *, maxsize=128, ttl=None):
+    """@cached_contextmanager decorator.
+
+    Typical usage:
+
+        @cached_contextmanager(maxsize=32, ttl=300)
+        def open_index(path):
+            <setup>
+            try:
+                yield <value>
+            finally:
+                <cleanup>
+
+    This makes this:
+
+        with open_index(path) as index:
+            <body>
+
+    only run <setup> the first time open_index is called with a given
+    path, reusing <value> in later with statements, and only runs
+    <cleanup> when the value expires (after *ttl* seconds), is evicted
+    because more than *maxsize* values are cached, or when
+    open_index.cache_clear() is called.
+    """
+    if func is None:
+        return partial(cached_contextmanager, maxsize=maxsize, ttl=ttl)
+    flags = _code_flags(func)
+    if flags & _CO_GENERATOR:
+        factory = contextmanager(func)
+    elif flags & _CO_ASYNC_GENERATOR:
+        factory = asynccontextmanager(func)
+    else:
+        # Already a context manager factory (such as a class)
+        factory = func
+    cache = _ContextCache(factory, maxsize, ttl)
+
+    @wraps(func)
+    def helper(*args, **kwds):
+        key = args
+        if kwds:
+            key += (_KWD_MARK,) + tuple(kwds.items())
+        return _CachedContext(cache, key, args, kwds)
+    helper.cache_info = cache.info
+    helper.cache_clear = cache.clear
+    helper.cache_aclear = cache.aclear
+    return helper
+
+
+# Hooks installed with add_context_hook(). While there are none, the
+# instrumented methods below are not installed at all, so the enter and
+# exit paths are exactly the same as if hooks weren't supported.
+_context_hooks = ()
+# (class, method name) -> uninstrumented method, while hooks are installed
+_uninstrumented = {}
+_hook_clock = _perf_counter
+
+
+def add_context_hook(hook):
+    """Call hook(event, cm, duration, exc_type) for each enter and exit.
+
+    *event* is "enter" or "exit", *cm* is the context manager (or the
+    callback, for ExitStack callbacks), *duration* is the number of seconds
+    the enter or exit method took, and *exc_type* is the type of the
+    exception raised by the enter method, or passed to the exit method
+    (or None).
+
+    Returns *hook*, so this can be used as a decorator.
+    """
+    global _context_hooks
+    if not _context_hooks:
+        _instrument()
+    _context_hooks += (hook,)
+    return hook
+
+
+def remove_context_hook(hook):
+    """Remove a hook installed with add_context_hook()."""
+    global _context_hooks
+    hooks = list(_context_hooks)
+    hooks.remove(hook)
+    _context_hooks = tuple(hooks)
+    if not hooks:
+        _uninstrument()
+
+
+def _call_hooks(event, cm, start, exc_type):
+    duration = _hook_clock() - start
+    for hook in _context_hooks:
+        hook(event, cm, duration, exc_type)
+
+
+# Each enter method is instrumented along with the matching exit method
+# (passed as *exit*), and the calls are only reported while the instance's
+# class resolves that exit method, so subclasses that override just one of
+# them don't report unmatched enters or exits
+
+def _instrumented_enter(enter, exit):
+    @wraps(enter)
+    def __enter__(self):
+        if type(self).__exit__ is not exit:
+            return enter(self)
+        start = _hook_clock()
+        try:
+            result = enter(self)
+        except BaseException as exc:
+            _call_hooks("enter", self, start, type(exc))
+            raise
+        _call_hooks("enter", self, start, None)
+        return result
+    return __enter__
+
+
+def _instrumented_exit(exit):
+    @wraps(exit)
+    def __exit__(self, exc_type, exc_value, traceback):
+        if type(self).__exit__ is not __exit__:
+            return exit(self, exc_type, exc_value, traceback)
+        start = _hook_clock()
+        try:
+            return exit(self, exc_type, exc_value, traceback)
+        finally:
+            _call_hooks("exit", self, start, exc_type)
+    __exit__._cl2_instrumented = True
+    return __exit__
+
+
+def _instrumented_aenter(aenter, aexit):
+    @wraps(aenter)
+    async def __aenter__(self):
+        if type(self).__aexit__ is not aexit:
+            return await aenter(self)
+        start = _hook_clock()
+        try:
+            result = await aenter(self)
+        except BaseException as exc:
+            _call_hooks("enter", self, start, type(exc))
+            raise
+        _call_hooks("enter", self, start, None)
+        return result
+    return __aenter__
+
+
+def _instrumented_aexit(aexit):
+    @wraps(aexit)
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if type(self).__aexit__ is not __aexit__:
+            return await aexit(self, exc_type, exc_value, traceback)
+        start = _hook_clock()
+        try:
+            return await aexit(self, exc_type, exc_value, traceback)
+        finally:
+            _call_hooks("exit", self, start, exc_type)
+    __aexit__._cl2_instrumented = True
+    return __aexit__
+
+
+def _timed_exit_callback(kind, target, arg):
+    # Reports the callback (or the context manager, for enter_context()) as
+    # the exiting object, along with the exception details it is passed
+    # (plain callbacks aren't passed the exception details)
+    cm = _exit_entry_callback(kind, target, arg)
+    base_kind = kind & ~_EXIT_ASYNC
+    if base_kind == _EXIT_CM:
+        exc_index = 1
+    elif base_kind == _EXIT_PUSHED:
+        exc_index = 0
+    else:
+        exc_index = None
+
+    if kind & _EXIT_ASYNC:
+        async def timed(*args, **kwds):
+            start = _hook_clock()
+            try:
+                return await target(*args, **kwds)
+            finally:
+                _call_hooks("exit", cm, start,
+                            None if exc_index is None else args[exc_index])
+    else:
+        def timed(*args, **kwds):
+            start = _hook_clock()
+            try:
+                return target(*args, **kwds)
+            finally:
+                _call_hooks("exit", cm, start,
+                            None if exc_index is None else args[exc_index])
+    timed._cl2_instrumented = True
+    timed._cl2_callback = cm
+    return timed
+
+
+def _instrument_exit_callbacks(callbacks):
+    entries = list(callbacks)
+    for i in range(0, len(entries), _EXIT_ENTRY_SIZE):
+        kind, target, arg = entries[i:i + 3]
+        if _exit_entry_callback(kind, target, arg) is _exit_concurrently:
+            # Report the callbacks in the group rather than the group itself
+            _instrument_exit_callbacks(arg)
+        elif not getattr(target, "_cl2_instrumented", False):
+            entries[i + 1] = _timed_exit_callback(kind, target, arg)
+    callbacks.clear()
+    # Bypass the registration site tracking of profiled stacks
+    deque.extend(callbacks, entries)
+
+
+# Exit stack scopes are only reported to the active SpanTracer (rather
+# than to the hooks), as their exits cover those of their callbacks
+
+def _instrumented_stack_enter(enter, exit):
+    @wraps(enter)
+    def __enter__(self):
+        result = enter(self)
+        tracer = _active_tracer
+        if tracer is not None and type(self).__exit__ is exit:
+            tracer._hook("enter", self, 0.0, None)
+        return result
+    return __enter__
+
+
+def _instrumented_stack_aenter(aenter, aexit):
+    @wraps(aenter)
+    async def __aenter__(self):
+        result = await aenter(self)
+        tracer = _active_tracer
+        if tracer is not None and type(self).__aexit__ is aexit:
+            tracer._hook("enter", self, 0.0, None)
+        return result
+    return __aenter__
+
+
+def _instrumented_stack_exit(exit):
+    @wraps(exit)
+    def __exit__(self, *exc_details):
+        _instrument_exit_callbacks(self._exit_callbacks)
+        tracer = _active_tracer
+        if tracer is None or type(self).__exit__ is not __exit__:
+            return exit(self, *exc_details)
+        start = _hook_clock()
+        try:
+            return exit(self, *exc_details)
+        finally:
+            tracer._hook("exit", self, _hook_clock() - start, exc_details[0])
+    return __exit__
+
+
+def _instrumented_stack_aexit(aexit):
+    @wraps(aexit)
+    async def __aexit__(self, *exc_details):
+        _instrument_exit_callbacks(self._exit_callbacks)
+        tracer = _active_tracer
+        if tracer is None or type(self).__aexit__ is not __aexit__:
+            return await aexit(self, *exc_details)
+        start = _hook_clock()
+        try:
+            return await aexit(self, *exc_details)
+        finally:
+            tracer._hook("exit", self, _hook_clock() - start, exc_details[0])
+    return __aexit__
+
+
+def _instrumented_methods():
+    # (class, enter name, exit name, enter wrapper, exit wrapper)
+    sync_cms = (_GeneratorContextManager, closing, nullcontext, suppress,
+                counting_suppress, _RedirectStream, chdir, shared, lazy)
+    async_cms = (_AsyncGeneratorContextManager, aclosing, nullcontext,
+                 counting_suppress, shared, lazy)
+    for cls in sync_cms:
+        yield (cls, "__enter__", "__exit__",
+               _instrumented_enter, _instrumented_exit)
+    for cls in async_cms:
+        yield (cls, "__aenter__", "__aexit__",
+               _instrumented_aenter, _instrumented_aexit)
+    yield (ExitStack, "__enter__", "__exit__",
+           _instrumented_stack_enter, _instrumented_stack_exit)
+    yield (AsyncExitStack, "__aenter__", "__aexit__",
+           _instrumented_stack_aenter, _instrumented_stack_aexit)
+
+
+def _uninstrumented_method(cls, name):
+    # Resolves the method as it was before any instrumentation
+    for base in cls.__mro__:
+        if (base, name) in _uninstrumented:
+            return _uninstrumented[base, name]
+        if name in base.__dict__:
+            return base.__dict__[name]
+    raise AttributeError(name)
+
+
+def _instrument():
+    for (cls, enter_name, exit_name,
+            instrumented_enter, instrumented_exit) in _instrumented_methods():
+        exit = instrumented_exit(_uninstrumented_method(cls, exit_name))
+        enter = instrumented_enter(_uninstrumented_method(cls, enter_name),
+                                   exit)
+        for name, method in ((enter_name, enter), (exit_name, exit)):
+            # None if the method is inherited rather than defined by cls
+            _uninstrumented[cls, name] = cls.__dict__.get(name)
+            setattr(cls, name, method)
+
+
+def _uninstrument():
+    while _uninstrumented:
+        (cls, name), method = _uninstrumented.popitem()
+        if method is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, method)
+
+
+# The SpanTracer that is currently recording (if any)
+_active_tracer = None
+# The innermost open span in the current context
+_current_span = contextvars.ContextVar("contextlib2_span", default=None)
+
+_SpanRecord = namedtuple("Span",
+    "name start duration span_id parent_id trace_id thread_id error")
+
+
+class _OpenSpan:
+    __slots__ = ("tracer", "cm", "name", "start", "span_id", "parent",
+                 "trace_id", "sampled")
+
+
+def _span_name(cm):
+    if isinstance(cm, _GeneratorContextManagerBase):
+        cm = cm.func
+    elif isinstance(cm, partial):
+        cm = cm.func
+    name = getattr(cm, "__qualname__", None)
+    if not isinstance(name, str):
+        name = type(cm).__qualname__
+    return name
+
+
+class SpanTracer:
+    """Records a tree of spans for the context managers entered while active.
+
+    While started, each context manager from this module that is entered
+    (including those used as decorators), each exit stack scope and each
+    exit stack callback is recorded as a span, with the enclosing span
+    tracked per context (and hence per asyncio task) as its parent.
+    Complete span trees are sampled at the given rate, and the spans can be
+    exported in the Chrome trace event format.
+    """
+
+    def __init__(self, *, sample_rate=1.0, max_spans=100000):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample rate {sample_rate!r} is not between 0 and 1")
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self._ids = itertools.count(1)
+        self._origin = None
+
+    def start(self):
+        """Start recording spans (only one tracer may record at a time)."""
+        global _active_tracer
+        if _active_tracer is not None:
+            raise RuntimeError("a span tracer is already active")
+        add_context_hook(self._hook)
+        _active_tracer = self
+        if self._origin is None:
+            self._origin = _hook_clock()
+
+    def stop(self):
+        """Stop recording spans."""
+        global _active_tracer
+        if _active_tracer is not self:
+            raise RuntimeError("the span tracer is not active")
+        _active_tracer = None
+        remove_context_hook(self._hook)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_details):
+        self.stop()
+
+    def _sample(self):
+        rate = self.sample_rate
+        if rate >= 1:
+            return True
+        import random
+        return random.random() < rate
+
+    def _hook(self, event, cm, duration, exc_type):
+        now = _hook_clock()
+        current = _current_span.get()
+        if current is not None and current.tracer is not self:
+            # Left over from an earlier tracer
+            current = None
+        if event == "enter":
+            if exc_type is not None:
+                return
+            if current is None:
+                sampled = self._sample()
+            elif current.sampled:
+                sampled = True
+            else:
+                # Only the root of an unsampled trace is tracked
+                return
+            span = _OpenSpan()
+            span.tracer = self
+            span.cm = cm
+            span.start = now - duration
+            span.span_id = next(self._ids)
+            span.parent = current
+            span.trace_id = span.span_id if current is None else current.trace_id
+            span.sampled = sampled
+            _current_span.set(span)
+        elif current is not None and current.cm is cm:
+            _current_span.set(current.parent)
+            if current.sampled:
+                parent = current.parent
+                self._record(cm, current.start, now, current.span_id,
+                             None if parent is None else parent.span_id,
+                             current.trace_id, exc_type)
+        elif current is None or current.sampled:
+            # An exit with no matching enter (such as an exit stack
+            # callback) is recorded as a leaf span
+            if current is None and not self._sample():
+                return
+            span_id = next(self._ids)
+            self._record(cm, now - duration, now, span_id,
+                         None if current is None else current.span_id,
+                         span_id if current is None else current.trace_id,
+                         exc_type)
+
+    def _record(self, cm, start, end, span_id, parent_id, trace_id, exc_type):
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return
+        self.spans.append(_SpanRecord(
+            _span_name(cm), start - self._origin, end - start, span_id,
+            parent_id, trace_id, threading.get_ident(),
+            None if exc_type is None else exc_type.__qualname__))
+
+    def chrome_trace(self):
+        """Return the recorded spans in the Chrome trace event format.
+
+        Each trace (span tree) is shown as a separate track, named after its
+        root span.
+        """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = {"span_id": span.span_id, "thread_id": span.thread_id}
+            if span.parent_id is None:
+                events.append({
+                    "name": "thread_name", "ph": "M", "pid": pid,
+                    "tid": span.trace_id,
+                    "args": {"name": f"{span.name} #{span.trace_id}"},
+                })
+            else:
+                args["parent_id"] = span.parent_id
+            if span.error is not None:
+                args["error"] = span.error
+            events.append({
+                "name": span.name, "cat": "contextlib2", "ph": "X",
+                "ts": span.start * 1e6, "dur": span.duration * 1e6,
+                "pid": pid, "tid": span.trace_id, "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        """Write the recorded spans to a Chrome trace event JSON file.
+
+        The file can be viewed offline with chrome://tracing or Perfetto.
+        """
+        import json
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+# Latency histograms use log-linear buckets: values (in nanoseconds) below
+# 2**_HIST_SUB_BITS each have their own bucket, and every power of two above
+# that is split into 2**_HIST_SUB_BITS equal buckets (a relative error of
+# at most 1/2**(_HIST_SUB_BITS + 1)). Larger values share the last bucket.
+_HIST_SUB_BITS = 5
+_HIST_SUB_BUCKETS = 1 << _HIST_SUB_BITS
+_HIST_MAX_BITS = 45  # Just under 10 hours
+_HIST_BUCKETS = (_HIST_MAX_BITS - _HIST_SUB_BITS + 1) << _HIST_SUB_BITS
+_DEFAULT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _hist_bucket(ns):
+    if ns < _HIST_SUB_BUCKETS:
+        return ns if ns > 0 else 0
+    shift = ns.bit_length() - _HIST_SUB_BITS - 1
+    index = ((shift + 1) << _HIST_SUB_BITS) + (ns >> shift) - _HIST_SUB_BUCKETS
+    return index if index < _HIST_BUCKETS else _HIST_BUCKETS - 1
+
+
+def _hist_bucket_midpoint(index):
+    # Return the middle of the range of nanosecond values in the bucket
+    if index < _HIST_SUB_BUCKETS:
+        return index
+    shift = (index >> _HIST_SUB_BITS) - 1
+    lower = (_HIST_SUB_BUCKETS + (index & (_HIST_SUB_BUCKETS - 1))) << shift
+    return lower + ((1 << shift) - 1) / 2
+
+
+class LatencyHistogram:
+    """Thread-safe log-linear histogram of latencies.
+
+    Each thread records into its own pre-allocated array of counters, so
+    recording doesn't need a lock. The per-thread counters are merged when
+    the histogram is read, and into a shared array when their thread exits.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # The counters of exited threads, followed by those of live threads
+        self._shards = [self._new_array()]
+
+    @staticmethod
+    def _new_array():
+        # One counter per bucket, followed by the total in nanoseconds
+        return array.array("q", bytes(8 * (_HIST_BUCKETS + 1)))
+
+    def _new_shard(self):
+        shard = self._new_array()
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        # Collected along with the rest of the thread's local data when the
+        # thread exits, at which point its counters are retired
+        sentinel = self._local.sentinel = _ThreadSentinel()
+        weakref.finalize(sentinel, self._retire, shard).atexit = False
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            retired = self._shards[0]
+            for index, count in enumerate(shard):
+                if count:
+                    retired[index] += count
+
+    def record_ns(self, ns):
+        """Record a latency given in nanoseconds."""
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard[_hist_bucket(ns)] += 1
+        shard[_HIST_BUCKETS] += ns
+
+    def record(self, seconds):
+        """Record a latency given in seconds."""
+        self.record_ns(int(seconds * 1e9))
+
+    def counts(self):
+        """Return the merged count for each bucket."""
+        with self._lock:
+            shards = list(self._shards)
+        merged = [0] * (_HIST_BUCKETS + 1)
+        for shard in shards:
+            for index, count in enumerate(shard):
+                if count:
+                    merged[index] += count
+        return merged
+
+    @property
+    def count(self):
+        """The number of latencies recorded."""
+        return sum(self.counts()[:_HIST_BUCKETS])
+
+    @property
+    def total(self):
+        """The sum of the latencies recorded, in seconds."""
+        with self._lock:
+            shards = list(self._shards)
+        return sum(shard[_HIST_BUCKETS] for shard in shards) / 1e9
+
+    def quantiles(self, qs=_DEFAULT_QUANTILES):
+        """Return the latency (in seconds) at each of the given quantiles.
+
+        The results are estimates, accurate to within the bucket width.
+        Returns NaN for each quantile if no latencies have been recorded.
+        """
+        counts = self.counts()[:_HIST_BUCKETS]
+        total = sum(counts)
+        if not total:
+            return [float("nan")] * len(qs)
+        results = []
+        for q in qs:
+            if not 0 <= q <= 1:
+                raise ValueError(f"quantile {q!r} is not between 0 and 1")
+            # The rank of the requested value (1 based, as for nearest rank)
+            rank = max(1, -int(-q * total // 1))
+            seen = 0
+            for index, count in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    break
+            results.append(_hist_bucket_midpoint(index) / 1e9)
+        return results
+
+    def percentile(self, p):
+        """Return the latency (in seconds) at percentile p (0-100)."""
+        return self.quantiles((p / 100,))[0]
+
+    def reset(self):
+        """Discard all of the recorded latencies."""
+        with self._lock:
+            for shard in self._shards:
+                for index in range(len(shard)):
+                    shard[index] = 0
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.label!r}: {self.count} values>"
+
+
+class _ThreadSentinel:
+    """Stored in thread-local data, to detect when the thread exits."""
+
+    __slots__ = ("__weakref__",)
+
+
+# Latency histograms used by timed(), by label
+_latency_histograms = {}
+_latency_histograms_lock = threading.Lock()
+
+
+def get_latency_histogram(label):
+    """Return the LatencyHistogram that timed(label) records into."""
+    histogram = _latency_histograms.get(label)
+    if histogram is None:
+        with _latency_histograms_lock:
+            histogram = _latency_histograms.get(label)
+            if histogram is None:
+                histogram = LatencyHistogram(label)
+                _latency_histograms[label] = histogram
+    return histogram
+
+
+def _escape_label(label):
+    return (str(label).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def format_latency_histograms(quantiles=_DEFAULT_QUANTILES,
+                              name="contextlib2_timed_seconds"):
+    """Return the latency histograms recorded by timed() as text.
+
+    The text uses the Prometheus text exposition format, reporting each
+    histogram as a summary with the given quantiles.
+    """
+    lines = [f"# TYPE {name} summary"]
+    for label, histogram in sorted(_latency_histograms.items(),
+                                   key=lambda item: str(item[0])):
+        label = _escape_label(label)
+        for q, value in zip(quantiles, histogram.quantiles(quantiles)):
+            lines.append(f'{name}{{label="{label}",quantile="{q}"}} {value!r}')
+        lines.append(f'{name}_sum{{label="{label}"}} {histogram.total!r}')
+        lines.append(f'{name}_count{{label="{label}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+class timed(AbstractContextManager, AbstractAsyncContextManager,
+            ContextDecorator):
+    """Context manager and decorator recording latencies by label.
+
+    Code like this:
+
+        with timed("db.query"):
+            <block>
+
+    records the time taken to run <block> in the histogram returned by
+    get_latency_histogram("db.query"). Each with statement needs its own
+    instance, but a single instance may decorate functions (including
+    coroutine functions), recording the time taken by each call.
+    """
+
+    __slots__ = ("histogram", "_start", "__weakref__")
+
+    def __init__(self, label):
+        histogram = _latency_histograms.get(label)
+        if histogram is None:
+            histogram = get_latency_histogram(label)
+        self.histogram = histogram
+
+    def _recreate_cm(self):
+        cm = timed.__new__(timed)
+        cm.histogram = self.histogram
+        return cm
+
+    def __call__(self, func):
+        if _code_flags(func) & _CO_COROUTINE:
+            return AsyncContextDecorator.__call__(self, func)
+        return ContextDecorator.__call__(self, func)
+
+    def __enter__(self):
+        self._start = _perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_details):
+        self.histogram.record_ns(_perf_counter_ns() - self._start)
+
+    async def __aenter__(self):
+        self._start = _perf_counter_ns()
+        return self
+
+    async def __aexit__(self, *exc_details):
+        self.histogram.record_ns(_perf_counter_ns() - self._start)
+
+
 # Preserve backwards compatibility
 class ContextStack(ExitStack):
     """(DEPRECATED) Backwards compatibility alias for ExitStack"""
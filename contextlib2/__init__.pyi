@@ -19,9 +19,12 @@ import abc
 import sys
 from _typeshed import FileDescriptorOrPath, Unused
 from abc import abstractmethod
-from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable, Generator, Iterator
-from types import TracebackType
-from typing import IO, Any, Generic, Protocol, TypeVar, overload, runtime_checkable
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable, Generator, Hashable, Iterable, Iterator
+from asyncio import Task
+from concurrent.futures import Executor
+from threading import Thread
+from types import CodeType, TracebackType
+from typing import IO, Any, Generic, Literal, NamedTuple, Protocol, TypeVar, overload, runtime_checkable
 from typing_extensions import ParamSpec, Self, TypeAlias
 
 __all__ = [
@@ -45,6 +48,9 @@ if True:
 if True:
     __all__ += ["chdir"]
 
+__all__ += ["ResourcePool", "AsyncResourcePool", "shared", "lazy", "cached_contextmanager", "add_context_hook", "remove_context_hook"]
+__all__ += ["timed", "LatencyHistogram", "get_latency_histogram", "format_latency_histograms", "ExitProfile", "ExitTimeoutError", "SpanTracer", "counting_suppress"]
+
 _T = TypeVar("_T")
 _T_co = TypeVar("_T_co", covariant=True)
 _T_io = TypeVar("_T_io", bound=IO[str] | None)
@@ -115,6 +121,7 @@ class _SupportsClose(Protocol):
 _SupportsCloseT = TypeVar("_SupportsCloseT", bound=_SupportsClose)
 
 class closing(AbstractContextManager[_SupportsCloseT, None]):
+    thing: _SupportsCloseT
     def __init__(self, thing: _SupportsCloseT) -> None: ...
     def __exit__(self, *exc_info: Unused) -> None: ...
 
@@ -125,6 +132,7 @@ if True:
     _SupportsAcloseT = TypeVar("_SupportsAcloseT", bound=_SupportsAclose)
 
     class aclosing(AbstractAsyncContextManager[_SupportsAcloseT, None]):
+        thing: _SupportsAcloseT
         def __init__(self, thing: _SupportsAcloseT) -> None: ...
         async def __aexit__(self, *exc_info: Unused) -> None: ...
 
@@ -143,14 +151,37 @@ class _RedirectStream(AbstractContextManager[_T_io, None]):
 class redirect_stdout(_RedirectStream[_T_io]): ...
 class redirect_stderr(_RedirectStream[_T_io]): ...
 
+_S = TypeVar("_S", bound=ExitStack[Any] | AsyncExitStack[Any])
+
+class _ExitStackFreeList(Generic[_S]):
+    def __init__(self, stack_type: type[_S], maxsize: int) -> None: ...
+    def __len__(self) -> int: ...
+    def acquire(self) -> _S: ...
+    def release(self, stack: _S) -> None: ...
+
 # In reality this is a subclass of `AbstractContextManager`;
 # see #7961 for why we don't do that in the stub
 class ExitStack(Generic[_ExitT_co], metaclass=abc.ABCMeta):
     def enter_context(self, cm: AbstractContextManager[_T, _ExitT_co]) -> _T: ...
+    def enter_contexts(self, cms: Iterable[AbstractContextManager[_T, _ExitT_co]]) -> list[_T]: ...
     def push(self, exit: _CM_EF) -> _CM_EF: ...
     def callback(self, callback: Callable[_P, _T], /, *args: _P.args, **kwds: _P.kwargs) -> Callable[_P, _T]: ...
+    def callbacks(self, callback: _F, /, *iterables: Iterable[Any]) -> _F: ...
+    @classmethod
+    def free_list(cls, maxsize: int = 64) -> _ExitStackFreeList[Self]: ...
+    def reset(self) -> None: ...
+    def mark(self) -> int: ...
     def pop_all(self) -> Self: ...
+    def enable_profiling(self, profile: ExitProfile | None = None) -> ExitProfile: ...
+    def slowest_exits(self, n: int = 10) -> list[_ExitTiming]: ...
     def close(self) -> None: ...
+    def unwind_to(
+        self,
+        mark: int,
+        exc_type: type[BaseException] | None = None,
+        exc_value: BaseException | None = None,
+        traceback: TracebackType | None = None,
+    ) -> bool: ...
     def __enter__(self) -> Self: ...
     def __exit__(
         self, exc_type: type[BaseException] | None, exc_value: BaseException | None, traceback: TracebackType | None, /
@@ -165,15 +196,42 @@ _ACM_EF = TypeVar("_ACM_EF", bound=AbstractAsyncContextManager[Any, Any] | _Exit
 # see #7961 for why we don't do that in the stub
 class AsyncExitStack(Generic[_ExitT_co], metaclass=abc.ABCMeta):
     def enter_context(self, cm: AbstractContextManager[_T, _ExitT_co]) -> _T: ...
+    def enter_contexts(self, cms: Iterable[AbstractContextManager[_T, _ExitT_co]]) -> list[_T]: ...
     async def enter_async_context(self, cm: AbstractAsyncContextManager[_T, _ExitT_co]) -> _T: ...
+    async def enter_async_contexts(self, cms: Iterable[AbstractAsyncContextManager[_T, _ExitT_co]]) -> list[_T]: ...
+    async def enter_async_contexts_concurrently(
+        self, cms: Iterable[AbstractAsyncContextManager[_T, _ExitT_co]], *, limit: int | None = None
+    ) -> list[_T]: ...
+    async def enter_context_in_executor(
+        self, cm: AbstractContextManager[_T, _ExitT_co], executor: Executor | None = None
+    ) -> _T: ...
     def push(self, exit: _CM_EF) -> _CM_EF: ...
     def push_async_exit(self, exit: _ACM_EF) -> _ACM_EF: ...
     def callback(self, callback: Callable[_P, _T], /, *args: _P.args, **kwds: _P.kwargs) -> Callable[_P, _T]: ...
+    def callbacks(self, callback: _F, /, *iterables: Iterable[Any]) -> _F: ...
     def push_async_callback(
         self, callback: Callable[_P, Awaitable[_T]], /, *args: _P.args, **kwds: _P.kwargs
     ) -> Callable[_P, Awaitable[_T]]: ...
+    def push_async_callbacks(self, callback: _AF, /, *iterables: Iterable[Any]) -> _AF: ...
+    @classmethod
+    def free_list(cls, maxsize: int = 64) -> _ExitStackFreeList[Self]: ...
+    def reset(self) -> None: ...
+    def mark(self) -> int: ...
     def pop_all(self) -> Self: ...
+    def enable_profiling(self, profile: ExitProfile | None = None) -> ExitProfile: ...
+    def slowest_exits(self, n: int = 10) -> list[_ExitTiming]: ...
     async def aclose(self) -> None: ...
+    async def aunwind_to(
+        self,
+        mark: int,
+        exc_type: type[BaseException] | None = None,
+        exc_value: BaseException | None = None,
+        traceback: TracebackType | None = None,
+    ) -> bool: ...
+    def set_exit_timeouts(
+        self, per_exit: float | None = None, total: float | None = None, *, on_timeout: Callable[[Any, float], object] | None = None
+    ) -> None: ...
+    def concurrent_group(self) -> _GeneratorContextManager[Self]: ...
     async def __aenter__(self) -> Self: ...
     async def __aexit__(
         self, exc_type: type[BaseException] | None, exc_value: BaseException | None, traceback: TracebackType | None, /
@@ -199,3 +257,238 @@ if True:
         def __init__(self, path: _T_fd_or_any_path) -> None: ...
         def __enter__(self) -> None: ...
         def __exit__(self, *excinfo: Unused) -> None: ...
+
+class _BaseResourcePool(Generic[_T]):
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        /,
+        maxsize: int = 10,
+        *,
+        max_idle: int | None = None,
+        idle_timeout: float | None = None,
+        check: Callable[[_T], Any] | None = None,
+        prefill: int = 0,
+    ) -> None: ...
+    @property
+    def maxsize(self) -> int: ...
+    @property
+    def in_use(self) -> int: ...
+    @property
+    def idle(self) -> int: ...
+    @property
+    def waiting(self) -> int: ...
+    @property
+    def wait_time(self) -> float: ...
+    @property
+    def closed(self) -> bool: ...
+
+class ResourcePool(_BaseResourcePool[_T], AbstractContextManager[ResourcePool[_T], None]):
+    def __init__(
+        self,
+        factory: Callable[[], AbstractContextManager[_T, Any]],
+        /,
+        maxsize: int = 10,
+        *,
+        max_idle: int | None = None,
+        idle_timeout: float | None = None,
+        check: Callable[[_T], bool] | None = None,
+        prefill: int = 0,
+    ) -> None: ...
+    def checkout(self, timeout: float | None = None) -> _GeneratorContextManager[_T]: ...
+    def prefill(self) -> Thread: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, *exc_details: Unused) -> None: ...
+
+class AsyncResourcePool(_BaseResourcePool[_T], AbstractAsyncContextManager[AsyncResourcePool[_T], None]):
+    def __init__(
+        self,
+        factory: Callable[[], AbstractAsyncContextManager[_T, Any]],
+        /,
+        maxsize: int = 10,
+        *,
+        max_idle: int | None = None,
+        idle_timeout: float | None = None,
+        check: Callable[[_T], Awaitable[bool]] | None = None,
+        prefill: int = 0,
+    ) -> None: ...
+    def checkout(self, timeout: float | None = None) -> _AsyncGeneratorContextManager[_T]: ...
+    def prefill(self) -> Task[None]: ...
+    async def aclose(self) -> None: ...
+    async def __aenter__(self) -> Self: ...
+    async def __aexit__(self, *exc_details: Unused) -> None: ...
+
+class shared(AbstractContextManager[_T, None], AbstractAsyncContextManager[_T, None]):
+    def __init__(
+        self,
+        factory: Callable[[], AbstractContextManager[_T, Any] | AbstractAsyncContextManager[_T, Any]],
+        /,
+        *,
+        linger: float | None = None,
+    ) -> None: ...
+    def __enter__(self) -> _T: ...
+    def __exit__(self, *exc_details: Unused) -> None: ...
+    def close(self) -> None: ...
+    async def __aenter__(self) -> _T: ...
+    async def __aexit__(self, *exc_details: Unused) -> None: ...
+    async def aclose(self) -> None: ...
+
+class lazy(AbstractContextManager[lazy[_T], bool | None], AbstractAsyncContextManager[lazy[_T], bool | None]):
+    @overload
+    def __init__(self, factory: Callable[_P, AbstractContextManager[_T, Any]], /, *args: _P.args, **kwds: _P.kwargs) -> None: ...
+    @overload
+    def __init__(self, factory: Callable[_P, AbstractAsyncContextManager[_T, Any]], /, *args: _P.args, **kwds: _P.kwargs) -> None: ...
+    @property
+    def entered(self) -> bool: ...
+    def get(self) -> _T: ...
+    async def aget(self) -> _T: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc_value: BaseException | None, traceback: TracebackType | None, /
+    ) -> bool | None: ...
+    async def __aenter__(self) -> Self: ...
+    async def __aexit__(
+        self, exc_type: type[BaseException] | None, exc_value: BaseException | None, traceback: TracebackType | None, /
+    ) -> bool | None: ...
+
+class _CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    maxsize: int | None
+    currsize: int
+
+class _CachedContext(AbstractContextManager[_T_co, None], AbstractAsyncContextManager[_T_co, None]):
+    def __init__(self, cache: Any, key: Hashable, args: tuple[Any, ...], kwds: dict[str, Any]) -> None: ...
+    def __enter__(self) -> _T_co: ...
+    def __exit__(self, *exc_details: Unused) -> None: ...
+    async def __aenter__(self) -> _T_co: ...
+    async def __aexit__(self, *exc_details: Unused) -> None: ...
+
+class _CachedContextManagerFunction(Generic[_P, _T_co]):
+    def __call__(self, *args: _P.args, **kwds: _P.kwargs) -> _CachedContext[_T_co]: ...
+    def cache_info(self) -> _CacheInfo: ...
+    def cache_clear(self) -> None: ...
+    async def cache_aclear(self) -> None: ...
+
+@overload
+def cached_contextmanager(
+    func: Callable[_P, Iterator[_T_co]]
+    | Callable[_P, AsyncIterator[_T_co]]
+    | Callable[_P, AbstractContextManager[_T_co, Any]]
+    | Callable[_P, AbstractAsyncContextManager[_T_co, Any]],
+    /,
+    *,
+    maxsize: int | None = 128,
+    ttl: float | None = None,
+) -> _CachedContextManagerFunction[_P, _T_co]: ...
+@overload
+def cached_contextmanager(
+    func: None = None, /, *, maxsize: int | None = 128, ttl: float | None = None
+) -> Callable[
+    [
+        Callable[_P, Iterator[_T_co]]
+        | Callable[_P, AsyncIterator[_T_co]]
+        | Callable[_P, AbstractContextManager[_T_co, Any]]
+        | Callable[_P, AbstractAsyncContextManager[_T_co, Any]]
+    ],
+    _CachedContextManagerFunction[_P, _T_co],
+]: ...
+
+_ContextHook: TypeAlias = Callable[[Literal["enter", "exit"], Any, float, type[BaseException] | None], object]
+_H = TypeVar("_H", bound=_ContextHook)
+
+def add_context_hook(hook: _H) -> _H: ...
+def remove_context_hook(hook: _ContextHook) -> None: ...
+
+class LatencyHistogram:
+    label: Any
+    def __init__(self, label: Any) -> None: ...
+    def record_ns(self, ns: int) -> None: ...
+    def record(self, seconds: float) -> None: ...
+    def counts(self) -> list[int]: ...
+    @property
+    def count(self) -> int: ...
+    @property
+    def total(self) -> float: ...
+    def quantiles(self, qs: Iterable[float] = ...) -> list[float]: ...
+    def percentile(self, p: float) -> float: ...
+    def reset(self) -> None: ...
+
+def get_latency_histogram(label: Any) -> LatencyHistogram: ...
+def format_latency_histograms(quantiles: Iterable[float] = ..., name: str = "contextlib2_timed_seconds") -> str: ...
+
+class timed(AbstractContextManager[timed, None], AbstractAsyncContextManager[timed, None], ContextDecorator):
+    histogram: LatencyHistogram
+    def __init__(self, label: Any) -> None: ...
+    def __call__(self, func: _F) -> _F: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, *exc_details: Unused) -> None: ...
+    async def __aenter__(self) -> Self: ...
+    async def __aexit__(self, *exc_details: Unused) -> None: ...
+
+class _ExitTiming(NamedTuple):
+    duration: float
+    code: CodeType
+    lineno: int
+    callback: Any
+    @property
+    def site(self) -> str: ...
+
+class _ExitSiteStats(NamedTuple):
+    code: CodeType
+    lineno: int
+    calls: int
+    total: float
+    max: float
+    @property
+    def site(self) -> str: ...
+
+class ExitProfile:
+    def slowest(self, n: int = 10) -> list[_ExitSiteStats]: ...
+    def report(self, n: int = 10) -> str: ...
+    def reset(self) -> None: ...
+
+class ExitTimeoutError(TimeoutError):
+    callback: Any
+    timeout: float
+    timed_out: list[Any]
+    def __init__(self, callback: Any, timeout: float, timed_out: list[Any]) -> None: ...
+
+class _SpanRecord(NamedTuple):
+    name: str
+    start: float
+    duration: float
+    span_id: int
+    parent_id: int | None
+    trace_id: int
+    thread_id: int
+    error: str | None
+
+class SpanTracer:
+    sample_rate: float
+    max_spans: int
+    spans: list[_SpanRecord]
+    dropped: int
+    def __init__(self, *, sample_rate: float = 1.0, max_spans: int = 100000) -> None: ...
+    def start(self) -> None: ...
+    def stop(self) -> None: ...
+    def __enter__(self) -> Self: ...
+    def __exit__(self, *exc_details: Unused) -> None: ...
+    def chrome_trace(self) -> dict[str, Any]: ...
+    def write_chrome_trace(self, path: FileDescriptorOrPath) -> None: ...
+
+class counting_suppress(suppress, AbstractAsyncContextManager[None, bool], ContextDecorator):
+    max_samples: int
+    counts: dict[type[BaseException], int]
+    samples: list[str]
+    def __init__(self, *exceptions: type[BaseException], max_samples: int = 10) -> None: ...
+    @property
+    def total(self) -> int: ...
+    def reset(self) -> None: ...
+    def __call__(self, func: _F) -> _F: ...
+    async def __aenter__(self) -> None: ...
+    async def __aexit__(
+        self, exctype: type[BaseException] | None, excinst: BaseException | None, exctb: TracebackType | None
+    ) -> bool: ...
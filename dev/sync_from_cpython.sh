@@ -16,4 +16,6 @@ sync_file "Lib/test/test_contextlib_async.py"  "test/test_contextlib_async.py"
 
 echo
 echo "Note: Update the 'contextlib2/__init__.pyi' stub as described in the file"
+echo "Note: Compare 'python -m benchmarks.bench_contextlib' (and bench_contextlib_async) results with a run"
+echo "      from before the sync to check for performance regressions"
 echo
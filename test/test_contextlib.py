@@ -1,13 +1,16 @@
 """Unit tests for synchronous features of contextlib2.py"""
 
 import io
+import json
 import os
 import sys
 import tempfile
 import threading
+import time
 import traceback
 import unittest
 from contextlib2 import *  # Tests __all__
+from contextlib2 import _GeneratorContextManager, _latency_histograms
 from test import support
 from test.support import os_helper
 from test.support.testcase import ExceptionIsLikeMixin
@@ -326,6 +329,17 @@ def woohoo():
     def test_instance_docstring_given_cm_docstring(self):
         baz = self._create_contextmanager_attribs()(None)
         self.assertEqual(baz.__doc__, "Whee!")
+        with baz:
+            self.assertEqual(baz.__doc__, "Whee!")
+
+    @support.requires_docstrings
+    def test_instance_docstring_without_cm_docstring(self):
+        @contextmanager
+        def woohoo():
+            yield
+        cm = woohoo()
+        self.assertEqual(cm.__doc__, type(cm).__doc__)
+        self.assertIsInstance(type(cm).__doc__, str)
 
     def test_keywords(self):
         # Ensure no keyword arguments are inhibited
@@ -675,6 +689,145 @@ class TestContextDecorator(unittest.TestCase):
         test('something else')
         self.assertEqual(state, [1, 'something else', 999])
 
+    def test_decorating_generator(self):
+        context = mycontext()
+
+        @context
+        def gen(n):
+            for i in range(n):
+                sent = yield i
+                if sent is not None:
+                    state.append(sent)
+            return 'done'
+
+        state = []
+        it = gen(3)
+        self.assertFalse(context.started)
+        self.assertEqual(next(it), 0)
+        self.assertTrue(context.started)
+        self.assertIsNone(context.exc)
+        self.assertEqual(it.send('sent'), 1)
+        self.assertEqual(list(it), [2])
+        self.assertEqual(context.exc, (None, None, None))
+        self.assertEqual(state, ['sent'])
+
+        context.exc = None
+        it = gen(3)
+        self.assertEqual(next(it), 0)
+        it.close()
+        self.assertIs(context.exc[0], GeneratorExit)
+
+    def test_decorating_generator_with_exception(self):
+        context = mycontext()
+
+        @context
+        def gen():
+            try:
+                yield 1
+            except KeyError:
+                yield 2
+            raise NameError('foo')
+
+        it = gen()
+        self.assertEqual(next(it), 1)
+        self.assertEqual(it.throw(KeyError), 2)
+        self.assertIsNone(context.exc)
+        with self.assertRaisesRegex(NameError, 'foo'):
+            next(it)
+        self.assertIs(context.exc[0], NameError)
+
+        context.catch = True
+        it = gen()
+        self.assertEqual(list(it), [1])
+        self.assertIs(context.exc[0], NameError)
+
+    def test_contextmanager_decorating_generator(self):
+        @contextmanager
+        def woohoo():
+            state.append('enter')
+            yield
+            state.append('exit')
+
+        @woohoo()
+        def gen():
+            state.append(1)
+            yield
+            state.append(2)
+
+        state = []
+        it = gen()
+        self.assertEqual(state, [])
+        next(it)
+        self.assertEqual(state, ['enter', 1])
+        self.assertEqual(list(it), [])
+        self.assertEqual(state, ['enter', 1, 2, 'exit'])
+
+    def test_contextmanager_as_decorator_exceptions(self):
+        @contextmanager
+        def woohoo(suppress):
+            try:
+                yield
+            except KeyError:
+                if not suppress:
+                    raise
+            except ValueError as exc:
+                raise TypeError from exc
+
+        @woohoo(True)
+        def suppressed():
+            raise KeyError
+        self.assertIsNone(suppressed())
+
+        @woohoo(False)
+        def propagated(exc):
+            raise exc
+        exc = KeyError()
+        try:
+            propagated(exc)
+        except KeyError as caught:
+            self.assertIs(caught, exc)
+            frames = traceback.extract_tb(caught.__traceback__)
+        else:
+            self.fail("KeyError not raised")
+        self.assertEqual(frames[-1].name, 'propagated')
+        self.assertNotIn('woohoo', [frame.name for frame in frames])
+
+        with self.assertRaises(TypeError) as cm:
+            propagated(ValueError())
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+
+    def test_contextmanager_as_decorator_bad_generators(self):
+        @contextmanager
+        def no_yield():
+            if False:
+                yield
+
+        @contextmanager
+        def two_yields():
+            yield
+            yield
+
+        @no_yield()
+        def func1():
+            state.append(1)
+
+        @two_yields()
+        def func2():
+            state.append(2)
+
+        state = []
+        with self.assertRaisesRegex(RuntimeError, "didn't yield"):
+            func1()
+        with self.assertRaisesRegex(RuntimeError, "didn't stop"):
+            func2()
+        self.assertEqual(state, [2])
+
+
+def exit_entries(stack):
+    """Return the (kind, target, arg, kwds) entries registered on a stack."""
+    callbacks = list(stack._exit_callbacks)
+    return [tuple(callbacks[i:i+4]) for i in range(0, len(callbacks), 4)]
+
 
 class TestBaseExitStack:
     exit_stack = None
@@ -715,10 +868,9 @@ class TestBaseExitStack:
                 else:
                     f = stack.callback(_exit)
                 self.assertIs(f, _exit)
-            for wrapper in stack._exit_callbacks:
-                self.assertIs(wrapper[1].__wrapped__, _exit)
-                self.assertNotEqual(wrapper[1].__name__, _exit.__name__)
-                self.assertIsNone(wrapper[1].__doc__, _exit.__doc__)
+            # Callbacks are stored directly, without a wrapper function
+            for kind, target, args, kwds in exit_entries(stack):
+                self.assertIs(target, _exit)
         self.assertEqual(result, expected)
 
         result = []
@@ -750,19 +902,19 @@ class TestBaseExitStack:
                 self.check_exc(*exc_details)
         with self.exit_stack() as stack:
             stack.push(_expect_ok)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_ok)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_ok)
             cm = ExitCM(_expect_ok)
             stack.push(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             stack.push(_suppress_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _suppress_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _suppress_exc)
             cm = ExitCM(_expect_exc)
             stack.push(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             stack.push(_expect_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_exc)
             stack.push(_expect_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_exc)
             1/0
 
     def test_enter_context(self):
@@ -780,10 +932,79 @@ class TestBaseExitStack:
                 result.append(4)
             self.assertIsNotNone(_exit)
             stack.enter_context(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             result.append(2)
         self.assertEqual(result, [1, 2, 3, 4])
 
+    def test_enter_contexts(self):
+        class TestCM(object):
+            def __init__(self, name):
+                self.name = name
+            def __enter__(self):
+                result.append(("enter", self.name))
+                return self.name
+            def __exit__(self, *exc_details):
+                result.append(("exit", self.name))
+
+        class OtherCM(TestCM):
+            pass
+
+        result = []
+        cms = [TestCM(1), TestCM(2), OtherCM(3), TestCM(4)]
+        with self.exit_stack() as stack:
+            self.assertEqual(stack.enter_contexts(iter(cms)), [1, 2, 3, 4])
+            self.assertEqual([entry[2] for entry in exit_entries(stack)], cms)
+            self.assertEqual(stack.enter_contexts([]), [])
+        self.assertEqual(result, [("enter", 1), ("enter", 2),
+                                  ("enter", 3), ("enter", 4),
+                                  ("exit", 4), ("exit", 3),
+                                  ("exit", 2), ("exit", 1)])
+
+    def test_enter_contexts_failure(self):
+        class TestCM(object):
+            def __init__(self, name):
+                self.name = name
+            def __enter__(self):
+                if self.name is None:
+                    raise ValueError("enter failed")
+                return self.name
+            def __exit__(self, *exc_details):
+                result.append((self.name, exc_details[0]))
+
+        class LacksExit:
+            def __enter__(self):
+                self.fail("Should not be called!")
+
+        result = []
+        with self.exit_stack() as stack:
+            stack.callback(result.append, "earlier")
+            with self.assertRaisesRegex(ValueError, "enter failed"):
+                stack.enter_contexts([TestCM(1), TestCM(2), TestCM(None)])
+            self.assertEqual(result, [(2, ValueError), (1, ValueError)])
+            self.assertEqual(len(exit_entries(stack)), 1)
+
+            result.clear()
+            expected_error, expected_text = support.cl2_cm_api_exc_info_sync()
+            with self.assertRaisesRegex(expected_error, expected_text):
+                stack.enter_contexts([TestCM(1), LacksExit()])
+            self.assertEqual(result, [(1, expected_error)])
+            self.assertEqual(len(exit_entries(stack)), 1)
+            result.clear()
+        self.assertEqual(result, ["earlier"])
+
+    def test_callbacks(self):
+        result = []
+        def _exit(*args):
+            result.append(args)
+        with self.exit_stack() as stack:
+            f = stack.callbacks(_exit, [1, 2, 3])
+            self.assertIs(f, _exit)
+            stack.callbacks(_exit, "ab", iter([4, 5, 6]))
+            stack.callbacks(_exit)
+            for kind, target, args, kwds in exit_entries(stack):
+                self.assertIs(target, _exit)
+        self.assertEqual(result, [("b", 5), ("a", 4), (3,), (2,), (1,)])
+
     def test_enter_context_errors(self):
         class LacksEnterAndExit:
             pass
@@ -828,6 +1049,209 @@ class TestBaseExitStack:
         new_stack.close()
         self.assertEqual(result, [1, 2, 3])
 
+    def test_reset(self):
+        result = []
+        stack = self.exit_stack()
+        stack.reset()
+        for i in range(2):
+            with stack:
+                stack.callback(result.append, i)
+                with self.assertRaisesRegex(RuntimeError, "pending"):
+                    stack.reset()
+            stack.reset()
+        self.assertEqual(result, [0, 1])
+
+    def test_free_list(self):
+        result = []
+        stacks = self.exit_stack.free_list(maxsize=2)
+        self.assertEqual(len(stacks), 0)
+        stack1 = stacks.acquire()
+        stack2 = stacks.acquire()
+        stack3 = stacks.acquire()
+        self.assertIsInstance(stack1, self.exit_stack)
+        self.assertIsNot(stack1, stack2)
+        with stack1:
+            stack1.callback(result.append, 1)
+            with self.assertRaisesRegex(RuntimeError, "pending"):
+                stacks.release(stack1)
+        self.assertEqual(result, [1])
+        stacks.release(stack1)
+        with self.assertRaisesRegex(RuntimeError, "already been released"):
+            stacks.release(stack1)
+        stacks.release(stack2)
+        # Stacks beyond the size limit are discarded
+        stacks.release(stack3)
+        self.assertEqual(len(stacks), 2)
+        self.assertIs(stacks.acquire(), stack2)
+        self.assertIs(stacks.acquire(), stack1)
+        self.assertIsNot(stacks.acquire(), stack3)
+        stacks.release(stack1)
+        with self.assertRaises(TypeError):
+            stacks.release(object())
+
+    def test_profiling(self):
+        class CM:
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                time.sleep(0.01)
+
+        profile = ExitProfile()
+        cm = CM()
+        for i in range(2):
+            stack = self.exit_stack()
+            with stack:
+                self.assertIs(stack.enable_profiling(profile), profile)
+                cm_line = sys._getframe().f_lineno + 1
+                stack.enter_context(cm)
+                callback_line = sys._getframe().f_lineno + 1
+                stack.callback(lambda: None)
+            slowest = stack.slowest_exits()
+            self.assertEqual(len(slowest), 2)
+            self.assertIs(slowest[0].callback, cm)
+            self.assertGreaterEqual(slowest[0].duration, 0.005)
+            self.assertIs(slowest[0].code, sys._getframe().f_code)
+            self.assertEqual(slowest[0].lineno, cm_line)
+            self.assertEqual(slowest[1].lineno, callback_line)
+            self.assertEqual(slowest[0].site, f"{__file__}:{cm_line} in "
+                                              f"test_profiling")
+            self.assertEqual(stack.slowest_exits(1), slowest[:1])
+
+        sites = profile.slowest()
+        self.assertEqual([stats.lineno for stats in sites],
+                         [cm_line, callback_line])
+        self.assertEqual([stats.calls for stats in sites], [2, 2])
+        self.assertGreaterEqual(sites[0].total, sites[0].max)
+        self.assertIn(f"{__file__}:{cm_line} in test_profiling\n",
+                      profile.report(1))
+        self.assertNotIn(str(callback_line), profile.report(1))
+        profile.reset()
+        self.assertEqual(profile.slowest(), [])
+
+    def test_profiling_last_unwind(self):
+        result = []
+        with self.exit_stack() as stack:
+            with self.assertRaisesRegex(RuntimeError, "not enabled"):
+                stack.slowest_exits()
+            stack.callback(result.append, 0)
+            stack.enable_profiling()
+            stack.callbacks(result.append, [1, 2])
+            mark = stack.mark()
+            stack.callback(result.append, 3)
+            stack.unwind_to(mark)
+            self.assertEqual(len(stack.slowest_exits()), 1)
+            new_stack = stack.pop_all()
+            stack.callback(result.append, 4)
+        # Callbacks registered before profiling was enabled aren't timed
+        self.assertEqual(len(stack.slowest_exits()), 1)
+        new_stack.close()
+        self.assertEqual(len(new_stack.slowest_exits()), 2)
+        self.assertEqual(result, [3, 4, 2, 1, 0])
+
+    def test_profiling_reset(self):
+        stacks = self.exit_stack.free_list()
+        stack = stacks.acquire()
+        with stack:
+            stack.enable_profiling()
+            stack.callback(lambda: None)
+        stacks.release(stack)
+        self.assertIs(stacks.acquire(), stack)
+        with stack:
+            stack.callback(lambda: None)
+        with self.assertRaisesRegex(RuntimeError, "not enabled"):
+            stack.slowest_exits()
+
+    def test_profiling_with_hooks(self):
+        events = []
+        def hook(event, cm, duration, exc_type):
+            events.append(event)
+        stack = self.exit_stack()
+        stack.enable_profiling()
+        stack.callback(events.append, "callback")
+        add_context_hook(hook)
+        try:
+            stack.close()
+        finally:
+            remove_context_hook(hook)
+        self.assertEqual(events, ["callback", "exit"])
+        self.assertEqual(len(stack.slowest_exits()), 1)
+
+    def test_mark_unwind_to(self):
+        result = []
+        with self.exit_stack() as stack:
+            stack.callback(result.append, 1)
+            mark = stack.mark()
+            self.assertEqual(mark, 1)
+            self.assertFalse(stack.unwind_to(mark))
+            stack.callback(result.append, 2)
+            inner_mark = stack.mark()
+            stack.callback(result.append, 3)
+            stack.callback(result.append, 4)
+            self.assertFalse(stack.unwind_to(inner_mark))
+            self.assertEqual(result, [4, 3])
+            self.assertEqual(stack.mark(), inner_mark)
+            stack.callback(result.append, 5)
+            self.assertFalse(stack.unwind_to(mark))
+            self.assertEqual(result, [4, 3, 5, 2])
+            with self.assertRaisesRegex(ValueError, "no longer extends"):
+                stack.unwind_to(inner_mark)
+            with self.assertRaisesRegex(ValueError, "no longer extends"):
+                stack.unwind_to(-1)
+            result.append("body")
+        self.assertEqual(result, [4, 3, 5, 2, "body", 1])
+
+    def test_unwind_to_exceptions(self):
+        def raise_exc(exc):
+            raise exc
+        saved_details = []
+        def save_exc(*exc_details):
+            saved_details.append(exc_details[1])
+        def suppress_exc(*exc_details):
+            return True
+
+        with self.exit_stack() as stack:
+            stack.push(save_exc)
+            mark = stack.mark()
+            stack.callback(raise_exc, KeyError)
+            stack.callback(raise_exc, IndexError)
+            try:
+                1/0
+            except ZeroDivisionError as exc:
+                with self.assertRaises(KeyError) as cm:
+                    stack.unwind_to(mark, type(exc), exc, exc.__traceback__)
+            exc = cm.exception
+            self.assertIsInstance(exc.__context__, IndexError)
+            self.assertIsInstance(exc.__context__.__context__,
+                                  ZeroDivisionError)
+            self.assertEqual(stack.mark(), mark)
+
+            stack.push(suppress_exc)
+            exc = ValueError()
+            self.assertTrue(stack.unwind_to(mark, ValueError, exc, None))
+        self.assertEqual(saved_details, [None])
+
+    def test_close_exception_chaining(self):
+        # Callbacks failing during a clean unwind still chain as they would
+        # for nested with statements, even when closing in an except clause
+        def raise_exc(exc):
+            raise exc
+        result = []
+        stack = self.exit_stack()
+        stack.callback(raise_exc, KeyError)
+        stack.callback(result.append, 1)
+        stack.callback(raise_exc, IndexError)
+        stack.callback(result.append, 2)
+        try:
+            raise ValueError
+        except ValueError:
+            with self.assertRaises(KeyError) as cm:
+                stack.close()
+        exc = cm.exception
+        self.assertIsInstance(exc.__context__, IndexError)
+        self.assertIsNone(exc.__context__.__context__)
+        self.assertEqual(result, [2, 1])
+        self.assertFalse(stack._exit_callbacks)
+
     def test_exit_raise(self):
         with self.assertRaises(ZeroDivisionError):
             with self.exit_stack() as stack:
@@ -860,8 +1284,7 @@ class TestBaseExitStack:
         expected = \
             [('test_exit_exception_traceback', 'with self.exit_stack() as stack:')] + \
             self.callback_error_internal_frames + \
-            [('_exit_wrapper', 'callback(*args, **kwds)'),
-             ('raise_exc', 'raise exc')]
+            [('raise_exc', 'raise exc')]
 
         # This check fails on PyPy 3.10
         # It also fails on CPython 3.9 and earlier versions
@@ -1105,7 +1528,7 @@ class TestBaseExitStack:
         with self.assertRaisesRegex(expected_error, expected_text):
             stack.enter_context(cm)
         stack.push(cm)
-        self.assertIs(stack._exit_callbacks[-1][1], cm)
+        self.assertIs(exit_entries(stack)[-1][1], cm)
 
     def test_dont_reraise_RuntimeError(self):
         # https://bugs.python.org/issue27122
@@ -1146,7 +1569,7 @@ class TestExitStack(TestBaseExitStack, unittest.TestCase):
     exit_stack = ExitStack
     callback_error_internal_frames = [
         ('__exit__', 'raise exc_details[1]'),
-        ('__exit__', 'if cb(*exc_details):'),
+        ('__exit__', 'target(*arg, **kwds)'),
     ]
 
 
@@ -1316,6 +1739,999 @@ class TestSuppress(ExceptionIsLikeMixin, unittest.TestCase):
             eg1.exception, ExceptionGroup("message", [KeyError("k")]),
         )
 
+    @support.cl2_requires_exception_groups
+    def test_exception_group_short_circuits(self):
+        nested = lambda: ExceptionGroup("nested", [
+            ValueError("ve1"),
+            ExceptionGroup("inner", [ValueError("ve2"), ValueError("ve3")]),
+        ])
+        with suppress(ValueError):
+            raise nested()
+        # The whole group propagates unchanged if nothing matches
+        eg = nested()
+        with self.assertRaises(ExceptionGroup) as eg1:
+            with suppress(KeyError):
+                raise eg
+        self.assertIs(eg1.exception, eg)
+        # Nested groups may be suppressed as a whole
+        with suppress(GeneratorExit, ExceptionGroup):
+            raise BaseExceptionGroup("message", [GeneratorExit(), nested()])
+        # Verdicts are cached per type, and reused with the instance
+        cm = suppress(ValueError)
+        with cm:
+            raise ExceptionGroup("many", [ValueError(i) for i in range(5000)])
+        with self.assertRaises(ExceptionGroup) as eg1:
+            with cm:
+                raise ExceptionGroup("mixed", [KeyError("k"), nested()])
+        self.assertExceptionIsLike(
+            eg1.exception, ExceptionGroup("mixed", [KeyError("k")]),
+        )
+        self.assertEqual(cm._verdicts.keys(), {ValueError, KeyError, ExceptionGroup})
+
+
+class TestCountingSuppress(ExceptionIsLikeMixin, unittest.TestCase):
+
+    def test_counts_and_samples(self):
+        cm = counting_suppress(KeyError, ValueError, max_samples=3)
+        self.assertEqual((cm.counts, cm.samples, cm.total), ({}, [], 0))
+        with cm:
+            pass
+        for i in range(50):
+            with cm:
+                {}[i]
+        with cm:
+            raise ValueError("ve")
+        with self.assertRaises(TypeError):
+            with cm:
+                raise TypeError
+        self.assertEqual(cm.counts, {KeyError: 50, ValueError: 1})
+        self.assertEqual(cm.total, 51)
+        self.assertEqual(len(cm.samples), 3)
+        for sample in cm.samples:
+            self.assertTrue(sample.startswith("Traceback (most recent call last):"))
+            self.assertRegex(sample, r"(KeyError: \d+|ValueError: ve)\n$")
+        cm.reset()
+        self.assertEqual((cm.counts, cm.samples, cm.total), ({}, [], 0))
+        self.assertFalse(hasattr(cm, "__dict__"))
+
+    @support.cl2_requires_exception_groups
+    def test_exception_groups(self):
+        cm = counting_suppress(ValueError)
+        with cm:
+            raise ExceptionGroup("eg", [ValueError(1), ExceptionGroup(
+                "nested", [ValueError(2), ValueError(3)])])
+        eg = ExceptionGroup("eg", [KeyError("k")])
+        with self.assertRaises(ExceptionGroup) as eg1:
+            with cm:
+                raise eg
+        self.assertIs(eg1.exception, eg)
+        with self.assertRaises(ExceptionGroup) as eg1:
+            with cm:
+                raise ExceptionGroup("eg", [ValueError(4), KeyError("k")])
+        self.assertExceptionIsLike(
+            eg1.exception, ExceptionGroup("eg", [KeyError("k")]))
+        self.assertEqual(cm.counts, {ValueError: 4})
+        self.assertEqual(cm.total, 2)
+        self.assertEqual(len(cm.samples), 2)
+
+    def test_decorator(self):
+        cm = counting_suppress(KeyError)
+
+        @cm
+        def lookup(key):
+            return {"a": 1}[key]
+
+        self.assertEqual(lookup("a"), 1)
+        self.assertIsNone(lookup("b"))
+        self.assertEqual(cm.counts, {KeyError: 1})
+
+    def test_exceptions_not_retained(self):
+        class Request:
+            pass
+
+        def fail(request):
+            raise KeyError
+
+        cm = counting_suppress(KeyError)
+        request = Request()
+        request_ref = weakref.ref(request)
+        with cm:
+            fail(request)
+        del request
+        support.gc_collect()
+        self.assertIsNone(request_ref())
+        self.assertIn("in fail\n", cm.samples[0])
+
+    def test_threads(self):
+        cm = counting_suppress(KeyError, max_samples=5)
+
+        def worker():
+            for _ in range(1000):
+                with cm:
+                    raise KeyError
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cm.counts, {KeyError: 4000})
+        self.assertEqual(len(cm.samples), 5)
+        self.assertNotIn(None, cm.samples)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestResourcePool(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.closed = []
+
+    @contextmanager
+    def connect(self):
+        resource = len(self.created)
+        self.created.append(resource)
+        try:
+            yield resource
+        finally:
+            self.closed.append(resource)
+
+    def test_reuse(self):
+        pool = ResourcePool(self.connect, 2)
+        with pool.checkout() as first:
+            self.assertEqual(pool.in_use, 1)
+            self.assertEqual(pool.idle, 0)
+        self.assertEqual(pool.in_use, 0)
+        self.assertEqual(pool.idle, 1)
+        with pool.checkout() as second:
+            self.assertIs(second, first)
+            with pool.checkout() as third:
+                self.assertIsNot(third, first)
+                self.assertEqual(pool.in_use, 2)
+        self.assertEqual(self.created, [0, 1])
+        self.assertEqual(self.closed, [])
+
+    def test_resource_returned_on_exception(self):
+        pool = ResourcePool(self.connect)
+        with self.assertRaises(ZeroDivisionError):
+            with pool.checkout():
+                1/0
+        self.assertEqual(pool.idle, 1)
+        self.assertEqual(self.closed, [])
+
+    def test_bounded(self):
+        pool = ResourcePool(self.connect, 1)
+        with pool.checkout():
+            with self.assertRaises(TimeoutError):
+                with pool.checkout(timeout=0.01):
+                    pass
+            self.assertEqual(pool.waiting, 0)
+        self.assertGreater(pool.wait_time, 0)
+        self.assertEqual(pool.in_use, 0)
+        self.assertEqual(self.created, [0])
+
+    def test_waiter_gets_returned_resource(self):
+        pool = ResourcePool(self.connect, 1)
+        result = []
+
+        def worker():
+            with pool.checkout() as resource:
+                result.append(resource)
+
+        with pool.checkout() as resource:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            while not pool.waiting:
+                time.sleep(0.001)
+        thread.join()
+        self.assertEqual(result, [resource])
+        self.assertEqual(self.created, [0])
+
+    def test_idle_timeout(self):
+        pool = ResourcePool(self.connect, idle_timeout=10)
+        pool._clock = clock = FakeClock()
+        with pool.checkout():
+            pass
+        clock.now = 5
+        with pool.checkout() as resource:
+            self.assertEqual(resource, 0)
+        clock.now = 20
+        with pool.checkout() as resource:
+            self.assertEqual(resource, 1)
+        self.assertEqual(self.closed, [0])
+
+    def test_max_idle_evicts_least_recently_used(self):
+        pool = ResourcePool(self.connect, 3, max_idle=1)
+        with pool.checkout(), pool.checkout():
+            pass
+        # The first resource is returned last, so it is the one kept
+        self.assertEqual(self.closed, [1])
+        self.assertEqual(pool.idle, 1)
+        with pool.checkout() as resource:
+            self.assertEqual(resource, 0)
+
+    def test_check(self):
+        healthy = {0: False}
+        pool = ResourcePool(self.connect,
+                            check=lambda resource: healthy.get(resource, True))
+        with pool.checkout():
+            pass
+        with pool.checkout() as resource:
+            self.assertEqual(resource, 1)
+        self.assertEqual(self.closed, [0])
+        self.assertEqual(pool.in_use, 0)
+
+    def test_factory_error(self):
+        @contextmanager
+        def broken():
+            raise ConnectionError
+            yield
+
+        pool = ResourcePool(broken, 1)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                with pool.checkout():
+                    pass
+        self.assertEqual(pool.in_use, 0)
+
+    def test_close(self):
+        with ExitStack() as stack:
+            pool = stack.enter_context(ResourcePool(self.connect))
+            with pool.checkout() as first:
+                with pool.checkout() as second:
+                    pass
+            self.assertEqual(pool.idle, 2)
+            with pool.checkout() as resource:
+                self.assertEqual(resource, first)
+                stack.close()
+                self.assertTrue(pool.closed)
+                self.assertEqual(self.closed, [second])
+            self.assertEqual(self.closed, [second, first])
+        with self.assertRaisesRegex(RuntimeError, "closed"):
+            with pool.checkout():
+                pass
+
+    def test_prefill(self):
+        with ResourcePool(self.connect, 5, prefill=3) as pool:
+            pool.prefill().join()
+            self.assertEqual(pool.idle, 3)
+            self.assertEqual(self.created, [0, 1, 2])
+        self.assertEqual(sorted(self.closed), [0, 1, 2])
+
+    def test_invalid_maxsize(self):
+        with self.assertRaises(ValueError):
+            ResourcePool(self.connect, 0)
+
+
+class TestShared(unittest.TestCase):
+
+    def setUp(self):
+        self.state = []
+
+    @contextmanager
+    def resource(self):
+        self.state.append('enter')
+        try:
+            yield len(self.state)
+        finally:
+            self.state.append('exit')
+
+    def wait_for_exit(self):
+        for _ in range(1000):
+            if self.state[-1] == 'exit':
+                return
+            time.sleep(0.001)
+        self.fail("shared context was not exited")
+
+    def test_shared(self):
+        cm = shared(self.resource)
+        with cm as first:
+            with cm as second:
+                self.assertEqual(first, second)
+            self.assertEqual(self.state, ['enter'])
+        self.assertEqual(self.state, ['enter', 'exit'])
+        with cm:
+            pass
+        self.assertEqual(self.state, ['enter', 'exit'] * 2)
+
+    def test_concurrent_users(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        @contextmanager
+        def slow_resource():
+            started.set()
+            release.wait()
+            with self.resource() as result:
+                yield result
+
+        cm = shared(slow_resource)
+        results = []
+        inside = threading.Barrier(5)
+
+        def user():
+            with cm as result:
+                results.append(result)
+                inside.wait()
+
+        threads = [threading.Thread(target=user) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.state.count('enter'), 1)
+        self.assertEqual(results, [1] * 5)
+
+    def test_exceptions_not_shared(self):
+        cm = shared(self.resource)
+        with cm:
+            with self.assertRaises(ZeroDivisionError):
+                with cm:
+                    1/0
+            self.assertEqual(self.state, ['enter'])
+
+    def test_enter_failure(self):
+        fail = [False, True]
+
+        @contextmanager
+        def flaky():
+            if fail.pop():
+                raise ConnectionError
+            yield
+
+        cm = shared(flaky)
+        with self.assertRaises(ConnectionError):
+            with cm:
+                pass
+        with cm:
+            pass
+
+    def test_linger(self):
+        cm = shared(self.resource, linger=0.01)
+        with cm:
+            pass
+        with cm:
+            pass
+        self.wait_for_exit()
+        self.assertEqual(self.state, ['enter', 'exit'])
+
+    def test_close(self):
+        cm = shared(self.resource, linger=60)
+        with cm:
+            with self.assertRaises(RuntimeError):
+                cm.close()
+        self.assertEqual(self.state, ['enter'])
+        cm.close()
+        self.assertEqual(self.state, ['enter', 'exit'])
+        cm.close()
+        self.assertEqual(self.state, ['enter', 'exit'])
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.state = []
+
+    @contextmanager
+    def resource(self, name, suppress=False):
+        self.state.append(('enter', name))
+        try:
+            yield name
+        except Exception as exc:
+            self.state.append(('exit', name, type(exc)))
+            if not suppress:
+                raise
+        else:
+            self.state.append(('exit', name, None))
+
+    def test_not_entered(self):
+        with ExitStack() as stack:
+            cm = stack.enter_context(lazy(self.resource, 'a'))
+            self.assertFalse(cm.entered)
+        self.assertEqual(self.state, [])
+
+    def test_entered_on_first_use(self):
+        with ExitStack() as stack:
+            cm = stack.enter_context(lazy(self.resource, 'a'))
+            self.assertEqual(self.state, [])
+            self.assertEqual(cm.get(), 'a')
+            self.assertEqual(cm.get(), 'a')
+            self.assertTrue(cm.entered)
+            self.assertEqual(self.state, [('enter', 'a')])
+        self.assertEqual(self.state, [('enter', 'a'), ('exit', 'a', None)])
+        self.assertFalse(cm.entered)
+
+    def test_exceptions(self):
+        with self.assertRaises(KeyError):
+            with lazy(self.resource, 'a') as cm:
+                cm.get()
+                raise KeyError
+        with lazy(self.resource, 'b', suppress=True) as cm:
+            cm.get()
+            raise KeyError
+        self.assertEqual(self.state, [('enter', 'a'), ('exit', 'a', KeyError),
+                                      ('enter', 'b'), ('exit', 'b', KeyError)])
+
+    def test_reuse(self):
+        cm = lazy(self.resource, 'a')
+        for _ in range(2):
+            with cm:
+                cm.get()
+        self.assertEqual(self.state, [('enter', 'a'), ('exit', 'a', None)] * 2)
+
+    def test_not_a_context_manager(self):
+        expected_error, expected_text = support.cl2_cm_api_exc_info_sync()
+        with lazy(object) as cm:
+            with self.assertRaisesRegex(expected_error, expected_text):
+                cm.get()
+            self.assertFalse(cm.entered)
+
+
+class TestCachedContextManager(unittest.TestCase):
+
+    def setUp(self):
+        self.state = []
+
+        @cached_contextmanager(maxsize=2)
+        def resource(name):
+            self.state.append(('enter', name))
+            yield name
+            self.state.append(('exit', name))
+        self.resource = resource
+
+    def test_reuse(self):
+        with self.resource('a') as first:
+            pass
+        with self.resource('a') as second:
+            self.assertIs(second, first)
+        self.assertEqual(self.state, [('enter', 'a')])
+        self.assertEqual(self.resource.cache_info(), (1, 1, 0, 2, 1))
+        self.resource.cache_clear()
+        self.assertEqual(self.state, [('enter', 'a'), ('exit', 'a')])
+        self.assertEqual(self.resource.cache_info().currsize, 0)
+
+    def test_keyword_arguments(self):
+        @cached_contextmanager
+        def resource(*args, **kwds):
+            yield (args, kwds)
+
+        with resource(1, b=2) as result:
+            self.assertEqual(result, ((1,), {'b': 2}))
+        with resource(1, 2) as result:
+            self.assertEqual(result, ((1, 2), {}))
+        self.assertEqual(resource.cache_info().misses, 2)
+
+    def test_lru_eviction(self):
+        for name in 'aba':
+            with self.resource(name):
+                pass
+        with self.resource('c'):
+            pass
+        self.assertEqual(self.state, [('enter', 'a'), ('enter', 'b'),
+                                      ('enter', 'c'), ('exit', 'b')])
+        self.assertEqual(self.resource.cache_info(), (1, 3, 1, 2, 2))
+
+    def test_eviction_deferred_while_in_use(self):
+        with self.resource('a'):
+            with self.resource('b'), self.resource('c'):
+                pass
+            # 'a' was evicted when 'c' was cached, but is still in use
+            self.assertEqual(self.state[-1], ('enter', 'c'))
+            self.assertEqual(self.resource.cache_info().evictions, 1)
+        self.assertEqual(self.state[-1], ('exit', 'a'))
+        self.resource.cache_clear()
+        self.assertEqual(self.state[-2:], [('exit', 'b'), ('exit', 'c')])
+
+    def test_ttl(self):
+        @cached_contextmanager(ttl=0.01)
+        def resource(name):
+            self.state.append(('enter', name))
+            yield name
+            self.state.append(('exit', name))
+
+        with resource('a'):
+            pass
+        with resource('b'):
+            pass
+        time.sleep(0.02)
+        with resource('a'):
+            pass
+        self.assertEqual(self.state, [('enter', 'a'), ('enter', 'b'),
+                                      ('exit', 'a'), ('exit', 'b'),
+                                      ('enter', 'a')])
+        self.assertEqual(resource.cache_info().evictions, 2)
+
+    def test_enter_failure_not_cached(self):
+        @cached_contextmanager
+        def resource():
+            self.state.append('enter')
+            raise ConnectionError
+            yield
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                with resource():
+                    pass
+        self.assertEqual(self.state, ['enter', 'enter'])
+        self.assertEqual(resource.cache_info().currsize, 0)
+
+    def test_factory_runs_without_lock(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        @cached_contextmanager
+        def resource(name):
+            self.state.append(('enter', name))
+            if name == 'slow':
+                started.set()
+                release.wait(5)
+            elif name == 'outer':
+                # Reentrant use of the cache with a different key
+                with resource('inner') as inner:
+                    yield (name, inner)
+                    return
+            yield name
+
+        results = []
+        def use_slow():
+            with resource('slow') as result:
+                results.append(result)
+        threads = [threading.Thread(target=use_slow) for _ in range(2)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads[1].start()
+        with resource('outer') as result:
+            self.assertEqual(result, ('outer', 'inner'))
+        self.assertEqual(results, [])
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['slow', 'slow'])
+        # The second user of the slow key waited for the first to enter it
+        self.assertEqual(self.state.count(('enter', 'slow')), 1)
+        self.assertEqual(resource.cache_info()[:2], (1, 3))
+
+    def test_nested_factory_cleanup(self):
+        @cached_contextmanager(maxsize=1)
+        def resource(depth):
+            self.state.append(('enter', depth))
+            if depth:
+                # The cleanup exits another cached call of the same function
+                with resource(depth - 1) as inner:
+                    yield (depth, inner)
+            else:
+                yield depth
+            self.state.append(('exit', depth))
+
+        with resource(1) as result:
+            self.assertEqual(result, (1, 0))
+        # Caching resource(1) evicted resource(0), which is only exited
+        # once resource(1) is (by cache_clear())
+        self.assertEqual(self.state, [('enter', 1), ('enter', 0)])
+        self.assertEqual(resource.cache_info().evictions, 1)
+        resource.cache_clear()
+        self.assertEqual(self.state[2:], [('exit', 0), ('exit', 1)])
+        with resource(2):
+            pass
+        with resource(3):
+            pass
+        self.assertEqual(resource.cache_info().currsize, 1)
+
+    def test_context_manager_factory(self):
+        @cached_contextmanager
+        class Resource:
+            def __init__(self, name):
+                self.name = name
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                pass
+
+        with Resource('a') as first, Resource('a') as second:
+            self.assertIs(first, second)
+            self.assertEqual(first.name, 'a')
+
+
+class TestContextHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        add_context_hook(self.hook)
+        self.addCleanup(remove_context_hook, self.hook)
+
+    def hook(self, event, cm, duration, exc_type):
+        self.assertGreaterEqual(duration, 0)
+        self.events.append((event, cm, exc_type))
+
+    def test_uninstrumented_when_no_hooks(self):
+        classes = (_GeneratorContextManager, closing, ExitStack,
+                   counting_suppress)
+        remove_context_hook(self.hook)
+        try:
+            methods = [dict(cls.__dict__) for cls in classes]
+            add_context_hook(print)
+            self.assertIsNot(closing.__exit__, methods[1]['__exit__'])
+            remove_context_hook(print)
+            self.assertEqual([dict(cls.__dict__) for cls in classes], methods)
+        finally:
+            add_context_hook(self.hook)
+
+    def test_remove_unknown_hook(self):
+        with self.assertRaises(ValueError):
+            remove_context_hook(print)
+
+    def test_contextmanager(self):
+        @contextmanager
+        def woohoo():
+            yield
+
+        cm = woohoo()
+        with self.assertRaises(KeyError):
+            with cm:
+                raise KeyError
+        self.assertEqual(self.events,
+                         [('enter', cm, None), ('exit', cm, KeyError)])
+
+    def test_contextmanager_as_decorator(self):
+        @contextmanager
+        def woohoo():
+            yield
+
+        @woohoo()
+        def func():
+            return 42
+
+        self.assertEqual(func(), 42)
+        self.assertEqual([event for event, cm, exc_type in self.events],
+                         ['enter', 'exit'])
+
+    def test_enter_failure(self):
+        with self.assertRaises(FileNotFoundError):
+            with chdir(os.path.join(os.curdir, 'does', 'not', 'exist')):
+                pass
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0][0], 'enter')
+        self.assertIs(self.events[0][2], FileNotFoundError)
+
+    def test_exit_stack(self):
+        class CM:
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                pass
+
+        def callback():
+            pass
+
+        cm = CM()
+        suppressor = suppress(KeyError)
+        with ExitStack() as stack:
+            stack.enter_context(cm)
+            stack.callback(callback)
+            stack.enter_context(suppressor)
+            raise KeyError
+        self.assertEqual(self.events, [
+            ('enter', suppressor, None),
+            ('exit', suppressor, KeyError),
+            ('exit', callback, None),
+            ('exit', cm, None),
+        ])
+
+    def test_partial_override(self):
+        class ExitOverride(closing):
+            def __exit__(self, *exc_info):
+                self.thing.close()
+
+        class EnterOverride(closing):
+            def __enter__(self):
+                return super().__enter__()
+
+        class Thing:
+            def close(self):
+                pass
+
+        with ExitOverride(Thing()):
+            pass
+        self.assertEqual(self.events, [])
+        cm = EnterOverride(Thing())
+        with cm:
+            pass
+        self.assertEqual(self.events, [('enter', cm, None), ('exit', cm, None)])
+
+
+class TestSpanTracer(unittest.TestCase):
+
+    def test_span_tree(self):
+        @contextmanager
+        def outer():
+            yield
+
+        @contextmanager
+        def inner():
+            yield
+
+        @inner()
+        def work():
+            pass
+
+        def callback():
+            pass
+
+        with SpanTracer() as tracer:
+            with outer():
+                with ExitStack() as stack:
+                    stack.callback(callback)
+                    work()
+            with self.assertRaises(ZeroDivisionError):
+                with inner():
+                    1/0
+        spans = {span.name.rpartition(".")[2]: span for span in tracer.spans}
+        self.assertEqual([span.name.rpartition(".")[2] for span in tracer.spans],
+                         ["inner", "callback", "ExitStack", "outer", "inner"])
+        self.assertIsNone(spans["outer"].parent_id)
+        self.assertEqual(spans["ExitStack"].parent_id, spans["outer"].span_id)
+        self.assertEqual(tracer.spans[0].parent_id, spans["ExitStack"].span_id)
+        self.assertEqual(spans["callback"].parent_id, spans["ExitStack"].span_id)
+        self.assertEqual({span.trace_id for span in tracer.spans[:4]},
+                         {spans["outer"].span_id})
+        self.assertIsNone(spans["inner"].parent_id)
+        self.assertEqual(spans["inner"].error, "ZeroDivisionError")
+        for span in tracer.spans[:3]:
+            self.assertGreaterEqual(span.start, spans["outer"].start)
+            self.assertLessEqual(span.start + span.duration,
+                                 spans["outer"].start + spans["outer"].duration)
+
+        # Nothing is recorded once the tracer is stopped
+        with outer():
+            pass
+        self.assertEqual(len(tracer.spans), 5)
+
+    def test_counting_suppress(self):
+        @contextmanager
+        def cm():
+            yield
+
+        suppressor = counting_suppress(KeyError)
+        with SpanTracer() as tracer:
+            with cm():
+                with suppressor:
+                    raise KeyError
+                with cm():
+                    pass
+        self.assertEqual([span.name.rpartition(".")[2] for span in tracer.spans],
+                         ["counting_suppress", "cm", "cm"])
+        # The suppressed exception is recorded, and doesn't leave the
+        # counting_suppress span open as the parent of the next span
+        self.assertEqual(tracer.spans[0].error, "KeyError")
+        parent = tracer.spans[2]
+        self.assertIsNone(parent.parent_id)
+        for span in tracer.spans[:2]:
+            self.assertEqual(span.parent_id, parent.span_id)
+        self.assertEqual(suppressor.total, 1)
+
+    def test_partial_override(self):
+        @contextmanager
+        def cm():
+            yield
+
+        class ExitOverride(nullcontext):
+            def __exit__(self, *exc_info):
+                pass
+
+        with SpanTracer() as tracer:
+            with cm():
+                with ExitOverride():
+                    pass
+                with cm():
+                    pass
+        self.assertEqual(len(tracer.spans), 2)
+        self.assertEqual(tracer.spans[0].parent_id, tracer.spans[1].span_id)
+
+    def test_threads(self):
+        @contextmanager
+        def cm():
+            yield
+
+        def worker():
+            with cm():
+                pass
+
+        with SpanTracer() as tracer:
+            with cm():
+                thread = threading.Thread(target=worker)
+                thread.start()
+                thread.join()
+        # Threads start in an empty context, so begin a new tree
+        self.assertEqual([span.parent_id for span in tracer.spans], [None, None])
+        self.assertNotEqual(tracer.spans[0].thread_id, tracer.spans[1].thread_id)
+
+    def test_sampling(self):
+        @contextmanager
+        def cm():
+            yield
+
+        with SpanTracer(sample_rate=0) as tracer:
+            with cm():
+                with cm():
+                    pass
+        self.assertEqual(tracer.spans, [])
+
+        with SpanTracer(sample_rate=0.5) as tracer:
+            for _ in range(200):
+                with cm():
+                    with cm():
+                        pass
+        # Trees are sampled as a whole
+        self.assertEqual(len(tracer.spans) % 2, 0)
+        self.assertLess(0, len(tracer.spans), 400)
+
+        with SpanTracer(max_spans=3) as tracer:
+            for _ in range(5):
+                with cm():
+                    pass
+        self.assertEqual(len(tracer.spans), 3)
+        self.assertEqual(tracer.dropped, 2)
+
+        with self.assertRaises(ValueError):
+            SpanTracer(sample_rate=2)
+
+    def test_start_stop(self):
+        tracer = SpanTracer()
+        with self.assertRaisesRegex(RuntimeError, "not active"):
+            tracer.stop()
+        with tracer:
+            with self.assertRaisesRegex(RuntimeError, "already active"):
+                SpanTracer().start()
+        with tracer:
+            with nullcontext():
+                pass
+        self.assertEqual([span.name for span in tracer.spans], ["nullcontext"])
+
+    def test_chrome_trace(self):
+        @contextmanager
+        def cm():
+            yield
+
+        with SpanTracer() as tracer:
+            with cm():
+                with cm():
+                    pass
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, "trace.json")
+            tracer.write_chrome_trace(path)
+            with open(path) as trace_file:
+                trace = json.load(trace_file)
+        self.assertEqual(trace, tracer.chrome_trace())
+        events = trace["traceEvents"]
+        self.assertEqual([event["ph"] for event in events], ["X", "M", "X"])
+        child, metadata, root = events
+        self.assertEqual(root["tid"], child["tid"])
+        self.assertEqual(metadata["tid"], root["tid"])
+        self.assertEqual(child["args"]["parent_id"], root["args"]["span_id"])
+        self.assertNotIn("parent_id", root["args"])
+        self.assertEqual(root["dur"], tracer.spans[1].duration * 1e6)
+
+
+class TestTimed(unittest.TestCase):
+
+    def histogram(self, label):
+        self.addCleanup(_latency_histograms.pop, label, None)
+        return get_latency_histogram(label)
+
+    def test_histogram_quantiles(self):
+        histogram = LatencyHistogram("test")
+        self.assertEqual(histogram.count, 0)
+        self.assertTrue(all(q != q for q in histogram.quantiles()))
+        for ns in range(1, 1001):
+            histogram.record_ns(ns * 1000)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.total, 0.5005)
+        for p, expected in [(0, 1e-6), (50, 500e-6), (99, 990e-6), (100, 1e-3)]:
+            self.assertAlmostEqual(histogram.percentile(p), expected,
+                                   delta=expected / 32)
+        self.assertEqual(histogram.quantiles((0.5, 0.99)),
+                         [histogram.percentile(50), histogram.percentile(99)])
+        with self.assertRaises(ValueError):
+            histogram.percentile(101)
+        histogram.reset()
+        self.assertEqual(histogram.count, 0)
+        self.assertEqual(histogram.total, 0)
+
+    def test_histogram_buckets(self):
+        histogram = LatencyHistogram("test")
+        histogram.record(0)
+        histogram.record_ns(31)
+        histogram.record(1e9)  # Beyond the last bucket
+        counts = histogram.counts()
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[31], 1)
+        self.assertEqual(counts[-2], 1)
+        self.assertEqual(histogram.percentile(0), 0)
+        self.assertGreater(histogram.percentile(100), 2 ** 44 / 1e9)
+
+    def test_timed(self):
+        histogram = self.histogram("test.timed")
+        with timed("test.timed") as cm:
+            self.assertIs(cm.histogram, histogram)
+        with self.assertRaises(ZeroDivisionError):
+            with timed("test.timed"):
+                1 / 0
+        self.assertEqual(histogram.count, 2)
+
+    def test_timed_duration(self):
+        histogram = self.histogram("test.timed")
+        with timed("test.timed"):
+            time.sleep(0.01)
+        self.assertGreaterEqual(histogram.percentile(50), 0.01 * 0.98)
+
+    def test_timed_decorator(self):
+        histogram = self.histogram("test.timed")
+
+        @timed("test.timed")
+        def test(x):
+            return x * 2
+
+        self.assertEqual(test(2), 4)
+        self.assertEqual(test(3), 6)
+        self.assertEqual(histogram.count, 2)
+
+    def test_timed_threads(self):
+        histogram = self.histogram("test.timed")
+        barrier = threading.Barrier(4)
+
+        def worker():
+            barrier.wait()
+            for _ in range(1000):
+                with timed("test.timed"):
+                    pass
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(histogram.count, 4000)
+        # The counters of the exited threads have been merged
+        self.assertEqual(len(histogram._shards), 1)
+
+    def test_histogram_exited_threads(self):
+        histogram = LatencyHistogram("test")
+        histogram.record_ns(1)
+        for _ in range(10):
+            threads = [threading.Thread(target=histogram.record_ns, args=(2,))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            support.gc_collect()
+            # Only the exited threads' shared shard and the current thread's
+            self.assertEqual(len(histogram._shards), 2)
+        self.assertEqual(histogram.count, 101)
+        self.assertEqual(histogram.counts()[2], 100)
+        self.assertEqual(histogram.total, 201e-9)
+        histogram.reset()
+        self.assertEqual(histogram.count, 0)
+
+    def test_format_latency_histograms(self):
+        self.histogram('test.timed"\\\n').record(0.25)
+        text = format_latency_histograms((0.5,), name="latency")
+        label = r'label="test.timed\"\\\n"'
+        self.assertIn("# TYPE latency summary\n", text)
+        self.assertIn(f'latency{{{label},quantile="0.5"}} 0.24', text)
+        self.assertIn(f"latency_sum{{{label}}} 0.25\n", text)
+        self.assertIn(f"latency_count{{{label}}} 1\n", text)
+
 
 class TestChdir(unittest.TestCase):
     def make_relative_path(self, *parts):
@@ -1364,5 +2780,49 @@ class TestChdir(unittest.TestCase):
         self.assertEqual(os.getcwd(), old_cwd)
 
 
+class TestInstanceLayout(unittest.TestCase):
+    # Context managers are often created in large numbers, so they use
+    # __slots__ rather than an instance __dict__ (but remain weakrefable)
+
+    def check_instance(self, cm):
+        self.assertFalse(hasattr(cm, "__dict__"))
+        self.assertIs(weakref.ref(cm)(), cm)
+
+    def test_simple_context_managers(self):
+        self.check_instance(closing(None))
+        self.check_instance(aclosing(None))
+        self.check_instance(nullcontext())
+        self.check_instance(suppress(KeyError))
+        self.check_instance(redirect_stdout(None))
+        self.check_instance(redirect_stderr(None))
+        self.check_instance(chdir("."))
+
+    def test_generator_context_managers(self):
+        @contextmanager
+        def woohoo():
+            yield
+
+        @asynccontextmanager
+        async def awoohoo():
+            yield
+
+        cm = woohoo()
+        self.check_instance(cm)
+        with cm:
+            self.assertFalse(hasattr(cm, "args"))
+            self.assertFalse(hasattr(cm, "kwds"))
+        acm = awoohoo()
+        self.check_instance(acm)
+
+    def test_subclasses_keep_instance_dict(self):
+        class MyCM(AbstractContextManager):
+            def __exit__(self, *exc_info):
+                pass
+        cm = MyCM()
+        cm.attr = 1
+        self.assertEqual(cm.__dict__, {"attr": 1})
+        self.assertTrue(hasattr(ExitStack(), "__dict__"))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,15 +1,23 @@
 """Unit tests for asynchronous features of contextlib2.py"""
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from contextlib2 import (
-    asynccontextmanager, AbstractAsyncContextManager,
-    AsyncExitStack, nullcontext, aclosing, contextmanager)
+    asynccontextmanager, AbstractAsyncContextManager, AsyncContextDecorator,
+    AsyncExitStack, AsyncResourcePool, ContextDecorator, ExitTimeoutError,
+    nullcontext, aclosing, add_context_hook, cached_contextmanager, contextmanager,
+    counting_suppress, lazy, get_latency_histogram, remove_context_hook, shared,
+    timed, SpanTracer)
+from contextlib2 import _latency_histograms
 import functools
+import sys
 from test import support
+import threading
 import unittest
 import traceback
 
-from .test_contextlib import TestBaseExitStack
+from .test_contextlib import FakeClock, TestBaseExitStack, exit_entries
 
 support.requires_working_socket(module=True)
 
@@ -421,6 +429,143 @@ class AsyncContextManagerTestCase(unittest.TestCase):
             await test()
         self.assertFalse(entered)
 
+    @_async_test
+    async def test_decorating_async_generator(self):
+        state = []
+
+        class context(AsyncContextDecorator):
+            async def __aenter__(self):
+                state.append('enter')
+
+            async def __aexit__(self, *exc):
+                state.append(exc[0])
+
+        @context()
+        async def agen(n):
+            for i in range(n):
+                try:
+                    sent = yield i
+                except KeyError:
+                    state.append('thrown')
+                else:
+                    if sent is not None:
+                        state.append(sent)
+
+        it = agen(4)
+        self.assertEqual(state, [])
+        self.assertEqual(await it.__anext__(), 0)
+        self.assertEqual(state, ['enter'])
+        self.assertEqual(await it.asend('sent'), 1)
+        self.assertEqual(await it.athrow(KeyError), 2)
+        self.assertEqual([i async for i in it], [3])
+        self.assertEqual(state, ['enter', 'sent', 'thrown', None])
+
+        state.clear()
+        it = agen(4)
+        self.assertEqual(await it.__anext__(), 0)
+        await it.aclose()
+        self.assertEqual(state, ['enter', GeneratorExit])
+
+    @_async_test
+    async def test_asynccontextmanager_decorating_async_generator(self):
+        @asynccontextmanager
+        async def woohoo():
+            state.append('enter')
+            try:
+                yield
+            except NameError:
+                state.append('suppressed')
+            state.append('exit')
+
+        @woohoo()
+        async def agen():
+            yield 1
+            raise NameError('foo')
+
+        state = []
+        self.assertEqual([i async for i in agen()], [1])
+        self.assertEqual(state, ['enter', 'suppressed', 'exit'])
+
+    @_async_test
+    async def test_sync_decorator_on_async_generator(self):
+        state = []
+
+        class context(ContextDecorator):
+            def __enter__(self):
+                state.append('enter')
+
+            def __exit__(self, *exc):
+                state.append('exit')
+
+        @context()
+        async def agen():
+            state.append(1)
+            yield
+            await asyncio.sleep(0)
+            state.append(2)
+
+        self.assertEqual([i async for i in agen()], [None])
+        self.assertEqual(state, ['enter', 1, 2, 'exit'])
+
+    @_async_test
+    async def test_decorator_exceptions(self):
+        @asynccontextmanager
+        async def woohoo(suppress):
+            try:
+                yield
+            except KeyError:
+                if not suppress:
+                    raise
+            except ValueError as exc:
+                raise TypeError from exc
+
+        @woohoo(True)
+        async def suppressed():
+            raise KeyError
+        self.assertIsNone(await suppressed())
+
+        @woohoo(False)
+        async def propagated(exc):
+            raise exc
+        exc = KeyError()
+        with self.assertRaises(KeyError) as cm:
+            await propagated(exc)
+        self.assertIs(cm.exception, exc)
+
+        with self.assertRaises(TypeError) as cm:
+            await propagated(ValueError())
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+
+        @woohoo(False)
+        async def returns():
+            return 42
+        self.assertEqual(await returns(), 42)
+
+    @_async_test
+    async def test_decorator_bad_generators(self):
+        @asynccontextmanager
+        async def no_yield():
+            if False:
+                yield
+
+        @asynccontextmanager
+        async def two_yields():
+            yield
+            yield
+
+        @no_yield()
+        async def func1():
+            pass
+
+        @two_yields()
+        async def func2():
+            pass
+
+        with self.assertRaisesRegex(RuntimeError, "didn't yield"):
+            await func1()
+        with self.assertRaisesRegex(RuntimeError, "didn't stop"):
+            await func2()
+
     @_async_test
     async def test_decorating_method(self):
 
@@ -540,6 +685,9 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
         def close(self):
             return self.run_coroutine(self.aclose())
 
+        def unwind_to(self, *args):
+            return self.run_coroutine(self.aunwind_to(*args))
+
         def __enter__(self):
             return self.run_coroutine(self.__aenter__())
 
@@ -552,7 +700,7 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
         ('run_coroutine', 'raise exc'),
         ('run_coroutine', 'raise exc'),
         ('__aexit__', 'raise exc_details[1]'),
-        ('__aexit__', 'cb_suppress = cb(*exc_details)'),
+        ('__aexit__', 'target(*arg, **kwds)'),
     ]
 
     def setUp(self):
@@ -587,10 +735,9 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
                 else:
                     f = stack.push_async_callback(_exit)
                 self.assertIs(f, _exit)
-            for wrapper in stack._exit_callbacks:
-                self.assertIs(wrapper[1].__wrapped__, _exit)
-                self.assertNotEqual(wrapper[1].__name__, _exit.__name__)
-                self.assertIsNone(wrapper[1].__doc__, _exit.__doc__)
+            # Callbacks are stored directly, without a wrapper function
+            for kind, target, args, kwds in exit_entries(stack):
+                self.assertIs(target, _exit)
 
         self.assertEqual(result, expected)
 
@@ -625,19 +772,19 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
 
         async with self.exit_stack() as stack:
             stack.push_async_exit(_expect_ok)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_ok)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_ok)
             cm = ExitCM(_expect_ok)
             stack.push_async_exit(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             stack.push_async_exit(_suppress_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _suppress_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _suppress_exc)
             cm = ExitCM(_expect_exc)
             stack.push_async_exit(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             stack.push_async_exit(_expect_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_exc)
             stack.push_async_exit(_expect_exc)
-            self.assertIs(stack._exit_callbacks[-1][1], _expect_exc)
+            self.assertIs(exit_entries(stack)[-1][1], _expect_exc)
             1/0
 
     @_async_test
@@ -657,11 +804,401 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
                 result.append(4)
             self.assertIsNotNone(_exit)
             await stack.enter_async_context(cm)
-            self.assertIs(stack._exit_callbacks[-1][1].__self__, cm)
+            self.assertIs(exit_entries(stack)[-1][2], cm)
             result.append(2)
 
         self.assertEqual(result, [1, 2, 3, 4])
 
+    @_async_test
+    async def test_enter_async_contexts(self):
+        class TestCM(object):
+            def __init__(self, name):
+                self.name = name
+            async def __aenter__(self):
+                if self.name is None:
+                    raise ValueError("enter failed")
+                result.append(("enter", self.name))
+                return self.name
+            async def __aexit__(self, *exc_details):
+                result.append(("exit", self.name, exc_details[0]))
+
+        class OtherCM(TestCM):
+            pass
+
+        result = []
+        async with AsyncExitStack() as stack:
+            cms = [TestCM(1), OtherCM(2)]
+            self.assertEqual(await stack.enter_async_contexts(cms), [1, 2])
+            self.assertEqual([entry[2] for entry in exit_entries(stack)], cms)
+            with self.assertRaisesRegex(ValueError, "enter failed"):
+                await stack.enter_async_contexts(
+                    [TestCM(3), TestCM(4), TestCM(None)])
+            self.assertEqual(result[-2:], [("exit", 4, ValueError),
+                                           ("exit", 3, ValueError)])
+            self.assertEqual(len(exit_entries(stack)), 2)
+            result.clear()
+        self.assertEqual(result, [("exit", 2, None), ("exit", 1, None)])
+
+    @_async_test
+    async def test_enter_async_contexts_concurrently(self):
+        active = 0
+        max_active = 0
+        result = []
+        class TestCM:
+            def __init__(self, name, delay):
+                self.name = name
+                self.delay = delay
+            async def __aenter__(self):
+                nonlocal active, max_active
+                active += 1
+                max_active = max(active, max_active)
+                await asyncio.sleep(self.delay)
+                active -= 1
+                result.append(("enter", self.name))
+                return self.name
+            async def __aexit__(self, *exc_details):
+                result.append(("exit", self.name))
+
+        cms = [TestCM(i, delay) for i, delay in enumerate([0.02, 0, 0.01, 0])]
+        async with AsyncExitStack() as stack:
+            self.assertEqual(await stack.enter_async_contexts_concurrently(cms),
+                             [0, 1, 2, 3])
+            self.assertEqual(max_active, 4)
+            # Exits are registered in the order the CMs were supplied
+            self.assertEqual([entry[2] for entry in exit_entries(stack)], cms)
+            self.assertEqual(await stack.enter_async_contexts_concurrently([]), [])
+            result.clear()
+        self.assertEqual(result, [("exit", 3), ("exit", 2),
+                                  ("exit", 1), ("exit", 0)])
+
+        max_active = 0
+        async with AsyncExitStack() as stack:
+            cms = [TestCM(i, 0) for i in range(5)]
+            self.assertEqual(
+                await stack.enter_async_contexts_concurrently(cms, limit=2),
+                [0, 1, 2, 3, 4])
+            self.assertEqual(max_active, 2)
+
+    @_async_test
+    async def test_enter_async_contexts_concurrently_tasks(self):
+        var = contextvars.ContextVar("var", default="default")
+        tasks = []
+        class TaskCM:
+            async def __aenter__(self):
+                tasks.append(asyncio.current_task())
+                var.set("entered")
+            async def __aexit__(self, *exc_details):
+                tasks.append(asyncio.current_task())
+                tasks.append(var.get())
+
+        async with AsyncExitStack() as stack:
+            await stack.enter_async_contexts_concurrently([TaskCM()])
+            self.assertEqual(var.get(), "default")
+        # Entered in a separate task, but exited in this one
+        self.assertIsNot(tasks[0], asyncio.current_task())
+        self.assertEqual(tasks[1:], [asyncio.current_task(), "default"])
+
+    @_async_test
+    async def test_enter_async_contexts_concurrently_failure(self):
+        result = []
+        class TestCM:
+            def __init__(self, name, delay=0, exc=None):
+                self.name = name
+                self.delay = delay
+                self.exc = exc
+            async def __aenter__(self):
+                try:
+                    await asyncio.sleep(self.delay)
+                except asyncio.CancelledError:
+                    result.append(("cancelled", self.name))
+                    raise
+                if self.exc is not None:
+                    raise self.exc
+                return self.name
+            async def __aexit__(self, *exc_details):
+                result.append(("exit", self.name, exc_details[0]))
+
+        async with AsyncExitStack() as stack:
+            stack.callback(result.append, "earlier")
+            cms = [TestCM(0), TestCM(1, exc=ValueError("enter failed")),
+                   TestCM(2, delay=10), TestCM(3)]
+            with self.assertRaisesRegex(ValueError, "enter failed"):
+                await stack.enter_async_contexts_concurrently(cms)
+            self.assertEqual(result, [("cancelled", 2),
+                                      ("exit", 3, ValueError),
+                                      ("exit", 0, ValueError)])
+            self.assertEqual(len(exit_entries(stack)), 1)
+            result.clear()
+
+            # Cancelling the call unwinds the entered CMs
+            cms = [TestCM(0), TestCM(1, delay=10)]
+            task = asyncio.ensure_future(
+                stack.enter_async_contexts_concurrently(cms))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(result, [("cancelled", 1),
+                                      ("exit", 0, asyncio.CancelledError)])
+            self.assertEqual(len(exit_entries(stack)), 1)
+            result.clear()
+
+            expected_error, expected_text = support.cl2_cm_api_exc_info_async()
+            with self.assertRaisesRegex(expected_error, expected_text):
+                await stack.enter_async_contexts_concurrently([TestCM(0), 1])
+            self.assertEqual(result, [])
+
+            # __aenter__ failing before returning an awaitable cancels the
+            # tasks that were already started, so they never enter
+            class RecordingCM(TestCM):
+                async def __aenter__(self):
+                    result.append(("enter", self.name))
+                    return await super().__aenter__()
+            class SyncFailingCM(TestCM):
+                def __aenter__(self):
+                    raise ValueError("sync enter failed")
+            cms = [RecordingCM(0), RecordingCM(1), SyncFailingCM(2)]
+            with self.assertRaisesRegex(ValueError, "sync enter failed"):
+                await stack.enter_async_contexts_concurrently(cms)
+            await asyncio.sleep(0.01)
+            self.assertEqual(result, [])
+            self.assertEqual(len(exit_entries(stack)), 1)
+            result.clear()
+        self.assertEqual(result, ["earlier"])
+
+    @support.cl2_requires_exception_groups
+    @_async_test
+    async def test_enter_async_contexts_concurrently_failures(self):
+        class FailingCM:
+            async def __aenter__(self):
+                raise ValueError("enter failed")
+            async def __aexit__(self, *exc_details):
+                pass
+
+        async with AsyncExitStack() as stack:
+            with self.assertRaises(ExceptionGroup) as cm:
+                await stack.enter_async_contexts_concurrently(
+                    [FailingCM(), FailingCM()])
+            self.assertEqual(len(cm.exception.exceptions), 2)
+
+    @_async_test
+    async def test_enter_context_in_executor(self):
+        var = contextvars.ContextVar("var")
+        result = []
+        class BlockingCM:
+            def __enter__(self):
+                result.append(("enter", threading.current_thread().name,
+                               var.get()))
+                return self
+            def __exit__(self, *exc_details):
+                result.append(("exit", threading.current_thread().name,
+                               var.get(), exc_details[0]))
+                return True
+
+        cm = BlockingCM()
+        with ThreadPoolExecutor(thread_name_prefix="cl2_test") as executor:
+            async with AsyncExitStack() as stack:
+                var.set("entered")
+                self.assertIs(
+                    await stack.enter_context_in_executor(cm, executor), cm)
+                var.set("exited")
+                1/0
+        self.assertEqual(len(result), 2)
+        # Both methods run in the context copied when entering
+        self.assertEqual(result[0][0::2], ("enter", "entered"))
+        self.assertEqual(result[1][0::2], ("exit", "entered"))
+        self.assertEqual(result[1][3], ZeroDivisionError)
+        for entry in result:
+            self.assertTrue(entry[1].startswith("cl2_test"))
+
+        result.clear()
+        async with AsyncExitStack() as stack:
+            var.set("default")
+            await stack.enter_context_in_executor(cm)
+        self.assertEqual(len(result), 2)
+        self.assertNotEqual(result[0][1], threading.current_thread().name)
+
+    @_async_test
+    async def test_enter_context_in_executor_context(self):
+        var = contextvars.ContextVar("var", default="default")
+        result = []
+        class ContextCM:
+            def __enter__(self):
+                self.token = var.set("entered")
+            def __exit__(self, *exc_details):
+                result.append(var.get())
+                var.reset(self.token)
+                result.append(var.get())
+
+        async with AsyncExitStack() as stack:
+            await stack.enter_context_in_executor(ContextCM())
+            self.assertEqual(var.get(), "default")
+        self.assertEqual(result, ["entered", "default"])
+
+    @_async_test
+    async def test_enter_context_in_executor_errors(self):
+        class FailingExitCM:
+            def __enter__(self):
+                pass
+            def __exit__(self, *exc_details):
+                raise ValueError("exit failed")
+
+        with self.assertRaisesRegex(ValueError, "exit failed") as cm:
+            async with AsyncExitStack() as stack:
+                await stack.enter_context_in_executor(FailingExitCM())
+                1/0
+        self.assertIsInstance(cm.exception.__context__, ZeroDivisionError)
+
+        expected_error, expected_text = support.cl2_cm_api_exc_info_sync()
+        async with AsyncExitStack() as stack:
+            with self.assertRaisesRegex(expected_error, expected_text):
+                await stack.enter_context_in_executor(object())
+            self.assertFalse(stack._exit_callbacks)
+
+    @_async_test
+    async def test_enter_context_in_executor_cancelled(self):
+        var = contextvars.ContextVar("var")
+        entering = threading.Event()
+        release = threading.Event()
+        exited = asyncio.Event()
+        exit_values = []
+        loop = asyncio.get_running_loop()
+        class SlowCM:
+            def __enter__(self):
+                var.set("entered")
+                entering.set()
+                release.wait()
+            def __exit__(self, *exc_details):
+                exit_values.append(var.get(None))
+                loop.call_soon_threadsafe(exited.set)
+                raise ValueError("exit failed")
+
+        unhandled = []
+        loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+        self.addCleanup(loop.set_exception_handler, None)
+        async with AsyncExitStack() as stack:
+            task = asyncio.ensure_future(
+                stack.enter_context_in_executor(SlowCM()))
+            await loop.run_in_executor(None, entering.wait)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertFalse(stack._exit_callbacks)
+            release.set()
+            # The CM is still exited once __enter__ completes (in the same
+            # context), and the exception from __exit__ is retrieved
+            await asyncio.wait_for(exited.wait(), 5)
+            await asyncio.sleep(0.01)
+            self.assertEqual(exit_values, ["entered"])
+        support.gc_collect()
+        self.assertEqual(unhandled, [])
+
+    @_async_test
+    async def test_aunwind_to(self):
+        result = []
+        async def _exit(value):
+            result.append(value)
+        async with AsyncExitStack() as stack:
+            stack.push_async_callback(_exit, 1)
+            mark = stack.mark()
+            stack.push_async_callback(_exit, 2)
+            stack.callback(result.append, 3)
+            self.assertFalse(await stack.aunwind_to(mark))
+            self.assertEqual(result, [3, 2])
+        self.assertEqual(result, [3, 2, 1])
+
+    @_async_test
+    async def test_push_async_callbacks(self):
+        result = []
+        async def _exit(*args):
+            result.append(args)
+        async with AsyncExitStack() as stack:
+            f = stack.push_async_callbacks(_exit, [1, 2], "ab")
+            self.assertIs(f, _exit)
+            stack.callbacks(result.append, [3])
+        self.assertEqual(result, [3, (2, "b"), (1, "a")])
+
+    @_async_test
+    async def test_concurrent_group(self):
+        result = []
+        release = asyncio.Event()
+        async def _wait_exit(name):
+            result.append(("start", name))
+            await release.wait()
+            result.append(("end", name))
+        async def _release_exit():
+            result.append("release")
+            release.set()
+
+        async with AsyncExitStack() as stack:
+            stack.callback(result.append, "outer")
+            with stack.concurrent_group() as group_stack:
+                self.assertIs(group_stack, stack)
+                stack.push_async_callback(_release_exit)
+                stack.push_async_callback(_wait_exit, 1)
+                stack.push_async_callback(_wait_exit, 2)
+                stack.callback(result.append, "sync")
+            self.assertEqual(len(exit_entries(stack)), 2)
+            with stack.concurrent_group():
+                pass
+            self.assertEqual(len(exit_entries(stack)), 2)
+            stack.callback(result.append, "inner")
+        # Sequential unwinding would wait forever for the release
+        self.assertEqual(result, ["inner", "sync",
+                                  ("start", 2), ("start", 1), "release",
+                                  ("end", 2), ("end", 1), "outer"])
+
+    @_async_test
+    async def test_concurrent_group_exc_details(self):
+        seen = []
+        class TestCM:
+            def __init__(self, suppress):
+                self.suppress = suppress
+            async def __aenter__(self):
+                pass
+            async def __aexit__(self, *exc_details):
+                seen.append(exc_details[0])
+                return self.suppress
+
+        async with AsyncExitStack() as stack:
+            stack.push(lambda *exc_details: seen.append(exc_details[0]))
+            with stack.concurrent_group():
+                await stack.enter_async_context(TestCM(False))
+                await stack.enter_async_context(TestCM(True))
+                await stack.enter_async_context(TestCM(False))
+            1/0
+        self.assertEqual(seen, [ZeroDivisionError] * 3 + [None])
+
+    @support.cl2_requires_exception_groups
+    @_async_test
+    async def test_concurrent_group_failures(self):
+        def raise_exc(exc):
+            raise exc
+        async def async_raise_exc(exc):
+            await asyncio.sleep(0)
+            raise exc
+        exc1 = ValueError(1)
+        exc2 = KeyError(2)
+        result = []
+        with self.assertRaises(BaseExceptionGroup) as cm:
+            async with AsyncExitStack() as stack:
+                stack.callback(result.append, "outer")
+                with stack.concurrent_group():
+                    stack.push_async_callback(async_raise_exc, exc1)
+                    stack.push_async_callback(asyncio.sleep, 0)
+                    stack.callback(raise_exc, exc2)
+                    # Not a coroutine function
+                    stack.push_async_callback(result.append, "inner")
+                1/0
+        group = cm.exception
+        self.assertIsInstance(group, ExceptionGroup)
+        self.assertEqual(len(group.exceptions), 3)
+        self.assertIsInstance(group.exceptions[0], TypeError)
+        self.assertIs(group.exceptions[1], exc2)
+        self.assertIs(group.exceptions[2], exc1)
+        self.assertIsInstance(group.__context__, ZeroDivisionError)
+        self.assertEqual(result, ["inner", "outer"])
+
     @_async_test
     async def test_enter_async_context_errors(self):
         class LacksEnterAndExit:
@@ -761,7 +1298,159 @@ class TestAsyncExitStack(TestBaseExitStack, unittest.TestCase):
         with self.assertRaisesRegex(expected_error, expected_text):
             await stack.enter_async_context(cm)
         stack.push_async_exit(cm)
-        self.assertIs(stack._exit_callbacks[-1][1], cm)
+        self.assertIs(exit_entries(stack)[-1][1], cm)
+
+    @_async_test
+    async def test_async_profiling(self):
+        @asynccontextmanager
+        async def slow():
+            yield
+            await asyncio.sleep(0.01)
+
+        cm = slow()
+        async with AsyncExitStack() as stack:
+            profile = stack.enable_profiling()
+            cm_line = sys._getframe().f_lineno + 1
+            await stack.enter_async_context(cm)
+            group_line = sys._getframe().f_lineno + 1
+            with stack.concurrent_group():
+                stack.push_async_callback(asyncio.sleep, 0)
+            stack.callback(lambda: None)
+        slowest = stack.slowest_exits()
+        self.assertEqual(len(slowest), 4)
+        self.assertIs(slowest[0].callback, cm)
+        self.assertEqual(slowest[0].lineno, cm_line)
+        # The group registers on exit, which Python < 3.10 reports as the
+        # last line of the with statement's body
+        if sys.version_info < (3, 10):
+            group_line += 1
+        self.assertIn(group_line, [timing.lineno for timing in slowest])
+        self.assertEqual(profile.slowest(1)[0].lineno, cm_line)
+
+    @_async_test
+    async def test_exit_timeouts(self):
+        result = []
+        timeouts = []
+
+        @asynccontextmanager
+        async def hang():
+            try:
+                yield
+                await asyncio.sleep(60)
+            finally:
+                result.append("cancelled")
+
+        async def fast():
+            await asyncio.sleep(0)
+            result.append("fast")
+
+        cm = hang()
+        with self.assertRaises(ExitTimeoutError) as cm_exc:
+            async with AsyncExitStack() as stack:
+                stack.set_exit_timeouts(0.01, on_timeout=
+                    lambda callback, timeout: timeouts.append((callback, timeout)))
+                stack.push_async_callback(fast)
+                await stack.enter_async_context(cm)
+                stack.callback(result.append, "sync")
+        self.assertEqual(result, ["sync", "cancelled", "fast"])
+        self.assertEqual(timeouts, [(cm, 0.01)])
+        self.assertIsInstance(cm_exc.exception, TimeoutError)
+        self.assertIs(cm_exc.exception.callback, cm)
+        self.assertEqual(cm_exc.exception.timeout, 0.01)
+        self.assertEqual(cm_exc.exception.timed_out, [cm])
+        # The task isn't left cancelled
+        await asyncio.sleep(0)
+
+    @_async_test
+    async def test_exit_timeouts_total(self):
+        async def hang():
+            await asyncio.sleep(60)
+
+        stack = AsyncExitStack()
+        stack.set_exit_timeouts(total=0.02)
+        stack.push_async_callback(hang)
+        stack.push_async_callback(hang)
+        stack.push_async_callback(asyncio.sleep, 0.005)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with self.assertRaises(ExitTimeoutError) as cm_exc:
+            await stack.aclose()
+        self.assertLess(loop.time() - start, 1)
+        self.assertEqual(cm_exc.exception.timed_out, [hang, hang])
+        self.assertLess(cm_exc.exception.timeout, 0.02)
+
+    @_async_test
+    async def test_exit_timeouts_exception(self):
+        async def hang(*exc_info):
+            await asyncio.sleep(60)
+
+        with self.assertRaises(ExitTimeoutError) as cm_exc:
+            async with AsyncExitStack() as stack:
+                stack.set_exit_timeouts(0.01)
+                stack.push_async_exit(hang)
+                1/0
+        self.assertIsInstance(cm_exc.exception.__context__, ZeroDivisionError)
+
+        # Callbacks that finish in time are unaffected, and the timeouts
+        # apply to stacks created by pop_all() and partial unwinds
+        result = []
+        async with AsyncExitStack() as stack:
+            stack.set_exit_timeouts(1)
+            stack.push_async_callback(asyncio.sleep, 0, "result")
+            mark = stack.mark()
+            stack.push_async_exit(hang)
+            with self.assertRaises(ExitTimeoutError):
+                stack.set_exit_timeouts(0.01)
+                await stack.aunwind_to(mark)
+            stack.push_async_exit(hang)
+            new_stack = stack.pop_all()
+        with self.assertRaises(ExitTimeoutError):
+            await new_stack.aclose()
+
+        stack.set_exit_timeouts()
+        self.assertIsNone(stack._exit_timeouts)
+
+        # Stacks reused via a free list don't keep the timeouts
+        stacks = AsyncExitStack.free_list()
+        stack = stacks.acquire()
+        stack.set_exit_timeouts(0.01)
+        stacks.release(stack)
+        self.assertIs(stacks.acquire(), stack)
+        self.assertIsNone(stack._exit_timeouts)
+
+    @_async_test
+    async def test_exit_timeouts_cancellation_swallowed(self):
+        async def stubborn():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                return "swallowed"
+
+        async with AsyncExitStack() as stack:
+            stack.set_exit_timeouts(0.01)
+            stack.push_async_callback(stubborn)
+        if hasattr(asyncio.current_task(), "cancelling"):
+            self.assertEqual(asyncio.current_task().cancelling(), 0)
+        # The task can still be suspended after the unwind
+        await asyncio.sleep(0)
+
+    @_async_test
+    async def test_exit_timeouts_external_cancel(self):
+        started = asyncio.Event()
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        async def unwind():
+            async with AsyncExitStack() as stack:
+                stack.set_exit_timeouts(30)
+                stack.push_async_callback(hang)
+
+        task = asyncio.ensure_future(unwind())
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
 
 
 class TestAsyncNullcontext(unittest.TestCase):
@@ -774,5 +1463,447 @@ class TestAsyncNullcontext(unittest.TestCase):
             self.assertIs(c_in, c)
 
 
+class TestAsyncResourcePool(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.closed = []
+
+    @asynccontextmanager
+    async def connect(self):
+        resource = len(self.created)
+        self.created.append(resource)
+        try:
+            yield resource
+        finally:
+            await asyncio.sleep(0)
+            self.closed.append(resource)
+
+    @_async_test
+    async def test_reuse(self):
+        pool = AsyncResourcePool(self.connect, 2)
+        async with pool.checkout() as first:
+            self.assertEqual(pool.in_use, 1)
+        self.assertEqual(pool.idle, 1)
+        async with pool.checkout() as second:
+            self.assertIs(second, first)
+            async with pool.checkout() as third:
+                self.assertIsNot(third, first)
+                self.assertEqual(pool.in_use, 2)
+        self.assertEqual(self.created, [0, 1])
+        self.assertEqual(self.closed, [])
+
+    @_async_test
+    async def test_bounded(self):
+        pool = AsyncResourcePool(self.connect, 1)
+        result = []
+
+        async def worker():
+            async with pool.checkout() as resource:
+                result.append(resource)
+
+        async with pool.checkout() as resource:
+            with self.assertRaises(TimeoutError):
+                async with pool.checkout(timeout=0.01):
+                    pass
+            task = asyncio.ensure_future(worker())
+            await asyncio.sleep(0)
+            self.assertEqual(pool.waiting, 1)
+        await task
+        self.assertEqual(result, [resource])
+        self.assertGreater(pool.wait_time, 0)
+        self.assertEqual(self.created, [0])
+
+    @_async_test
+    async def test_idle_timeout_and_check(self):
+        healthy = {1: False}
+
+        async def check(resource):
+            return healthy.get(resource, True)
+
+        pool = AsyncResourcePool(self.connect, idle_timeout=10, check=check)
+        pool._clock = clock = FakeClock()
+        async with pool.checkout():
+            pass
+        clock.now = 20
+        async with pool.checkout() as resource:
+            self.assertEqual(resource, 1)
+        self.assertEqual(self.closed, [0])
+        async with pool.checkout() as resource:
+            self.assertEqual(resource, 2)
+        self.assertEqual(self.closed, [0, 1])
+        self.assertEqual(pool.in_use, 0)
+
+    @_async_test
+    async def test_close(self):
+        async with AsyncExitStack() as stack:
+            pool = await stack.enter_async_context(
+                AsyncResourcePool(self.connect, prefill=2))
+            await pool.prefill()
+            self.assertEqual(pool.idle, 2)
+            async with pool.checkout() as resource:
+                await stack.aclose()
+                self.assertTrue(pool.closed)
+                self.assertEqual(len(self.closed), 1)
+            self.assertEqual(sorted(self.closed), [0, 1])
+        with self.assertRaisesRegex(RuntimeError, "closed"):
+            async with pool.checkout():
+                pass
+
+
+class TestAsyncShared(unittest.TestCase):
+
+    def setUp(self):
+        self.state = []
+
+    @asynccontextmanager
+    async def resource(self):
+        self.state.append('enter')
+        await asyncio.sleep(0)
+        try:
+            yield len(self.state)
+        finally:
+            await asyncio.sleep(0)
+            self.state.append('exit')
+
+    @_async_test
+    async def test_concurrent_users(self):
+        cm = shared(self.resource)
+        results = []
+
+        async def user():
+            async with cm as result:
+                results.append(result)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(user() for _ in range(5)))
+        self.assertEqual(self.state, ['enter', 'exit'])
+        self.assertEqual(results, [1] * 5)
+
+    @_async_test
+    async def test_linger(self):
+        cm = shared(self.resource, linger=0.01)
+        async with cm:
+            pass
+        await asyncio.sleep(0)
+        async with cm:
+            pass
+        self.assertEqual(self.state, ['enter'])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.state, ['enter', 'exit'])
+
+    @_async_test
+    async def test_aclose(self):
+        cm = shared(self.resource, linger=60)
+        async with cm:
+            with self.assertRaises(RuntimeError):
+                await cm.aclose()
+        self.assertEqual(self.state, ['enter'])
+        await cm.aclose()
+        self.assertEqual(self.state, ['enter', 'exit'])
+
+
+class TestAsyncLazy(unittest.TestCase):
+
+    @_async_test
+    async def test_async_lazy(self):
+        state = []
+
+        @asynccontextmanager
+        async def resource(name):
+            state.append(('enter', name))
+            yield name
+            state.append(('exit', name))
+
+        async with AsyncExitStack() as stack:
+            unused = await stack.enter_async_context(lazy(resource, 'a'))
+            used = await stack.enter_async_context(lazy(resource, 'b'))
+            self.assertEqual(await used.aget(), 'b')
+            self.assertEqual(await used.aget(), 'b')
+            self.assertFalse(unused.entered)
+        self.assertEqual(state, [('enter', 'b'), ('exit', 'b')])
+
+    @_async_test
+    async def test_sync_cm_in_async_with(self):
+        state = []
+
+        @contextmanager
+        def resource():
+            state.append('enter')
+            yield 42
+            state.append('exit')
+
+        async with lazy(resource) as cm:
+            self.assertEqual(cm.get(), 42)
+        self.assertEqual(state, ['enter', 'exit'])
+
+    @_async_test
+    async def test_async_cm_in_sync_with(self):
+        @asynccontextmanager
+        async def resource():
+            yield
+
+        cm = lazy(resource)
+        with self.assertRaisesRegex(RuntimeError, 'async with'):
+            with cm:
+                await cm.aget()
+        await cm.__aexit__(None, None, None)
+
+
+class TestAsyncCachedContextManager(unittest.TestCase):
+
+    @_async_test
+    async def test_async_cached_contextmanager(self):
+        state = []
+
+        @cached_contextmanager(maxsize=1)
+        async def resource(name):
+            state.append(('enter', name))
+            yield name
+            await asyncio.sleep(0)
+            state.append(('exit', name))
+
+        async def use(name):
+            async with resource(name) as result:
+                await asyncio.sleep(0)
+                return result
+
+        self.assertEqual(await asyncio.gather(use('a'), use('a')), ['a', 'a'])
+        self.assertEqual(await use('b'), 'b')
+        self.assertEqual(state, [('enter', 'a'), ('enter', 'b'), ('exit', 'a')])
+        self.assertEqual(resource.cache_info(), (1, 2, 1, 1, 1))
+        with self.assertRaisesRegex(RuntimeError, 'cache_aclear'):
+            resource.cache_clear()
+        await resource.cache_aclear()
+        self.assertEqual(state[-1], ('exit', 'b'))
+
+    @_async_test
+    async def test_async_nested_factory_cleanup(self):
+        state = []
+
+        @cached_contextmanager(maxsize=1)
+        async def resource(depth):
+            state.append(('enter', depth))
+            if depth:
+                # The cleanup exits another cached call of the same function
+                async with resource(depth - 1) as inner:
+                    yield (depth, inner)
+            else:
+                yield depth
+            state.append(('exit', depth))
+
+        async with resource(1) as result:
+            self.assertEqual(result, (1, 0))
+        self.assertEqual(state, [('enter', 1), ('enter', 0)])
+        await resource.cache_aclear()
+        self.assertEqual(state[2:], [('exit', 0), ('exit', 1)])
+        async with resource(2):
+            pass
+        async with resource(3):
+            pass
+        self.assertEqual(resource.cache_info().currsize, 1)
+
+    @_async_test
+    async def test_async_factory_runs_without_lock(self):
+        state = []
+        release = asyncio.Event()
+
+        @cached_contextmanager
+        async def resource(name):
+            state.append(('enter', name))
+            if name.startswith('slow'):
+                await release.wait()
+            elif name == 'outer':
+                # Reentrant use of the cache with a different key
+                async with resource('inner') as inner:
+                    yield (name, inner)
+                    return
+            yield name
+
+        async def use(name):
+            async with resource(name) as result:
+                return result
+
+        slow = [asyncio.ensure_future(use('slow')) for _ in range(2)]
+        await asyncio.sleep(0)
+        self.assertEqual(await use('outer'), ('outer', 'inner'))
+        self.assertFalse(any(task.done() for task in slow))
+        release.set()
+        self.assertEqual(await asyncio.gather(*slow), ['slow', 'slow'])
+        self.assertEqual(state.count(('enter', 'slow')), 1)
+        self.assertEqual(resource.cache_info()[:2], (1, 3))
+
+        # A cancelled entry doesn't leave its key pending
+        release.clear()
+        task = asyncio.ensure_future(use('slow cancelled'))
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        release.set()
+        self.assertEqual(await use('slow cancelled'), 'slow cancelled')
+
+
+class TestAsyncContextHooks(unittest.TestCase):
+
+    @_async_test
+    async def test_async_hooks(self):
+        events = []
+
+        def hook(event, cm, duration, exc_type):
+            events.append((event, cm, exc_type))
+
+        @asynccontextmanager
+        async def woohoo():
+            yield
+
+        async def callback():
+            pass
+
+        add_context_hook(hook)
+        try:
+            cm = woohoo()
+            async with AsyncExitStack() as stack:
+                await stack.enter_async_context(cm)
+                stack.push_async_callback(callback)
+        finally:
+            remove_context_hook(hook)
+        self.assertEqual(events, [
+            ('enter', cm, None),
+            ('exit', callback, None),
+            ('exit', cm, None),
+        ])
+
+    @_async_test
+    async def test_async_hooks_wrapped_callbacks(self):
+        events = []
+
+        def hook(event, cm, duration, exc_type):
+            events.append((event, cm, exc_type))
+
+        class BlockingCM:
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_details):
+                pass
+
+        async def callback():
+            pass
+
+        def sync_callback():
+            pass
+
+        cm = BlockingCM()
+        add_context_hook(hook)
+        try:
+            async with AsyncExitStack() as stack:
+                stack.enable_profiling()
+                stack.set_exit_timeouts(10)
+                await stack.enter_context_in_executor(cm)
+                with stack.concurrent_group():
+                    stack.push_async_callback(callback)
+                    stack.callback(sync_callback)
+        finally:
+            remove_context_hook(hook)
+        # After concurrent_group() itself, the context manager (rather than
+        # the executor entry) and the callbacks in the group (rather than
+        # the group) are reported
+        self.assertEqual([event for event, cm, exc_type in events[:2]],
+                         ['enter', 'exit'])
+        self.assertEqual(events[2:], [
+            ('exit', sync_callback, None),
+            ('exit', callback, None),
+            ('exit', cm, None),
+        ])
+
+
+class TestAsyncSpanTracer(unittest.TestCase):
+
+    @_async_test
+    async def test_async_span_tree(self):
+        @asynccontextmanager
+        async def cm():
+            yield
+
+        async def task():
+            async with cm():
+                await asyncio.sleep(0)
+
+        with SpanTracer() as tracer:
+            async with AsyncExitStack() as stack:
+                await stack.enter_async_context(cm())
+                await asyncio.gather(task(), task())
+        spans = tracer.spans
+        self.assertEqual([span.name.rpartition(".")[2] for span in spans],
+                         ["cm", "cm", "cm", "AsyncExitStack"])
+        # Both tasks are children of the context manager entered on the stack
+        self.assertEqual(spans[0].parent_id, spans[2].span_id)
+        self.assertEqual(spans[1].parent_id, spans[2].span_id)
+        self.assertEqual(spans[2].parent_id, spans[3].span_id)
+        self.assertIsNone(spans[3].parent_id)
+
+
+class TestAsyncCountingSuppress(unittest.TestCase):
+
+    @_async_test
+    async def test_async_counting_suppress(self):
+        cm = counting_suppress(KeyError)
+        async with cm:
+            await asyncio.sleep(0)
+            raise KeyError
+
+        @cm
+        async def lookup(key):
+            await asyncio.sleep(0)
+            return {"a": 1}[key]
+
+        self.assertEqual(await lookup("a"), 1)
+        self.assertIsNone(await lookup("b"))
+        self.assertEqual(cm.counts, {KeyError: 2})
+        self.assertEqual(len(cm.samples), 2)
+        self.assertIn("in lookup\n", cm.samples[1])
+
+    @_async_test
+    async def test_async_counting_suppress_hooks(self):
+        events = []
+
+        def hook(event, cm, duration, exc_type):
+            events.append((event, cm, exc_type))
+
+        cm = counting_suppress(KeyError)
+        add_context_hook(hook)
+        try:
+            async with cm:
+                raise KeyError
+        finally:
+            remove_context_hook(hook)
+        self.assertEqual(events, [('enter', cm, None), ('exit', cm, KeyError)])
+
+
+class TestAsyncTimed(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(_latency_histograms.pop, "test.timed", None)
+        self.histogram = get_latency_histogram("test.timed")
+
+    @_async_test
+    async def test_async_timed(self):
+        async with timed("test.timed") as cm:
+            await asyncio.sleep(0.01)
+        self.assertIs(cm.histogram, self.histogram)
+        self.assertEqual(self.histogram.count, 1)
+        self.assertGreaterEqual(self.histogram.percentile(50), 0.01 * 0.98)
+
+    @_async_test
+    async def test_async_timed_decorator(self):
+        @timed("test.timed")
+        async def test(x):
+            await asyncio.sleep(0)
+            return x * 2
+
+        self.assertEqual(await asyncio.gather(test(1), test(2)), [2, 4])
+        self.assertEqual(self.histogram.count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()